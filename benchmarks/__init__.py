@@ -0,0 +1,4 @@
+"""
+Benchmarks of ineedproxy against local fake proxies and targets, see `python -m benchmarks --help`.
+Not part of the installed package.
+"""
@@ -0,0 +1,87 @@
+"""
+Runs the benchmarks and prints the results as JSON.
+
+    python -m benchmarks                 # everything, takes a few minutes
+    python -m benchmarks --quick         # small sizes, a few seconds
+    python -m benchmarks --only get_proxy feedback --output before.json
+
+Everything runs against local fake proxies and targets, no network is needed.
+Compare two runs with `python -m benchmarks.compare before.json after.json`.
+"""
+from typing import Any, Dict
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import sys
+import time
+
+from ineedproxy import __version__
+
+from .suite import bench_feedback, bench_get_proxy, bench_get_request, bench_validation
+
+BENCHMARKS = ("get_proxy", "feedback", "validation", "get_request")
+
+_FULL = {
+    "get_proxy": {"sizes": [1_000, 10_000, 100_000], "duration": 1.0,
+                  "selections": ["random", "round_robin", "p2c", "fastest"]},
+    "feedback": {"size": 10_000, "calls": 2_000},
+    "validation": {"count": 500, "dead": 500, "concurrency_levels": [10, 50, 200, 500], "latency": 0.05,
+                   "failure_rate": 0.1, "prefilter_timeout": 1.0},
+    "get_request": {"proxies": 50, "requests": 2_000, "concurrency": 50, "latency": 0.02, "failure_rate": 0.05,
+                    "selections": ["random", "p2c", "fastest"]},
+}
+
+_QUICK = {
+    "get_proxy": {"sizes": [1_000, 10_000], "duration": 0.2, "selections": ["random"]},
+    "feedback": {"size": 1_000, "calls": 200},
+    "validation": {"count": 50, "dead": 50, "concurrency_levels": [10, 50], "latency": 0.01,
+                   "failure_rate": 0.1, "prefilter_timeout": 1.0},
+    "get_request": {"proxies": 10, "requests": 200, "concurrency": 20, "latency": 0.01, "failure_rate": 0.05,
+                    "selections": ["random"]},
+}
+
+
+async def _run(name: str, params: Dict[str, Any]) -> Any:
+    if name == "get_proxy":
+        return bench_get_proxy(**params)
+    if name == "feedback":
+        return bench_feedback(**params)
+    if name == "validation":
+        return await bench_validation(**params)
+    return await bench_get_request(**params)
+
+
+async def main(only=BENCHMARKS, quick: bool = False) -> Dict[str, Any]:
+    config = _QUICK if quick else _FULL
+    report: Dict[str, Any] = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "quick": quick,
+        "results": {},
+    }
+    for name in only:
+        print(f"Running {name} ...", file=sys.stderr)
+        start = time.perf_counter()
+        report["results"][name] = {"params": config[name], "runs": await _run(name, config[name]),
+                                   "seconds": time.perf_counter() - start}
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Benchmarks of ineedproxy.")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument("--quick", action="store_true", help="Small sizes, for a quick check.")
+    parser.add_argument("--output", help="Write the JSON to this file instead of stdout.")
+    args = parser.parse_args()
+
+    logging.getLogger("ineedproxy").setLevel(logging.ERROR)  # failing fake proxies would log every attempt
+    result = json.dumps(asyncio.run(main(args.only, args.quick)), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(result + "\n")
+    else:
+        print(result)
@@ -0,0 +1,47 @@
+"""
+Compares two JSON reports of `python -m benchmarks`, run by run.
+
+    python -m benchmarks.compare before.json after.json
+
+Prints the throughput and latency of every run in both reports and the change in percent.
+"""
+from typing import Any, Dict, Iterable, Tuple
+import json
+import sys
+
+# Fields that tell runs of a benchmark apart, everything else is a measurement
+_KEYS = ("pool_size", "selection", "filter", "mode", "concurrency", "candidates", "proxies")
+# Measurements worth comparing, with True when higher is better
+_METRICS = {"ops_per_sec": True, "tested_per_sec": True, "requests_per_sec": True,
+            "p50_ms": False, "p99_ms": False}
+
+
+def _runs(report: Dict[str, Any]) -> Iterable[Tuple[str, Tuple, Dict[str, Any]]]:
+    for name, result in report["results"].items():
+        for run in result["runs"]:
+            yield name, tuple((key, run[key]) for key in _KEYS if key in run), run
+
+
+def compare(before: Dict[str, Any], after: Dict[str, Any]) -> str:
+    old = {(name, key): run for name, key, run in _runs(before)}
+    lines = [f"{before['version']} -> {after['version']}"]
+    for name, key, run in _runs(after):
+        previous = old.get((name, key))
+        if previous is None:
+            continue
+        label = f"{name} " + " ".join(f"{field}={value}" for field, value in key)
+        for metric, higher_is_better in _METRICS.items():
+            if metric not in run or not previous.get(metric):
+                continue
+            change = (run[metric] - previous[metric]) / previous[metric] * 100
+            better = change > 0 if higher_is_better else change < 0
+            lines.append(f"{label:<70} {metric:<16} {previous[metric]:>12.1f} {run[metric]:>12.1f} "
+                         f"{change:>+7.1f}%{'' if better or abs(change) < 5 else '  !'}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: python -m benchmarks.compare BEFORE.json AFTER.json")
+    with open(sys.argv[1]) as before_file, open(sys.argv[2]) as after_file:
+        print(compare(json.load(before_file), json.load(after_file)))
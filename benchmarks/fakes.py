@@ -0,0 +1,109 @@
+from typing import Dict, List, Optional
+import asyncio
+import random
+
+import aiohttp
+from aiohttp import web
+
+
+class FakeTarget:
+    """A local site answering every path with {"origin": ...} like httpbin.org/ip, after an optional delay."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.url: Optional[str] = None
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.json_response({"origin": request.remote})
+
+    async def start(self) -> "FakeTarget":
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", 0).start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}/ip"
+        return self
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+class FakeProxies:
+    """
+    Local HTTP forward proxies, one port each, forwarding plain http requests to the real target.
+
+    Every proxy has its own latency and failure rate. A failing request is answered with 502 or,
+    for half of them, the connection is dropped, like dead free proxies do.
+    Dead proxies are returned as well, as urls of ports that nothing listens on.
+    """
+
+    def __init__(self, count: int, latency: float = 0.0, latency_jitter: float = 0.0, failure_rate: float = 0.0,
+                 dead: int = 0, seed: int = 0):
+        self.count = count
+        self.dead = dead
+        self._random = random.Random(seed)
+        self._config: Dict[int, tuple] = {}
+        self._latency = latency
+        self._jitter = latency_jitter
+        self._failure_rate = failure_rate
+        self._runner: Optional[web.AppRunner] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.urls: List[str] = []
+        self.dead_urls: List[str] = []
+        self.requests = 0
+
+    async def _handle(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        port = request.transport.get_extra_info("sockname")[1]
+        latency, failure_rate = self._config[port]
+        if latency:
+            await asyncio.sleep(latency * (1 + self._random.uniform(-self._jitter, self._jitter)))
+        if failure_rate and self._random.random() < failure_rate:
+            if self._random.random() < 0.5:
+                request.transport.close()
+            raise web.HTTPBadGateway()
+        async with self._session.request(request.method, str(request.url)) as response:
+            return web.Response(body=await response.read(), status=response.status,
+                                content_type=response.content_type)
+
+    async def start(self) -> "FakeProxies":
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+        for _ in range(self.count):
+            site = web.TCPSite(self._runner, "127.0.0.1", 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+            self._config[port] = (self._latency, self._failure_rate)
+            self.urls.append(f"http://127.0.0.1:{port}")
+
+        # Ports that were just free, so connecting to them is refused
+        for _ in range(self.dead):
+            probe = await asyncio.start_server(lambda reader, writer: None, "127.0.0.1", 0)
+            port = probe.sockets[0].getsockname()[1]
+            probe.close()
+            await probe.wait_closed()
+            self.dead_urls.append(f"http://127.0.0.1:{port}")
+        return self
+
+    def set(self, url: str, latency: Optional[float] = None, failure_rate: Optional[float] = None) -> None:
+        """Changes the behaviour of a single proxy."""
+        port = int(url.rsplit(":", 1)[1])
+        old_latency, old_failure_rate = self._config[port]
+        self._config[port] = (old_latency if latency is None else latency,
+                              old_failure_rate if failure_rate is None else failure_rate)
+
+    async def stop(self) -> None:
+        # Handlers still forwarding a request (a slow hedged one, say) need the session until the runner is down
+        if self._runner is not None:
+            await self._runner.cleanup()
+        if self._session is not None:
+            await self._session.close()
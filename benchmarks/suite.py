@@ -0,0 +1,182 @@
+from pathlib import Path
+from statistics import quantiles
+from tempfile import TemporaryDirectory
+from typing import Any, Dict, List, Optional, Sequence
+import asyncio
+import random
+import time
+
+from ineedproxy import Manager, ProxyDict, URL
+from ineedproxy.data_manager import DataManager
+from ineedproxy.test_proxies import get_valid_proxies
+
+from .fakes import FakeProxies, FakeTarget
+
+_COUNTRIES = ("US", "DE", "FR", "GB", "NL", "BR", "IN", "JP", "RU", "CN")
+_ANONYMITIES = ("elite", "anonymous", "transparent")
+_PROTOCOLS = ("http", "https", "socks4", "socks5")
+
+# Preferences get_proxy is measured with, from no filter to one matching a few percent of the pool
+FILTERS: Dict[str, Dict[str, Any]] = {
+    "none": {},
+    "protocol": {"protocol": "http"},
+    "country": {"country": "US"},
+    "combined": {"protocol": ["http", "https"], "country": ["US", "DE"], "exclude_anonymity": "transparent"},
+}
+
+
+def _summary(samples: Sequence[float]) -> Dict[str, float]:
+    """Milliseconds of the usual quantiles."""
+    ordered = sorted(samples)
+    if len(ordered) < 2:
+        value = ordered[0] * 1000 if ordered else 0.0
+        return {"p50_ms": value, "p90_ms": value, "p99_ms": value, "max_ms": value}
+    cuts = quantiles(ordered, n=100, method="inclusive")
+    return {"p50_ms": cuts[49] * 1000, "p90_ms": cuts[89] * 1000, "p99_ms": cuts[98] * 1000,
+            "max_ms": ordered[-1] * 1000}
+
+
+def synthetic_proxies(count: int, seed: int = 0) -> List[ProxyDict]:
+    """Proxies with unique addresses and a random mix of protocols, countries and anonymities, nothing listens there."""
+    rng = random.Random(seed)
+    proxies = []
+    for i in range(count):
+        url = f"{rng.choice(_PROTOCOLS)}://10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}:{1024 + i % 60000}"
+        proxies.append(ProxyDict(url=URL(url), country=rng.choice(_COUNTRIES), anonymity=rng.choice(_ANONYMITIES)))
+    return proxies
+
+
+def _data_manager(data_file: Optional[Path], proxies: List[ProxyDict], **kwargs: Any) -> DataManager:
+    data_manager = DataManager(data_file, allowed_fails_in_row=3, fails_without_check=2,
+                               percent_failed_to_remove=0.5, min_proxies=0, **kwargs)
+    data_manager.add_proxy(proxies)
+    return data_manager
+
+
+def bench_get_proxy(sizes: Sequence[int], duration: float, selections: Sequence[str] = ("random",)) -> List[dict]:
+    """get_proxy calls per second for every pool size, filter and selection strategy."""
+    results = []
+    for size in sizes:
+        proxies = synthetic_proxies(size)
+        for selection in selections:
+            data_manager = _data_manager(None, proxies, selection=selection)
+            for name, preferences in FILTERS.items():
+                get_proxy = data_manager.get_proxy
+                get_proxy(**preferences)  # builds the pool of the filter, measured separately
+                calls = 0
+                start = time.perf_counter()
+                stop_at = start + duration
+                while True:
+                    for _ in range(100):
+                        get_proxy(**preferences)
+                    calls += 100
+                    if time.perf_counter() >= stop_at:
+                        break
+                elapsed = time.perf_counter() - start
+                results.append({"pool_size": size, "selection": selection, "filter": name,
+                                "calls": calls, "ops_per_sec": calls / elapsed})
+    return results
+
+
+def bench_feedback(size: int, calls: int) -> List[dict]:
+    """Cost of a feedback_proxy call without a store file and with every way of persisting it."""
+    modes = {
+        "memory": {},
+        "write_through": {},
+        "write_behind": {"flush_interval": 1.0, "flush_threshold": 1000},
+        "journal": {"journal": True},
+    }
+    proxies = synthetic_proxies(size)
+    results = []
+    for mode, kwargs in modes.items():
+        with TemporaryDirectory() as directory:
+            data_file = None if mode == "memory" else Path(directory) / "proxy_data"
+            data_manager = _data_manager(data_file, proxies, **kwargs)
+            rng = random.Random(0)
+            timings = []
+            start = time.perf_counter()
+            for _ in range(calls):
+                data_manager.get_proxy()
+                success = rng.random() < 0.8
+                call_start = time.perf_counter()
+                data_manager.feedback_proxy(success, rng.uniform(0.05, 0.5) if success else None)
+                timings.append(time.perf_counter() - call_start)
+            elapsed = time.perf_counter() - start
+            close_start = time.perf_counter()
+            data_manager.close()
+            results.append({"mode": mode, "pool_size": size, "calls": calls,
+                            "ops_per_sec": calls / elapsed, "close_ms": (time.perf_counter() - close_start) * 1000,
+                            **_summary(timings)})
+    return results
+
+
+async def bench_validation(count: int, dead: int, concurrency_levels: Sequence[int], latency: float,
+                           failure_rate: float, prefilter_timeout: Optional[float]) -> List[dict]:
+    """Proxies tested per second by get_valid_proxies against local fake proxies, for every concurrency level."""
+    target = await FakeTarget().start()
+    fakes = await FakeProxies(count, latency=latency, latency_jitter=0.5, failure_rate=failure_rate,
+                              dead=dead).start()
+    candidates = [ProxyDict(url=URL(url), country=None, anonymity=None) for url in fakes.urls + fakes.dead_urls]
+    random.Random(0).shuffle(candidates)
+    results = []
+    try:
+        for concurrency in concurrency_levels:
+            start = time.perf_counter()
+            valid = await get_valid_proxies(candidates, simultaneous_proxy_requests=concurrency,
+                                            test_url=target.url, timeout=5, prefilter_timeout=prefilter_timeout)
+            elapsed = time.perf_counter() - start
+            results.append({"candidates": len(candidates), "concurrency": concurrency, "valid": len(valid),
+                            "seconds": elapsed, "tested_per_sec": len(candidates) / elapsed})
+    finally:
+        await fakes.stop()
+        await target.stop()
+    return results
+
+
+async def bench_get_request(proxies: int, requests: int, concurrency: int, latency: float, failure_rate: float,
+                            selections: Sequence[str]) -> List[dict]:
+    """End to end latency of Manager.get_request through local fake proxies, for every selection strategy."""
+    target = await FakeTarget().start()
+    fakes = await FakeProxies(proxies, latency=latency, latency_jitter=0.5, failure_rate=failure_rate).start()
+    # A few slow proxies, so strategies that learn latency have something to learn
+    for url in fakes.urls[:max(proxies // 10, 1)]:
+        fakes.set(url, latency=latency * 10)
+
+    async def source() -> List[ProxyDict]:
+        return [ProxyDict(url=URL(url), country=None, anonymity=None) for url in fakes.urls]
+
+    results = []
+    try:
+        for selection in selections:
+            async with Manager([source], data_file=None, test_url=target.url, test_timeout=5, max_proxies=proxies,
+                               min_proxies=1, selection=selection, dead_proxy_ttl=None,
+                               allowed_fails_in_row=1000, percent_failed_to_remove=1.0) as manager:
+                semaphore = asyncio.Semaphore(concurrency)
+                timings: List[float] = []
+                failed = 0
+
+                async def one() -> None:
+                    nonlocal failed
+                    async with semaphore:
+                        request_start = time.perf_counter()
+                        try:
+                            await manager.get_request(target.url, timeout=5)
+                        except Exception:
+                            failed += 1
+                            return
+                        timings.append(time.perf_counter() - request_start)
+
+                start = time.perf_counter()
+                await asyncio.gather(*(one() for _ in range(requests)))
+                elapsed = time.perf_counter() - start
+                results.append({"selection": selection, "proxies": proxies, "requests": requests,
+                                "concurrency": concurrency, "failed": failed,
+                                "requests_per_sec": requests / elapsed, **_summary(timings)})
+    finally:
+        await fakes.stop()
+        await target.stop()
+    return results
+
+
+__all__ = ['FILTERS', 'synthetic_proxies', 'bench_get_proxy', 'bench_feedback', 'bench_validation',
+           'bench_get_request']
@@ -24,17 +24,18 @@ fetching_method = [fetch_proxies]
 if __name__ == '__main__':
     async def main():
         # Create a proxy manager and instantly start fetching some proxies if missing
-        manager = await inp.Manager(fetching_method=fetching_method, data_file=proxy_data,
-                                    auto_fetch_proxies=True)  # define the manager and let it do the work
-
-        proxy_response = await manager.get_request(url="https://httpbin.org/ip")  # test the proxies
-        # this method will automatically use the manager.get_proxy method
-        # which will fetch more proxies if needed and act accordingly to the settings
-        # !! to use this very automatic method without crashing the program, set auto_fetch_proxies=True !!
-
-        # Debug output
-        print("Proxies:", len(manager))
-        print("Proxy_response:\n", proxy_response)
+        # leaving the block closes its connection pool and writes pending data
+        async with inp.Manager(fetching_method=fetching_method, data_file=proxy_data,
+                               auto_fetch_proxies=True) as manager:  # define the manager and let it do the work
+
+            proxy_response = await manager.get_request(url="https://httpbin.org/ip")  # test the proxies
+            # this method will automatically use the manager.get_proxy method
+            # which will fetch more proxies if needed and act accordingly to the settings
+            # !! to use this very automatic method without crashing the program, set auto_fetch_proxies=True !!
+
+            # Debug output
+            print("Proxies:", len(manager))
+            print("Proxy_response:\n", proxy_response)
 
 
     asyncio.run(main())
@@ -3,11 +3,20 @@
 Library module initialization.
 """
 
-from typing import Tuple, List
+from typing import Tuple
 
 from .manager import Manager
-from .utils import NoProxyAvailable, ProxyPreferences, ProxyDict, URL
-from .get import fetch_json_proxy_list
+from .lease import ProxyLease
+from .selection import SelectionStrategy
+from .utils import NoProxyAvailable, RequestFailed, ProxyPreferences, ProxyDict, URL, SourceStats
+from .get import fetch_json_proxy_list, fetch_proxy_list
+from .parsing import parse_proxy_list
+from .source_cache import SourceCache
+from .dead_cache import DeadProxyCache, BloomDeadProxyCache
+from .socks import SocksConnector, socks_connector
+from .metrics import Metrics, PROMETHEUS_CONTENT_TYPE
+from .tracing import AttemptTrace
+from .shared_pool import PoolServer, PoolClient, SharedPoolError
 
 # Version information
 from . import version
@@ -15,11 +24,28 @@ from . import version
 # Define what will be imported with `from library import *`
 __all__: Tuple[str, ...] = (
     "Manager",
+    "ProxyLease",
+    "SelectionStrategy",
     "NoProxyAvailable",
+    "RequestFailed",
     "ProxyPreferences",
     "ProxyDict",
+    "SourceStats",
     "URL",
     "fetch_json_proxy_list",
+    "fetch_proxy_list",
+    "parse_proxy_list",
+    "SourceCache",
+    "DeadProxyCache",
+    "BloomDeadProxyCache",
+    "SocksConnector",
+    "socks_connector",
+    "Metrics",
+    "PROMETHEUS_CONTENT_TYPE",
+    "AttemptTrace",
+    "PoolServer",
+    "PoolClient",
+    "SharedPoolError",
     "__version__",
 )
 
@@ -0,0 +1,349 @@
+from array import array
+from collections.abc import MutableMapping
+from math import isnan, nan
+import threading
+from socket import inet_aton, inet_ntoa
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from weakref import WeakValueDictionary
+
+from .utils import URL
+
+# Fields every proxy record has, stored in typed columns. Others go into a per-row dict.
+_CODED = ("protocol", "country", "anonymity")
+_COUNTERS = ("times_failed", "times_succeed", "times_failed_in_row", "breaker_trips")
+_FLOATS = ("last_checked", "last_ok", "latency", "error_score", "open_until")  # NaN stands for None
+FIELDS: Tuple[str, ...] = ("url",) + _CODED + _COUNTERS + _FLOATS
+
+_FLOAT_DEFAULTS = {"error_score": 0.0}
+
+
+class _Codes:
+    """Interns the values of a low-cardinality field as small ints, 0 is None."""
+    __slots__ = ("values", "codes")
+
+    def __init__(self):
+        self.values: List[Any] = [None]
+        self.codes: Dict[Any, int] = {None: 0}
+
+    def code(self, value: Any) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class ProxyRow(MutableMapping):
+    """
+    A dict-like view of one record of ColumnarSlots. Reads and writes go straight to the columns,
+    so code written for dict records works unchanged.
+
+    ColumnarSlots hands out the same view for a record as long as anyone holds it,
+    so identity checks like `slots.get(proxy_id) is proxy` keep working.
+    A view of a removed record raises KeyError instead of touching the record that reuses the slot.
+    """
+    __slots__ = ("_slots", "_id", "_generation", "__weakref__")
+
+    def __init__(self, slots: "ColumnarSlots", proxy_id: int):
+        self._slots = slots
+        self._id = proxy_id
+        self._generation = slots._generations[proxy_id]
+
+    def _check(self) -> int:
+        if self._slots._generations[self._id] != self._generation:
+            raise KeyError(f"Proxy {self._id} was removed")
+        return self._id
+
+    def __getitem__(self, key: str) -> Any:
+        return self._slots._read(self._check(), key)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self._slots._write(self._check(), key, value)
+
+    def __delitem__(self, key: str) -> None:
+        proxy_id = self._check()
+        if key in self._slots._field_set:
+            raise KeyError(f"Can't delete the column {key}")
+        del self._slots._extra[proxy_id][key]
+
+    def __iter__(self) -> Iterator[str]:
+        yield from FIELDS
+        extra = self._slots._extra.get(self._check())
+        if extra:
+            yield from list(extra)
+
+    def __len__(self) -> int:
+        return len(FIELDS) + len(self._slots._extra.get(self._check(), ()))
+
+    def __repr__(self) -> str:
+        return f"ProxyRow({dict(self)!r})"
+
+
+class ColumnarSlots:
+    """
+    Slot storage for proxy records like ProxySlots, with each field kept in a typed array instead of a dict per proxy.
+
+    IPv4 addresses are packed into 4 bytes and ports into 2, protocol, country and anonymity are interned
+    as small ints, counters and timestamps live in int and float arrays. A record takes about 75 bytes
+    instead of about 500 for a dict with its url string. Urls that can't be rebuilt from
+    protocol, IPv4 and port, and fields outside of FIELDS, are kept as they are in side dicts.
+
+    get() returns a ProxyRow, created only when asked for and shared while it is in use.
+    snapshot() and column() read the columns in bulk.
+    """
+
+    def __init__(self, first_generation: int = 0):
+        # Held while a record is added, removed or changes its url or a non-numeric field, and while snapshot()
+        # copies the columns on the store thread, so it never sees a record half written.
+        self._lock = threading.Lock()
+        self._reset(first_generation)
+
+    def _reset(self, first_generation: int) -> None:
+        self._first_generation = first_generation
+        self._ip = array("I")
+        self._port = array("H")
+        self._codes = {field: _Codes() for field in _CODED}
+        self._coded = {field: array("H") for field in _CODED}
+        self._counters = {field: array("I") for field in _COUNTERS}
+        self._floats = {field: array("d") for field in _FLOATS}
+        self._alive = bytearray()
+        self._generations = array("I")  # bumped on remove, so old views of the slot are told apart
+        self._urls: Dict[int, str] = {}  # urls that are not protocol://IPv4:port
+        self._extra: Dict[int, Dict[str, Any]] = {}
+        self._views: "WeakValueDictionary[int, ProxyRow]" = WeakValueDictionary()
+        self._free: List[int] = []
+        self._count = 0
+        self._field_set = frozenset(FIELDS)
+
+    # Single fields
+
+    def _read(self, proxy_id: int, key: str) -> Any:
+        if key == "url":
+            url = self._urls.get(proxy_id)
+            if url is not None:
+                return url
+            protocol = self._codes["protocol"].values[self._coded["protocol"][proxy_id]]
+            return f"{protocol}://{inet_ntoa(self._ip[proxy_id].to_bytes(4, 'big'))}:{self._port[proxy_id]}"
+        column = self._coded.get(key)
+        if column is not None:
+            return self._codes[key].values[column[proxy_id]]
+        column = self._counters.get(key)
+        if column is not None:
+            return column[proxy_id]
+        column = self._floats.get(key)
+        if column is not None:
+            value = column[proxy_id]
+            return None if isnan(value) else value
+        extra = self._extra.get(proxy_id)
+        if extra is None or key not in extra:
+            raise KeyError(key)
+        return extra[key]
+
+    def _write(self, proxy_id: int, key: str, value: Any) -> None:
+        column = self._counters.get(key)
+        if column is not None:
+            column[proxy_id] = value or 0
+            return
+        column = self._floats.get(key)
+        if column is not None:
+            column[proxy_id] = nan if value is None else value
+            return
+        with self._lock:
+            if key == "url" or key == "protocol":
+                url = self._read(proxy_id, "url") if key == "protocol" else value
+                if key == "protocol":
+                    self._coded["protocol"][proxy_id] = self._codes["protocol"].code(value)
+                self._set_url(proxy_id, url)
+                return
+            column = self._coded.get(key)
+            if column is not None:
+                column[proxy_id] = self._codes[key].code(value)
+                return
+            self._extra.setdefault(proxy_id, {})[key] = value
+
+    def _set_url(self, proxy_id: int, url: str) -> None:
+        self._urls.pop(proxy_id, None)
+        parsed = URL(url)
+        protocol = self._codes["protocol"].values[self._coded["protocol"][proxy_id]]
+        if parsed.ip and parsed.port and parsed.protocol == protocol \
+                and url == f"{protocol}://{parsed.ip}:{parsed.port}":
+            try:
+                self._ip[proxy_id] = int.from_bytes(inet_aton(parsed.ip), "big")
+                self._port[proxy_id] = parsed.port
+                return
+            except (OSError, OverflowError):
+                pass
+        self._urls[proxy_id] = url
+
+    # ProxySlots interface
+
+    def add(self, proxy: Dict[str, Any]) -> int:
+        """Stores a record and returns its id."""
+        with self._lock:
+            return self._add(proxy)
+
+    def _add(self, proxy: Dict[str, Any]) -> int:
+        if self._free:
+            proxy_id = self._free.pop()
+            self._alive[proxy_id] = 1
+        else:
+            proxy_id = len(self._alive)
+            self._alive.append(1)
+            self._generations.append(self._first_generation)
+            self._ip.append(0)
+            self._port.append(0)
+            for column in self._coded.values():
+                column.append(0)
+            for column in self._counters.values():
+                column.append(0)
+            for column in self._floats.values():
+                column.append(nan)
+
+        for field in _CODED:
+            self._coded[field][proxy_id] = self._codes[field].code(proxy.get(field))
+        for field in _COUNTERS:
+            self._counters[field][proxy_id] = proxy.get(field) or 0
+        for field in _FLOATS:
+            value = proxy.get(field, _FLOAT_DEFAULTS.get(field))
+            self._floats[field][proxy_id] = nan if value is None else value
+        self._set_url(proxy_id, str(proxy["url"]))
+        extra = {key: value for key, value in proxy.items() if key not in self._field_set}
+        if extra:
+            self._extra[proxy_id] = extra
+        self._count += 1
+        return proxy_id
+
+    def remove(self, proxy_id: int) -> Dict[str, Any]:
+        """Empties the slot of a record and returns a copy of the record."""
+        proxy = self.get(proxy_id)
+        if proxy is None:
+            raise IndexError("Proxy does not exist")
+        record = dict(proxy)
+        with self._lock:
+            self._alive[proxy_id] = 0
+            self._generations[proxy_id] += 1
+            self._views.pop(proxy_id, None)
+            self._urls.pop(proxy_id, None)
+            self._extra.pop(proxy_id, None)
+            self._free.append(proxy_id)
+            self._count -= 1
+        return record
+
+    def get(self, proxy_id: int) -> Optional[ProxyRow]:
+        if not (0 <= proxy_id < len(self._alive)) or not self._alive[proxy_id]:
+            return None
+        view = self._views.get(proxy_id)
+        if view is None:
+            view = self._views[proxy_id] = ProxyRow(self, proxy_id)
+        return view
+
+    def clear(self) -> None:
+        # Views of the old records must not match the new ones that get their slots
+        with self._lock:
+            self._reset(max(self._generations, default=self._first_generation) + 1)
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """
+        Copies all records into plain dicts.
+        Safe to call from the writing thread of the store: the columns are copied under the lock,
+        which takes a few milliseconds for 100k records, and the dicts are built from the copies afterwards.
+        """
+        with self._lock:
+            alive = bytes(self._alive)
+            ip, port = self._ip[:], self._port[:]
+            coded = {field: (list(self._codes[field].values), self._coded[field][:]) for field in _CODED}
+            counters = {field: column[:] for field, column in self._counters.items()}
+            floats = {field: column[:] for field, column in self._floats.items()}
+            urls = dict(self._urls)
+            extras = {proxy_id: dict(extra) for proxy_id, extra in self._extra.items()}
+
+        ids = [i for i in range(len(alive)) if alive[i]]
+        protocols, protocol_codes = coded["protocol"]
+        records = []
+        for proxy_id in ids:
+            url = urls.get(proxy_id)
+            if url is None:
+                url = (f"{protocols[protocol_codes[proxy_id]]}://"
+                       f"{inet_ntoa(ip[proxy_id].to_bytes(4, 'big'))}:{port[proxy_id]}")
+            records.append({"url": url})
+        for field, (values, column) in coded.items():
+            for record, proxy_id in zip(records, ids):
+                record[field] = values[column[proxy_id]]
+        for field, column in counters.items():
+            for record, proxy_id in zip(records, ids):
+                record[field] = column[proxy_id]
+        for field, column in floats.items():
+            for record, proxy_id in zip(records, ids):
+                value = column[proxy_id]
+                record[field] = None if value != value else value
+        for record, proxy_id in zip(records, ids):
+            extra = extras.get(proxy_id)
+            if extra:
+                record.update(extra)
+        return records
+
+    def ids(self) -> Iterator[int]:
+        alive = self._alive
+        return (i for i in range(len(alive)) if alive[i])
+
+    def values(self) -> Iterator[ProxyRow]:
+        return (self.get(i) for i in self.ids())
+
+    def items(self) -> Iterator[Tuple[int, ProxyRow]]:
+        return ((i, self.get(i)) for i in self.ids())
+
+    def __getitem__(self, proxy_id: int) -> ProxyRow:
+        proxy = self.get(proxy_id)
+        if proxy is None:
+            raise IndexError("Proxy does not exist")
+        return proxy
+
+    def __contains__(self, proxy_id: int) -> bool:
+        return 0 <= proxy_id < len(self._alive) and bool(self._alive[proxy_id])
+
+    def __iter__(self) -> Iterator[ProxyRow]:
+        return self.values()
+
+    def __len__(self) -> int:
+        return self._count
+
+    # Bulk access
+
+    def column(self, field: str) -> List[Any]:
+        """
+        The values of one field for all stored proxies in id order, like [proxy[field] for proxy in slots]
+        but read straight from the array without building rows.
+        """
+        alive = self._alive
+        if field in self._coded:
+            values, column = self._codes[field].values, self._coded[field]
+            return [values[code] for code, live in zip(column, alive) if live]
+        if field in self._counters:
+            return [value for value, live in zip(self._counters[field], alive) if live]
+        if field in self._floats:
+            return [None if value != value else value for value, live in zip(self._floats[field], alive) if live]
+        return [proxy[field] for proxy in self.values()]
+
+    def value_counts(self, field: str) -> Dict[Any, int]:
+        """How many stored proxies have each value of protocol, country or anonymity."""
+        counts = [0] * len(self._codes[field].values)
+        for code, live in zip(self._coded[field], self._alive):
+            if live:
+                counts[code] += 1
+        return {value: count for value, count in zip(self._codes[field].values, counts) if count}
+
+    def totals(self) -> Dict[str, int]:
+        """Sum of every counter over all stored proxies."""
+        alive = self._alive
+        return {field: sum(value for value, live in zip(column, alive) if live)
+                for field, column in self._counters.items()}
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes taken by the columns, without the side dicts of unusual urls and extra fields."""
+        columns = [self._ip, self._port, self._generations, *self._coded.values(), *self._counters.values(),
+                   *self._floats.values()]
+        return sum(column.itemsize * len(column) for column in columns) + len(self._alive)
+
+
+__all__ = ['ColumnarSlots', 'ProxyRow', 'FIELDS']
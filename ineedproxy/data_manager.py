@@ -1,13 +1,18 @@
-from random import choice
 from pathlib import Path
-from typing import Optional, List, Union
-
-from .file_ops import read_msgpack, write_msgpack
-from .utils import ProxyDict, NoProxyAvailable, URL, ProxyIndex
+from collections import OrderedDict
+from heapq import nlargest, heappush, heappop
+from typing import Optional, List, Union, Dict, Tuple, FrozenSet, Callable, Iterable, Iterator
+import time
+
+from .store import ProxyStore, ADD, REMOVE, UPDATE, CLEAR
+from .utils import ProxyDict, NoProxyAvailable, URL, ProxyIndex, ProxyKey, _proxy_key, bitmap_ids, bitmap_of
+from .slots import ProxySlots
+from .columnar import ColumnarSlots
+from .lease import ProxyLease
+from .selection import SelectionStrategy, get_strategy_factory, success_rate
+from .metrics import Metrics
 from .logger import logger
 
-from orjson import JSONDecodeError
-
 
 def _validate_protocol(protocols: Union[str, List[str], None]) -> Optional[List[str]]:
     if protocols is None:
@@ -20,8 +25,24 @@ def _validate_protocol(protocols: Union[str, List[str], None]) -> Optional[List[
     return protocols
 
 
-def _rm_duplicate_proxies(proxies: List[ProxyDict]) -> List[ProxyDict]:
-    return [proxy for i, proxy in enumerate(proxies) if proxy not in proxies[:i]]
+PreferenceKey = Tuple[Optional[FrozenSet[str]], ...]
+_NO_FILTER: PreferenceKey = (None,) * 6
+
+
+def _as_filter(values: Union[str, List[str], None]) -> Optional[FrozenSet[str]]:
+    if not values:
+        return None
+    return frozenset((values,) if isinstance(values, str) else values)
+
+
+def _matches(key: PreferenceKey, proxy: dict) -> bool:
+    protocol, country, anonymity, exclude_protocol, exclude_country, exclude_anonymity = key
+    return ((protocol is None or proxy["protocol"] in protocol)
+            and (country is None or proxy["country"] in country)
+            and (anonymity is None or proxy["anonymity"] in anonymity)
+            and not (exclude_protocol and proxy["protocol"] in exclude_protocol)
+            and not (exclude_country and proxy["country"] in exclude_country)
+            and not (exclude_anonymity and proxy["anonymity"] in exclude_anonymity))
 
 
 class DataManager:
@@ -29,89 +50,220 @@ class DataManager:
                  allowed_fails_in_row: int,
                  fails_without_check: int,
                  percent_failed_to_remove: float,
-                 min_proxies: int):
+                 min_proxies: int,
+                 flush_interval: Optional[float] = None,
+                 flush_threshold: int = 100,
+                 journal: bool = False,
+                 compact_ratio: float = 2.0,
+                 selection: Union[str, Callable[[], SelectionStrategy]] = "random",
+                 max_cached_filters: int = 64,
+                 latency_alpha: float = 0.3,
+                 breaker_cooldown: float = 60.0,
+                 breaker_max_trips: int = 3,
+                 metrics: Optional[Metrics] = None,
+                 columnar: bool = False):
         """
         Get add and remove proxies from a list with some extra features.
 
         :param msgpack: Highly recommended to use it.
         Path to a store file with proxy data. If set to None, it will not store data in a file.
-        :param allowed_fails_in_row: How many times a proxy can fail in a row before being removed.
-        :param fails_without_check: How many times a proxy can fail before being checked for percentage of fails to remove.
-        :param percent_failed_to_remove: Percentage of fails to remove a proxy.
-        Example: 0.5 means 50% of tries are fails, if higher than that it gets removed.
+        :param allowed_fails_in_row: How many times a proxy can fail in a row before its breaker trips.
+        :param fails_without_check: How many times a proxy can fail before being checked for percentage of fails.
+        :param percent_failed_to_remove: Percentage of fails that trips the breaker of a proxy.
+        Example: 0.5 means 50% of tries are fails, if higher than that it trips.
         :param min_proxies: When len(proxies) < min_proxies -> fetch more proxies
+        :param flush_interval: Seconds between background writes of the store file (write-behind).
+        None writes the file on every change. Call flush() or aclose() before exiting when using it.
+        :param flush_threshold: Number of changes that trigger a background write before flush_interval is over.
+        :param journal: Append every change as a small record to "<msgpack>.journal" instead of rewriting the whole file.
+        :param compact_ratio: Fold the journal into the msgpack file once it is this many times bigger.
+        :param selection: How to pick proxies: "random", "round_robin", "lru", "least_in_flight", "weighted"
+        (by success rate), "p2c" (the faster of two random ones), "fastest" (lowest expected latency)
+        or a factory returning a SelectionStrategy.
+        :param max_cached_filters: How many preference combinations keep their own selection structure.
+        :param latency_alpha: Weight of the newest sample in the moving averages of latency and errors.
+        :param breaker_cooldown: Seconds a proxy with a tripped breaker is paused. After that it gets one more
+        chance, a success puts it back to normal, a failure trips the breaker again with twice the cooldown.
+        :param breaker_max_trips: The proxy is removed when its breaker trips this often in a row.
+        1 removes proxies on their first bad streak.
+        :param metrics: Where to count selections, breaker trips and store writes. The pool is reported there too.
+        :param columnar: Keep the proxies in typed arrays (ColumnarSlots) instead of a dict each,
+        which takes about a tenth of the memory for big pools. Records are then dict-like ProxyRow views.
         """
         self.msgpack = msgpack
         self.allowed_fails_in_row = allowed_fails_in_row
         self.fails_without_check = fails_without_check
         self.percent_failed_to_remove = percent_failed_to_remove
         self.min_proxies = min_proxies
-
-        self.proxies = self._load_proxies()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics.add_collector(self._collect_metrics)
+
+        self.slots = ColumnarSlots() if columnar else ProxySlots()
+        self.store = ProxyStore(msgpack, snapshot=self.slots.snapshot,
+                                flush_interval=flush_interval, flush_threshold=flush_threshold,
+                                journal=journal, compact_ratio=compact_ratio, metrics=self.metrics)
+        self.keys: Dict[ProxyKey, int] = {}  # proxy key -> id, so every proxy is stored once
+        for proxy in self.store.load():
+            key = _proxy_key(URL(proxy["url"]))
+            if key in self.keys:
+                continue  # written by an older version that did not deduplicate, gone with the next snapshot
+            self.keys[key] = self.slots.add(proxy)
         logger.debug("Loaded %s proxies on init",
-                     len(self.proxies) if self.msgpack else "0 (Not storing data in a file!)")
+                     len(self.slots) if self.msgpack else "0 (Not storing data in a file!)")
 
-        self.last_proxy_index = None
+        self.last_proxy_id = None
+        self.in_flight: Dict[int, int] = {}  # proxy id -> number of unreleased leases
         self.index = ProxyIndex()
-        self.index.rebuild_index(self.proxies)
-
-    def _load_proxies(self) -> List[ProxyDict]:
-        if self.msgpack and self.msgpack.exists() and self.msgpack.stat().st_size > 0:
-            try:
-                return read_msgpack(self.msgpack)
-            except JSONDecodeError:
-                logger.warning("Failed to decode msgpack, returning empty list.")
-                return []
-        if self.msgpack:
-            self.msgpack.touch(exist_ok=True)
-        return []
-
-    def _write_data(self):
-        if self.msgpack:
-            write_msgpack(self.msgpack, self.proxies)
+        self.index.rebuild_index(self.slots.items())
+
+        self.max_cached_filters = max_cached_filters
+        self.latency_alpha = latency_alpha
+        self.breaker_cooldown = breaker_cooldown
+        self.breaker_max_trips = breaker_max_trips
+        self.open_breakers: Dict[int, dict] = {}  # id -> paused proxy
+        self._reopen_queue: List[Tuple[float, int, int]] = []  # (open_until, id, identity of the record)
+        self._strategy_factory = get_strategy_factory(selection)
+        self._pools: OrderedDict[PreferenceKey, SelectionStrategy] = OrderedDict()
+        for proxy_id, proxy in self.slots.items():
+            if proxy.get("open_until"):
+                self._open_breaker(proxy_id, proxy)
+        self._get_pool(_NO_FILTER)
+
+    @property
+    def proxies(self) -> List[dict]:
+        """All stored proxies in slot order. Builds a new list, use `slots` for lookups by id."""
+        return list(self.slots.values())
+
+    def flush(self) -> None:
+        """Writes all pending changes to the store file."""
+        self.store.flush()
+
+    def close(self) -> None:
+        """Stops background writing and writes all pending changes."""
+        self.store.close()
+
+    async def aclose(self) -> None:
+        """Stops background writing and writes all pending changes without blocking the event loop."""
+        await self.store.aclose()
 
     def force_rm_last_proxy(self):
-        if self.last_proxy_index is not None:
-            self.rm_proxy(self.last_proxy_index)
+        if self.last_proxy_id is not None and self.last_proxy_id in self.slots:
+            self.rm_proxy(self.last_proxy_id)
+
+    def feedback_proxy(self, success: bool, latency: Optional[float] = None):
+        """
+        Feedback for the proxy returned by the last get_proxy call.
+        Not safe with concurrent requests, use acquire() and report on the lease there.
+        """
+        if self.last_proxy_id is not None:
+            self._feedback(self.last_proxy_id, success, latency)
 
-    def feedback_proxy(self, success: bool):
-        if self.last_proxy_index is None or self.last_proxy_index >= len(self.proxies):
+    def _feedback(self, proxy_id: int, success: bool, latency: Optional[float] = None):
+        proxy = self.slots.get(proxy_id)
+        if proxy is None:
             return
 
-        proxy = self.proxies[self.last_proxy_index]
+        # Exponentially weighted moving averages of the response time of successes and of the error rate
+        alpha = self.latency_alpha
+        proxy["error_score"] = (1 - alpha) * (proxy.get("error_score") or 0.0) + alpha * (0.0 if success else 1.0)
+        if success and latency is not None:
+            previous = proxy.get("latency")
+            proxy["latency"] = latency if previous is None else (1 - alpha) * previous + alpha * latency
+
         if success:
             proxy["times_succeed"] = proxy.get("times_succeed", 0) + 1
             proxy["times_failed_in_row"] = 0
-        else:
-            proxy["times_failed"] = proxy.get("times_failed", 0) + 1
-            proxy["times_failed_in_row"] = proxy.get("times_failed_in_row", 0) + 1
-
-            total_attempts = proxy.get("times_failed", 0) + proxy.get("times_succeed", 0)
-            failed_ratio = proxy.get("times_failed", 0) / total_attempts if total_attempts > 0 else 0
-
-            should_remove = any([
-                proxy.get("times_failed_in_row", 0) > self.allowed_fails_in_row,
-                proxy.get("times_failed", 0) > self.fails_without_check and failed_ratio > self.percent_failed_to_remove
-            ])
-
-            if should_remove:
-                logger.debug(
-                    "Removing proxy %s due to %s",
-                    proxy['url'],
-                    'too many failures in a row' if proxy.get('times_failed_in_row',
-                                                              0) > self.allowed_fails_in_row else 'bad success-failure ratio'
-                )
-
-                self.rm_proxy(self.last_proxy_index)
-        self._write_data()
-
-    def add_proxy(self, proxies: List[ProxyDict], remove_duplicates: bool = False) -> None:
-        """Adds proxies, removes duplicates if requested, and writes them to a file."""
-        start_index = len(self.proxies)
+            proxy["breaker_trips"] = 0  # closes a half-open breaker
+            if self.open_breakers.pop(proxy_id, None) is not None:
+                # A health check reached the proxy while it was paused
+                proxy["open_until"] = None
+                self._pools_add(proxy_id, proxy)
+            self.store.record([UPDATE, proxy["url"], {"times_succeed": proxy["times_succeed"],
+                                                      "times_failed_in_row": 0,
+                                                      "breaker_trips": 0,
+                                                      "open_until": proxy.get("open_until"),
+                                                      "latency": proxy.get("latency"),
+                                                      "error_score": proxy["error_score"]}])
+            self._pools_feedback(proxy_id, proxy)
+            return
+
+        proxy["times_failed"] = proxy.get("times_failed", 0) + 1
+        proxy["times_failed_in_row"] = proxy.get("times_failed_in_row", 0) + 1
+
+        total_attempts = proxy.get("times_failed", 0) + proxy.get("times_succeed", 0)
+        failed_ratio = proxy.get("times_failed", 0) / total_attempts if total_attempts > 0 else 0
+
+        half_open = proxy.get("breaker_trips", 0) > 0
+        # Late failures of leases taken before the breaker opened don't count as a failed probe
+        should_trip = proxy_id not in self.open_breakers and (half_open or any([
+            proxy.get("times_failed_in_row", 0) > self.allowed_fails_in_row,
+            proxy.get("times_failed", 0) > self.fails_without_check and failed_ratio > self.percent_failed_to_remove
+        ]))
+
+        if should_trip:
+            reason = ('failed probe after cooldown' if half_open else
+                      'too many failures in a row' if proxy.get('times_failed_in_row', 0) > self.allowed_fails_in_row
+                      else 'bad success-failure ratio')
+            trips = proxy.get("breaker_trips", 0) + 1
+            self.metrics.breaker_trips.inc()
+            if trips >= self.breaker_max_trips:
+                logger.debug("Removing proxy %s due to %s", proxy['url'], reason)
+                self.metrics.proxies_removed.inc()
+                self.rm_proxy(proxy_id)
+                return
+
+            # Open the breaker: out of rotation for a cooldown that doubles with every trip in a row
+            proxy["breaker_trips"] = trips
+            proxy["open_until"] = time.time() + self.breaker_cooldown * 2 ** (trips - 1)
+            proxy["times_failed_in_row"] = 0
+            logger.debug("Pausing proxy %s for %.0fs due to %s",
+                         proxy['url'], proxy["open_until"] - time.time(), reason)
+            self._open_breaker(proxy_id, proxy)
+
+        self.store.record([UPDATE, proxy["url"], {"times_failed": proxy["times_failed"],
+                                                  "times_failed_in_row": proxy["times_failed_in_row"],
+                                                  "breaker_trips": proxy.get("breaker_trips", 0),
+                                                  "open_until": proxy.get("open_until"),
+                                                  "error_score": proxy["error_score"]}])
+        self._pools_feedback(proxy_id, proxy)
+
+    def _open_breaker(self, proxy_id: int, proxy: dict) -> None:
+        self.open_breakers[proxy_id] = proxy
+        heappush(self._reopen_queue, (proxy["open_until"], proxy_id, id(proxy)))
+        self._pools_remove(proxy_id)
+
+    def _reopen_due(self) -> None:
+        """Puts proxies whose breaker cooldown ran out back into rotation, half-open until their next feedback."""
+        now = time.time()
+        while self._reopen_queue and self._reopen_queue[0][0] <= now:
+            open_until, proxy_id, identity = heappop(self._reopen_queue)
+            proxy = self.open_breakers.get(proxy_id)
+            if proxy is None or id(proxy) != identity or proxy.get("open_until") != open_until:
+                continue  # removed or tripped again in the meantime
+            del self.open_breakers[proxy_id]
+            proxy["open_until"] = None
+            self._pools_add(proxy_id, proxy)
+
+    def add_proxy(self, proxies: List[ProxyDict], remove_duplicates: bool = True) -> int:
+        """
+        Adds proxies and writes them to a file.
+        A proxy that is already stored, or comes twice, is not added again. Its stored record gets
+        the new country, anonymity and test results instead, while its counters are kept.
+
+        :param remove_duplicates: Kept for compatibility, duplicates are always skipped.
+        :return: Number of proxies actually added, without the duplicates and the ones already stored.
+        """
         new_proxies = []
+        updated = 0
 
         for proxy in proxies:
             url = URL(proxy["url"])
+            key = _proxy_key(url)
+            existing_id = self.keys.get(key)
+            if existing_id is not None:
+                updated += self._update_seen(existing_id, proxy)
+                continue
+
             new_proxy = {
                 "url": str(url),  # Store the string representation of the URL
                 "protocol": url.protocol,
@@ -119,105 +271,238 @@ class DataManager:
                 "anonymity": proxy.get("anonymity", "unknown"),
                 "times_failed": 0,
                 "times_succeed": 0,
-                "times_failed_in_row": 0
+                "times_failed_in_row": 0,
+                "last_checked": proxy.get("last_checked"),  # unix time of the last test, None if never tested
+                "last_ok": proxy.get("last_ok"),  # unix time of the last passed test
+                "latency": proxy.get("latency"),  # moving average of response times in seconds, None if unknown
+                "error_score": 0.0,  # moving average of failures, 0 means no recent failures, 1 only failures
+                "breaker_trips": 0,  # times the breaker tripped in a row, > 0 while paused or half-open
+                "open_until": None  # unix time until which the proxy is paused
             }
+            proxy_id = self.slots.add(new_proxy)
+            self.keys[key] = proxy_id
+            stored = self.slots[proxy_id]  # the record itself, or its view with columnar storage
+            self.index.add_proxy(proxy_id, stored)
+            self._pools_add(proxy_id, stored)
             new_proxies.append(new_proxy)
 
-        if remove_duplicates:
-            new_proxies = _rm_duplicate_proxies(new_proxies)
-
-        logger.debug("Adding %d proxies. Removed %d duplicates.", len(new_proxies), len(proxies) - len(new_proxies))
-        self.proxies.extend(new_proxies)
+        logger.debug("Adding %d proxies. Skipped %d duplicates, %d of them with new data.",
+                     len(new_proxies), len(proxies) - len(new_proxies), updated)
+        self.metrics.proxies_added.inc(amount=len(new_proxies))
+        self.store.record(*([ADD, proxy] for proxy in new_proxies))
+        return len(new_proxies)
+
+    def _update_seen(self, proxy_id: int, seen: ProxyDict) -> bool:
+        """Merges what a source or test says about an already stored proxy into its record."""
+        proxy = self.slots[proxy_id]
+        changes = {}
+        for field in ("country", "anonymity"):
+            value = seen.get(field)
+            if value and value != "unknown" and value != proxy.get(field):
+                changes[field] = value
+        for field in ("last_checked", "last_ok"):
+            value = seen.get(field)
+            if value is not None and value > (proxy.get(field) or 0):
+                changes[field] = value
+        latency = seen.get("latency")
+        if latency is not None:
+            previous = proxy.get("latency")
+            alpha = self.latency_alpha
+            changes["latency"] = latency if previous is None else (1 - alpha) * previous + alpha * latency
+        if not changes:
+            return False
+
+        regroup = "country" in changes or "anonymity" in changes
+        if regroup:
+            self.index.remove_proxy(proxy_id, proxy)
+            self._pools_remove(proxy_id)
+        proxy.update(changes)
+        if regroup:
+            self.index.add_proxy(proxy_id, proxy)
+            if proxy_id not in self.open_breakers:
+                self._pools_add(proxy_id, proxy)
+        else:
+            self._pools_feedback(proxy_id, proxy)
+        self.store.record([UPDATE, proxy["url"], changes])
+        return True
+
+    def rm_proxy(self, proxy_id: int):
+        """Removes a proxy by its id. The ids of all other proxies stay valid."""
+        if proxy_id not in self.slots:
+            logger.error("Attempt to remove proxy with invalid id: %d", proxy_id)
+            raise IndexError("Proxy does not exist")
 
-        # Update index for new proxies
-        for i, proxy in enumerate(new_proxies, start=start_index):
-            self.index.add_proxy(i, proxy)
+        proxy = self.slots.remove(proxy_id)
+        self.keys.pop(_proxy_key(URL(proxy["url"])), None)
+        self.index.remove_proxy(proxy_id, proxy)
+        self._pools_remove(proxy_id)
+        self.open_breakers.pop(proxy_id, None)
 
-        self._write_data()
+        self.in_flight.pop(proxy_id, None)
+        if self.last_proxy_id == proxy_id:
+            self.last_proxy_id = None
+        self.store.record([REMOVE, proxy["url"]])
 
-    def rm_proxy(self, index: int):
-        if 0 <= index < len(self.proxies):
+    def rm_all_proxies(self):
+        self.slots.clear()
+        self.keys.clear()
+        self.index.clear()
+        self._pools.clear()
+        self._get_pool(_NO_FILTER)
+        self.open_breakers.clear()
+        self._reopen_queue.clear()
+        self.in_flight.clear()
+        self.last_proxy_id = None
+        self.store.record([CLEAR])
+
+    def get_proxy(self, **preferences) -> str:
+        """
+        Returns the url of a proxy matching the preferences.
+        Feedback for it goes through feedback_proxy, which only works for one request at a time.
+        """
+        return self.slots[self._select_id(**preferences)]["url"]
 
-            # Remove from index first
-            proxy = self.proxies[index]
-            self.index.remove_proxy(index, proxy)
+    def acquire(self, **preferences) -> ProxyLease:
+        """
+        Leases a proxy matching the preferences.
+        The lease keeps the id of the proxy, so any number of leases can be out at once
+        and their feedback still lands on the right proxy.
+        """
+        proxy_id = self._select_id(**preferences)
+        self._set_in_flight(proxy_id, self.in_flight.get(proxy_id, 0) + 1)
+        lease = ProxyLease(self, proxy_id, self.slots[proxy_id])
+        logger.debug("Leased proxy: %s", lease.url)
+        return lease
+
+    def release(self, lease: ProxyLease, success: Optional[bool]) -> None:
+        """Ends a lease. Called by the lease itself, success is None when released without feedback."""
+        if self.slots.get(lease.proxy_id) is not lease.proxy:
+            return  # proxy got removed in the meantime, its slot may already belong to another one
+
+        self._set_in_flight(lease.proxy_id, max(self.in_flight.get(lease.proxy_id, 0) - 1, 0))
+        if success is not None:
+            self._feedback(lease.proxy_id, success, lease.latency)
+
+    def _set_in_flight(self, proxy_id: int, in_flight: int) -> None:
+        if in_flight:
+            self.in_flight[proxy_id] = in_flight
+        else:
+            self.in_flight.pop(proxy_id, None)
+        for pool in self._pools.values():
+            pool.on_in_flight(proxy_id, in_flight)
 
-            # Remove from a proxy list
-            self.proxies.pop(index)
+    def health_check_candidates(self, limit: int, min_age: float,
+                                protocols: Iterable[str] = ("http", "https")) -> List[Tuple[int, dict]]:
+        """
+        Returns the (id, proxy) pairs most in need of a new test.
+        Proxies that were never tested come first, then the longest untested ones,
+        where a bad success ratio makes a proxy up to twice as urgent. Leased proxies are skipped.
 
-            if self.last_proxy_index is not None and index < self.last_proxy_index:
-                self.last_proxy_index -= 1
-            self._write_data()
-        else:
-            logger.error("Attempt to remove proxy at invalid index: %d", index)
-            raise IndexError("Proxy does not exist")
+        :param limit: Maximum number of proxies to return.
+        :param min_age: Only proxies not tested within this many seconds.
+        :param protocols: Only proxies with these protocols.
+        """
+        now = time.time()
+        protocols = set(protocols)
 
-    def rm_all_proxies(self):
-        self.proxies.clear()
-        self.index.clear()
-        self._write_data()
+        def age(proxy: dict) -> float:
+            return now - (proxy.get("last_checked") or 0)
 
-    def get_proxy(self,
-                  protocol: Union[list[str], str, None] = None,
-                  country: Union[list[str], str, None] = None,
-                  anonymity: Union[list[str], str, None] = None,
-                  exclude_protocol: Union[list[str], str, None] = None,
-                  exclude_country: Union[list[str], str, None] = None,
-                  exclude_anonymity: Union[list[str], str, None] = None) -> URL:
+        due = ((proxy_id, proxy) for proxy_id, proxy in self.slots.items()
+               if proxy["protocol"] in protocols and proxy_id not in self.in_flight and age(proxy) >= min_age)
+        return nlargest(limit, due, key=lambda item: age(item[1]) * (2 - success_rate(item[1])))
 
-        if self.min_proxies and len(self.proxies) < self.min_proxies:
+    def record_check(self, proxy_id: int, proxy: dict, ok: bool, latency: Optional[float] = None) -> None:
+        """
+        Stores the outcome of a health check and counts it as feedback, so a dead proxy gets removed.
+        Ignored if the proxy was removed while it was tested.
+        """
+        if self.slots.get(proxy_id) is not proxy:
+            return
+        now = time.time()
+        proxy["last_checked"] = now
+        if ok:
+            proxy["last_ok"] = now
+        self.store.record([UPDATE, proxy["url"], {"last_checked": now, "last_ok": proxy.get("last_ok")}])
+        self._feedback(proxy_id, ok, latency)
+
+    def _select_id(self,
+                   protocol: Union[list[str], str, None] = None,
+                   country: Union[list[str], str, None] = None,
+                   anonymity: Union[list[str], str, None] = None,
+                   exclude_protocol: Union[list[str], str, None] = None,
+                   exclude_country: Union[list[str], str, None] = None,
+                   exclude_anonymity: Union[list[str], str, None] = None) -> int:
+
+        self._reopen_due()
+        self.metrics.get_proxy_calls.inc()
+        if self.min_proxies and self.available() < self.min_proxies:
+            self.metrics.get_proxy_misses.inc()
             raise NoProxyAvailable("Not enough proxies available.")
 
-        valid_indices = set(range(len(self.proxies)))
-
-        # Include filters
-        if protocol:
-            protocol = [protocol] if isinstance(protocol, str) else protocol
-            protocol_indices = set().union(*(self.index.protocol_index[p] for p in protocol))
-            valid_indices &= protocol_indices
-
-        if country:
-            country = [country] if isinstance(country, str) else country
-            country_indices = set().union(*(self.index.country_index[c] for c in country))
-            valid_indices &= country_indices
-
-        if anonymity:
-            anonymity = [anonymity] if isinstance(anonymity, str) else anonymity
-            anonymity_indices = set().union(*(self.index.anonymity_index[a] for a in anonymity))
-            valid_indices &= anonymity_indices
-
-        # Exclude filters
-        if exclude_protocol:
-            exclude_protocol = [exclude_protocol] if isinstance(exclude_protocol, str) else exclude_protocol
-            exclude_indices = set().union(*(self.index.protocol_index[p] for p in exclude_protocol))
-            valid_indices -= exclude_indices
-
-        if exclude_country:
-            exclude_country = [exclude_country] if isinstance(exclude_country, str) else exclude_country
-            exclude_indices = set().union(*(self.index.country_index[c] for c in exclude_country))
-            valid_indices -= exclude_indices
-
-        if exclude_anonymity:
-            exclude_anonymity = [exclude_anonymity] if isinstance(exclude_anonymity, str) else exclude_anonymity
-            exclude_indices = set().union(*(self.index.anonymity_index[a] for a in exclude_anonymity))
-            valid_indices -= exclude_indices
-
-        if not valid_indices:
+        key = (_as_filter(protocol), _as_filter(country), _as_filter(anonymity),
+               _as_filter(exclude_protocol), _as_filter(exclude_country), _as_filter(exclude_anonymity))
+        pool = self._get_pool(key)
+        if not len(pool):
+            self.metrics.get_proxy_misses.inc()
             raise NoProxyAvailable("No proxy found with the given parameters.")
 
         # Avoid consecutive same proxy unless it's the only option
-        if (
-                self.last_proxy_index is not None
-                and self.last_proxy_index in valid_indices
-                and len(valid_indices) > 1
-        ):
-            valid_indices.remove(self.last_proxy_index)
-
-        selected_index = choice(list(valid_indices))
-        self.last_proxy_index = selected_index
-        chosen_proxy = self.proxies[selected_index]["url"]
-        logger.debug("Chosen proxy: %s", chosen_proxy)
-        return chosen_proxy
+        selected_id = pool.pick(avoid=self.last_proxy_id)
+        self.last_proxy_id = selected_id
+        logger.debug("Chosen proxy: %s", self.slots[selected_id]["url"])
+        return selected_id
+
+    def _get_pool(self, key: PreferenceKey) -> SelectionStrategy:
+        """Returns the strategy for a preference combination, building it from the index on first use."""
+        pool = self._pools.get(key)
+        if pool is not None:
+            self._pools.move_to_end(key)
+            return pool
+
+        pool = self._strategy_factory()
+        for proxy_id in self._filter_ids(key):
+            pool.add(proxy_id, self.slots[proxy_id])
+        self._pools[key] = pool
+        if len(self._pools) > self.max_cached_filters:
+            oldest = next(k for k in self._pools if k != _NO_FILTER)
+            del self._pools[oldest]
+        return pool
+
+    def _filter_ids(self, key: PreferenceKey) -> Iterator[int]:
+        candidates = self.index.matching(*key)
+        if self.open_breakers:
+            candidates &= ~bitmap_of(self.open_breakers)
+        return bitmap_ids(candidates)
+
+    def available(self) -> int:
+        """Number of proxies in rotation, which excludes the ones paused by their breaker."""
+        return len(self.slots) - len(self.open_breakers)
+
+    def _collect_metrics(self) -> None:
+        """Fills in the pool gauges from the index, so keeping them costs nothing between reads."""
+        metrics = self.metrics
+        metrics.pool_size.set(value=len(self.slots))
+        metrics.pool_available.set(value=self.available())
+        metrics.pool_open_breakers.set(value=len(self.open_breakers))
+        metrics.pool_in_flight.set(value=sum(self.in_flight.values()))
+        for gauge, index in ((metrics.pool_by_protocol, self.index.protocol_index),
+                             (metrics.pool_by_country, self.index.country_index),
+                             (metrics.pool_by_anonymity, self.index.anonymity_index)):
+            gauge.replace({(str(value),): len(ids) for value, ids in index.items() if ids})
+
+    def _pools_add(self, proxy_id: int, proxy: dict) -> None:
+        for key, pool in self._pools.items():
+            if _matches(key, proxy):
+                pool.add(proxy_id, proxy)
+
+    def _pools_remove(self, proxy_id: int) -> None:
+        for pool in self._pools.values():
+            pool.remove(proxy_id)
+
+    def _pools_feedback(self, proxy_id: int, proxy: dict) -> None:
+        for pool in self._pools.values():
+            pool.on_feedback(proxy_id, proxy)
 
     def __len__(self):
-        return len(self.proxies)
+        return len(self.slots)
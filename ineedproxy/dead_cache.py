@@ -0,0 +1,202 @@
+from hashlib import blake2b
+from math import ceil, log
+from pathlib import Path
+from typing import Dict, List, Iterable, Optional, Tuple, Union
+import asyncio
+import time
+
+import msgpack
+
+from .file_ops import read_msgpack, write_msgpack
+from .utils import ProxyDict, ProxyKey, URL, _proxy_key
+from .logger import logger
+
+
+def _key(proxy: Union[ProxyDict, URL, str]) -> ProxyKey:
+    if isinstance(proxy, dict):
+        proxy = proxy["url"]
+    return _proxy_key(URL(proxy))
+
+
+class DeadProxyCache:
+    def __init__(self, file: Optional[Path] = None, ttl: float = 3600, max_ttl: float = 24 * 3600,
+                 backoff: float = 2.0):
+        """
+        Remembers proxies that failed their test, so the next fetch does not wait for the same timeouts again.
+
+        A proxy that failed is skipped for ttl seconds. Every further failure multiplies that by backoff,
+        up to max_ttl. Passing a test forgets it.
+
+        :param file: msgpack file to keep the entries between runs. None keeps them in memory only.
+        :param ttl: Seconds a proxy is skipped after its first failure.
+        :param max_ttl: Upper limit for the backed off time. Also how long an expired entry remembers its failures.
+        :param backoff: Factor the skip time grows with every failure in a row.
+        """
+        self.file = Path(file) if file is not None else None
+        self.ttl = ttl
+        self.max_ttl = max_ttl
+        self.backoff = backoff
+        self._entries: Dict[ProxyKey, Tuple[float, int]] = {}  # key -> (unix time it expires, failures in a row)
+
+    def add(self, proxy: Union[ProxyDict, URL, str]) -> None:
+        """Records a failed test."""
+        key = _key(proxy)
+        _, failures = self._entries.get(key, (0, 0))
+        failures += 1
+        self._entries[key] = (time.time() + min(self.ttl * self.backoff ** (failures - 1), self.max_ttl), failures)
+
+    def discard(self, proxy: Union[ProxyDict, URL, str]) -> None:
+        """Forgets a proxy after it passed a test."""
+        self._entries.pop(_key(proxy), None)
+
+    def filter(self, proxies: Iterable[ProxyDict]) -> List[ProxyDict]:
+        """The proxies that are not known to be dead."""
+        now = time.time()
+        entries = self._entries
+        return [proxy for proxy in proxies if entries.get(_key(proxy), (0,))[0] <= now]
+
+    def prune(self) -> None:
+        """Drops entries that expired longer than max_ttl ago."""
+        limit = time.time() - self.max_ttl
+        self._entries = {key: entry for key, entry in self._entries.items() if entry[0] > limit}
+
+    def load(self) -> None:
+        if self.file is None or not self.file.exists() or self.file.stat().st_size == 0:
+            return
+        try:
+            self._load(read_msgpack(self.file))
+        except (msgpack.UnpackException, ValueError, KeyError, TypeError) as e:
+            logger.warning("Ignoring broken dead proxy cache %s: %s", self.file, e)
+
+    def save(self) -> None:
+        """Writes the entries to the file."""
+        if self.file is None:
+            return
+        self.prune()
+        self._write(self._dump())
+
+    async def asave(self) -> None:
+        """Like save, but writes in an executor instead of blocking the event loop."""
+        if self.file is None:
+            return
+        self.prune()
+        await asyncio.get_running_loop().run_in_executor(None, self._write, self._dump())
+
+    def _write(self, data: dict) -> None:
+        try:
+            write_msgpack(self.file, data)
+        except OSError as e:
+            logger.warning("Failed to write dead proxy cache %s: %s", self.file, e)
+
+    def _load(self, data: dict) -> None:
+        if data.get("kind") != "exact":
+            logger.debug("Dead proxy cache %s was written by a Bloom filter cache, starting empty", self.file)
+            return
+        self._entries = {tuple(key) if isinstance(key, list) else key: (expires, failures)
+                         for key, expires, failures in data["entries"]}
+        self.prune()
+
+    def _dump(self) -> dict:
+        return {"kind": "exact", "entries": [[key, expires, failures]
+                                             for key, (expires, failures) in self._entries.items()]}
+
+    def __contains__(self, proxy: Union[ProxyDict, URL, str]) -> bool:
+        return self._entries.get(_key(proxy), (0,))[0] > time.time()
+
+    def __len__(self) -> int:
+        now = time.time()
+        return sum(1 for expires, _ in self._entries.values() if expires > now)
+
+
+class _BloomFilter:
+    __slots__ = ("bits", "size", "hashes", "created")
+
+    def __init__(self, capacity: int, error_rate: float, created: float):
+        self.size = max(ceil(-capacity * log(error_rate) / log(2) ** 2), 8)
+        self.hashes = max(round(self.size / capacity * log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.created = created
+
+    def _positions(self, key: ProxyKey) -> Iterable[int]:
+        digest = blake2b(repr(key).encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, key: ProxyKey) -> None:
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: ProxyKey) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class BloomDeadProxyCache(DeadProxyCache):
+    def __init__(self, file: Optional[Path] = None, ttl: float = 3600, capacity: int = 1_000_000,
+                 error_rate: float = 0.01):
+        """
+        A DeadProxyCache for huge lists that needs about 1.2 bytes per proxy at a 1% error rate,
+        no matter how long the urls are.
+
+        Two Bloom filters take turns, a new one is started every ttl seconds and the one before the last is dropped,
+        so a proxy is skipped for ttl to 2 * ttl seconds. In exchange there is no backoff,
+        discard() can't forget a single proxy and about error_rate of the working proxies get skipped too.
+
+        :param file: msgpack file to keep the filters between runs. None keeps them in memory only.
+        :param ttl: Seconds a filter takes new entries before it is rotated out.
+        :param capacity: Failed proxies per ttl the filter is sized for. More raise the error rate.
+        :param error_rate: Share of working proxies wrongly skipped at capacity.
+        """
+        super().__init__(file, ttl=ttl, max_ttl=2 * ttl, backoff=1.0)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        now = time.time()
+        self._filters: List[_BloomFilter] = [_BloomFilter(capacity, error_rate, now)]
+
+    def _rotate(self) -> List[_BloomFilter]:
+        now = time.time()
+        if now - self._filters[-1].created >= self.ttl:
+            self._filters = [filter_ for filter_ in self._filters[-1:] if now - filter_.created < 2 * self.ttl]
+            self._filters.append(_BloomFilter(self.capacity, self.error_rate, now))
+        return self._filters
+
+    def add(self, proxy: Union[ProxyDict, URL, str]) -> None:
+        self._rotate()[-1].add(_key(proxy))
+
+    def discard(self, proxy: Union[ProxyDict, URL, str]) -> None:
+        """Bloom filters can't remove entries, the proxy stays skipped until its filter is rotated out."""
+
+    def filter(self, proxies: Iterable[ProxyDict]) -> List[ProxyDict]:
+        filters = self._rotate()
+        return [proxy for proxy in proxies if not any(_key(proxy) in filter_ for filter_ in filters)]
+
+    def prune(self) -> None:
+        self._rotate()
+
+    def _load(self, data: dict) -> None:
+        if data.get("kind") != "bloom" or data["capacity"] != self.capacity or data["error_rate"] != self.error_rate:
+            logger.debug("Dead proxy cache %s was written with other settings, starting empty", self.file)
+            return
+        filters = []
+        for created, bits in data["filters"]:
+            filter_ = _BloomFilter(self.capacity, self.error_rate, created)
+            if len(bits) == len(filter_.bits):
+                filter_.bits[:] = bits
+                filters.append(filter_)
+        if filters:
+            self._filters = filters
+            self._rotate()
+
+    def _dump(self) -> dict:
+        return {"kind": "bloom", "capacity": self.capacity, "error_rate": self.error_rate,
+                "filters": [[filter_.created, bytes(filter_.bits)] for filter_ in self._filters]}
+
+    def __contains__(self, proxy: Union[ProxyDict, URL, str]) -> bool:
+        key = _key(proxy)
+        return any(key in filter_ for filter_ in self._rotate())
+
+    def __len__(self) -> int:
+        """Bloom filters don't know how many entries they hold, always 0."""
+        return 0
+
+
+__all__ = ['DeadProxyCache', 'BloomDeadProxyCache']
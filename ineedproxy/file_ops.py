@@ -1,5 +1,7 @@
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
+import os
+import tempfile
 import msgpack
 
 
@@ -25,19 +27,87 @@ def read_msgpack(file: Path) -> List[Dict[str, Any]]:
         raise msgpack.UnpackException(f"Failed to unpack msgpack file {file}: {e}")
 
 
-def write_msgpack(file: Path, data: List[Dict[str, Any]]) -> None:
+def write_msgpack(file: Path, data: List[Dict[str, Any]]) -> int:
     """Writes data to a msgpack file.
 
+    The data is written to a temporary file in the same directory first and then renamed over
+    the target, so a crash mid-write never leaves a half-written file behind.
+
     Args:
         file: Path where the msgpack file will be saved.
         data: Data to be packed and written (list of dictionaries).
 
+    Returns:
+        Number of bytes written.
+
     Raises:
         PermissionError: If the file cannot be written.
     """
+    tmp_name = None
     try:
         file.parent.mkdir(parents=True, exist_ok=True)  # Ensure directory exists
-        with open(file, "wb") as f:
-            f.write(msgpack.packb(data, use_bin_type=True))
+        packed = msgpack.packb(data, use_bin_type=True)
+        with tempfile.NamedTemporaryFile("wb", dir=file.parent, prefix=f".{file.name}.", suffix=".tmp",
+                                         delete=False) as f:
+            tmp_name = f.name
+            f.write(packed)
+        os.replace(tmp_name, file)
+        return len(packed)
     except PermissionError:
         raise PermissionError(f"No permission to write to {file}")
+    finally:
+        if tmp_name is not None and os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+
+
+def append_msgpack_records(file: Path, records: List[Any]) -> int:
+    """Appends records to a msgpack journal file, one packed object per record.
+
+    Args:
+        file: Path to the journal file. Created if missing.
+        records: Records to pack and append.
+
+    Returns:
+        Number of bytes appended.
+
+    Raises:
+        PermissionError: If the file cannot be written.
+    """
+    packer = msgpack.Packer(use_bin_type=True)
+    packed = b"".join(packer.pack(record) for record in records)
+    try:
+        with open(file, "ab") as f:
+            f.write(packed)
+        return len(packed)
+    except PermissionError:
+        raise PermissionError(f"No permission to write to {file}")
+
+
+def read_msgpack_records(file: Path) -> Tuple[List[Any], int]:
+    """Reads all complete records from a msgpack journal file.
+
+    A truncated or corrupted tail, like the one a crash during an append leaves behind, ends the read
+    instead of raising.
+
+    Args:
+        file: Path to the journal file.
+
+    Returns:
+        The records and the number of bytes they span. Everything after that offset is garbage.
+    """
+    records = []
+    valid_bytes = 0
+    try:
+        with open(file, "rb") as f:
+            unpacker = msgpack.Unpacker(f, raw=False)
+            while True:
+                try:
+                    records.append(unpacker.unpack())
+                except msgpack.OutOfData:
+                    break
+                except ValueError:  # corrupted record, msgpack's FormatError and friends
+                    break
+                valid_bytes = unpacker.tell()
+    except FileNotFoundError:
+        pass
+    return records, valid_bytes
@@ -1,12 +1,20 @@
-from typing import List, Optional, Dict
+from typing import Any, List, Optional, Dict, Tuple, Mapping, Callable, Awaitable
+from concurrent.futures import Executor
+from contextvars import ContextVar
 import asyncio
 
-from .utils import ProxyDict, convert_to_proxy_dict_format
+from .utils import ProxyDict
+from .parsing import parse_proxy_list_async
+from .source_cache import SourceCache, current_source_cache
 from .logger import logger
 
 import orjson
 import aiohttp
 
+# Session of the Manager that is currently fetching, used by get_request calls that bring no session of their own.
+# This lets plain fetching methods like fetch_json_proxy_list reuse the Manager's connection pool.
+current_session: ContextVar[Optional[aiohttp.ClientSession]] = ContextVar("current_session", default=None)
+
 
 async def get_request(
         url: str,
@@ -15,6 +23,7 @@ async def get_request(
         proxy: Optional[str] = None,
         session: Optional[aiohttp.ClientSession] = None,
         headers: Optional[Dict[str, str]] = None,
+        trace_request_ctx: Optional[Any] = None,
 ) -> str:
     """
     Performs a GET request with retry logic and proper error handling.
@@ -24,12 +33,46 @@ async def get_request(
         retries: Number of retry attempts
         timeout: Request timeout in seconds
         proxy: Optional proxy URL
-        session: Optional aiohttp session to reuse
+        session: Optional aiohttp session to reuse. Defaults to the session of the fetching Manager, if any
         headers: Optional custom headers
+        trace_request_ctx: Passed to the trace configs of the session, see aiohttp.TraceConfig
 
     Returns:
         Response text content
 
+    Raises:
+        Exception: If all retry attempts fail
+    """
+    _, text, _ = await get_response(url, retries=retries, timeout=timeout, proxy=proxy, session=session,
+                                    headers=headers, trace_request_ctx=trace_request_ctx)
+    return text
+
+
+async def get_response(
+        url: str,
+        retries: int = 1,
+        timeout: int = 10,
+        proxy: Optional[str] = None,
+        session: Optional[aiohttp.ClientSession] = None,
+        headers: Optional[Dict[str, str]] = None,
+        trace_request_ctx: Optional[Any] = None,
+) -> Tuple[int, str, Mapping[str, str]]:
+    """
+    Like get_request, but also returns the status and the headers of the response,
+    for example to tell a 304 Not Modified apart.
+
+    Args:
+        url: The URL to request
+        retries: Number of retry attempts
+        timeout: Request timeout in seconds
+        proxy: Optional proxy URL
+        session: Optional aiohttp session to reuse. Defaults to the session of the fetching Manager, if any
+        headers: Optional custom headers
+        trace_request_ctx: Passed to the trace configs of the session, see aiohttp.TraceConfig
+
+    Returns:
+        Status code, response text content and response headers
+
     Raises:
         Exception: If all retry attempts fail
     """
@@ -52,6 +95,8 @@ async def get_request(
 
     try:
         if session is None:
+            session = current_session.get()
+        if session is None or session.closed:
             session = aiohttp.ClientSession()
             created_session = True
 
@@ -61,14 +106,15 @@ async def get_request(
                         url,
                         headers=default_headers,
                         proxy=proxy,
-                        timeout=aiohttp.ClientTimeout(total=timeout)
+                        timeout=aiohttp.ClientTimeout(total=timeout),
+                        trace_request_ctx=trace_request_ctx
                 ) as response:
                     if response.status >= 400:
                         error_msg = f"HTTP error: {response.status}"
                         logger.warning(f"{error_msg} (Attempt {attempt + 1}/{retries})")
                         response.raise_for_status()  # This will raise an exception for 4xx/5xx status codes
 
-                    return await response.text()
+                    return response.status, await response.text(), response.headers
 
             except (
                     aiohttp.ClientError,
@@ -95,12 +141,46 @@ async def get_request(
             await session.close()
 
 
-async def fetch_json_proxy_list(url: str) -> List[ProxyDict]:
+async def _fetch_list(url: str, parse: Callable[[str], Awaitable[List[ProxyDict]]],
+                      cache: Optional[SourceCache], min_refresh_interval: Optional[float]) -> List[ProxyDict]:
+    """Downloads and parses a proxy list, or reuses the one in the source cache while the source did not change."""
+    cache = cache if cache is not None else current_source_cache.get()
+    if cache is None:
+        return await parse(await get_request(url, retries=3, timeout=15))
+
+    entry = await cache.get(url)
+    if entry is not None and cache.is_fresh(entry, min_refresh_interval):
+        logger.debug(f"Reusing the list of {url}, fetched less than the minimum refresh interval ago")
+        return [ProxyDict(**proxy) for proxy in entry.proxies]
+
+    headers = {}
+    if entry is not None:
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+    status, text, response_headers = await get_response(url, retries=3, timeout=15, headers=headers)
+    if status == 304 and entry is not None:
+        logger.debug(f"List of {url} not modified, reusing {len(entry.proxies)} proxies")
+        cache.touch(entry)
+        return [ProxyDict(**proxy) for proxy in entry.proxies]
+
+    proxies = await parse(text)
+    await cache.put(url, proxies, response_headers.get("ETag"), response_headers.get("Last-Modified"))
+    return [ProxyDict(**proxy) for proxy in proxies]
+
+
+async def fetch_json_proxy_list(url: str, cache: Optional[SourceCache] = None,
+                                min_refresh_interval: Optional[float] = None) -> List[ProxyDict]:
     """
     Fetches a list of proxies from a website and parses the JSON response.
+    Big responses are parsed in a worker thread, see parse_proxy_list_async.
+    With a source cache, unchanged lists are neither downloaded nor parsed again, see SourceCache.
 
     Args:
         url: URL to fetch a proxy list from
+        cache: Source cache to use. Defaults to the one of the fetching Manager, if any
+        min_refresh_interval: Seconds not to ask this source again, defaults to the one of the cache
 
     Returns:
         List of proxy dictionaries
@@ -108,18 +188,51 @@ async def fetch_json_proxy_list(url: str) -> List[ProxyDict]:
     Raises:
         Exception: If the request fails or JSON parsing fails
     """
-    try:
-        response = await get_request(url, retries=3, timeout=15)
-
+    async def parse(response: str) -> List[ProxyDict]:
         try:
-            proxies = orjson.loads(response)
-            proxy_list = convert_to_proxy_dict_format(proxies)
-            return proxy_list
+            if not response.lstrip().startswith(("[", "{")):
+                raise orjson.JSONDecodeError("Expected a JSON array or object", response[:20], 0)
+            return await parse_proxy_list_async(response, source=url)
 
         except orjson.JSONDecodeError as e:
             logger.error(f"Failed to parse JSON response: {str(e)}")
             raise Exception(f"Invalid JSON response from {url}: {str(e)}")
 
+    try:
+        return await _fetch_list(url, parse, cache, min_refresh_interval)
+
+    except Exception as e:
+        logger.error(f"Failed to fetch proxy list from {url}: {str(e)}")
+        raise
+
+
+async def fetch_proxy_list(url: str, default_protocol: str = "http",
+                           executor: Optional[Executor] = None,
+                           cache: Optional[SourceCache] = None,
+                           min_refresh_interval: Optional[float] = None) -> List[ProxyDict]:
+    """
+    Fetches a list of proxies in any format parse_proxy_list understands:
+    JSON, or plain text with one "ip:port" or "protocol://ip:port" per line.
+
+    Args:
+        url: URL to fetch a proxy list from
+        default_protocol: Protocol of plain text lines without one
+        executor: Executor to parse big responses in, defaults to a worker thread
+        cache: Source cache to use. Defaults to the one of the fetching Manager, if any
+        min_refresh_interval: Seconds not to ask this source again, defaults to the one of the cache
+
+    Returns:
+        List of proxy dictionaries
+
+    Raises:
+        Exception: If the request fails or the response can't be parsed
+    """
+    async def parse(response: str) -> List[ProxyDict]:
+        return await parse_proxy_list_async(response, source=url, default_protocol=default_protocol,
+                                            executor=executor)
+
+    try:
+        return await _fetch_list(url, parse, cache, min_refresh_interval)
     except Exception as e:
         logger.error(f"Failed to fetch proxy list from {url}: {str(e)}")
         raise
@@ -0,0 +1,71 @@
+from typing import Optional, TYPE_CHECKING
+import asyncio
+import time
+
+if TYPE_CHECKING:
+    from .data_manager import DataManager
+
+
+class ProxyLease:
+    """
+    A proxy handed out for one piece of work.
+
+    Holds the stable id of the proxy, so feedback always lands on the proxy that actually did the work,
+    no matter how many other leases were taken in between.
+    Report the outcome exactly once with success() or failure(). Used as an async context manager,
+    a lease that was not reported counts as a success when the block finishes
+    and as a failure when it raises. Cancellation only releases it without feedback.
+    """
+
+    __slots__ = ("proxy_id", "url", "proxy", "started", "latency", "released", "_data_manager")
+
+    def __init__(self, data_manager: "DataManager", proxy_id: int, proxy: dict):
+        self._data_manager = data_manager
+        self.proxy_id = proxy_id
+        self.proxy = proxy
+        self.url: str = proxy["url"]
+        self.started = time.monotonic()
+        self.latency: Optional[float] = None
+        self.released = False
+
+    def success(self, latency: Optional[float] = None) -> None:
+        """
+        Reports that the proxy worked.
+
+        :param latency: Response time in seconds. Defaults to the time since the lease was taken.
+        """
+        self._report(True, latency)
+
+    def failure(self, latency: Optional[float] = None) -> None:
+        """Reports that the proxy failed."""
+        self._report(False, latency)
+
+    def release(self) -> None:
+        """Gives the proxy back without any feedback, for example when the work got cancelled."""
+        if self.released:
+            return
+        self.released = True
+        self._data_manager.release(self, None)
+
+    def _report(self, success: bool, latency: Optional[float]) -> None:
+        if self.released:
+            raise RuntimeError(f"Lease for {self.url} was already released")
+        self.released = True
+        self.latency = latency if latency is not None else time.monotonic() - self.started
+        self._data_manager.release(self, success)
+
+    async def __aenter__(self) -> "ProxyLease":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if self.released:
+            return
+        if exc_type is None:
+            self.success()
+        elif issubclass(exc_type, asyncio.CancelledError):
+            self.release()
+        else:
+            self.failure()
+
+    def __repr__(self):
+        return f"ProxyLease({self.url}, id={self.proxy_id}, released={self.released})"
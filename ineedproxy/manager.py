@@ -1,12 +1,93 @@
-from typing import List, Union, Callable
+from typing import List, Union, Callable, Tuple, AsyncIterator, Deque, Dict
+from collections import deque, OrderedDict
+from contextlib import aclosing, asynccontextmanager
 from pathlib import Path
+import asyncio
+import time
 import aiohttp
 
 from .data_manager import DataManager
-from .utils import ProxyDict, ProxyPreferences, NoProxyAvailable
-from .test_proxies import get_valid_proxies
+from .utils import ProxyDict, ProxyPreferences, NoProxyAvailable, RequestFailed, SourceStats, URL
+from .lease import ProxyLease
+from .selection import SelectionStrategy
+from .test_proxies import iter_valid_proxies, _is_proxy_valid, SUPPORTED_PROTOCOLS
 from .logger import logger
-from .get import get_request as _get_request
+from .get import get_request as _get_request, current_session
+from .source_cache import SourceCache, current_source_cache
+from .dead_cache import DeadProxyCache, BloomDeadProxyCache
+from .socks import SOCKS_PROTOCOLS, socks_connector
+from .metrics import Metrics
+from .tracing import RequestTracer, AttemptTrace
+from .shared_pool import PoolServer, PoolClient, SharedPoolError
+
+# Errors that mean one attempt of a request failed, so another proxy is worth a try
+_REQUEST_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+class _LatencyWindow:
+    """Response times of the most recent successful requests, for quantile estimates."""
+
+    def __init__(self, size: int = 500, min_samples: int = 20, refresh_every: int = 25):
+        self.samples: Deque[float] = deque(maxlen=size)
+        self.min_samples = min_samples
+        self.refresh_every = refresh_every
+        self._sorted: List[float] = []
+        self._added = 0
+
+    def add(self, latency: float | None) -> None:
+        if latency is not None:
+            self.samples.append(latency)
+            self._added += 1
+
+    def quantile(self, q: float) -> float | None:
+        """The q quantile, None while there are fewer than min_samples. Re-sorts only every refresh_every samples."""
+        if len(self.samples) < self.min_samples:
+            return None
+        if self._added >= self.refresh_every or not self._sorted:
+            self._sorted = sorted(self.samples)
+            self._added = 0
+        return self._sorted[min(int(q * len(self._sorted)), len(self._sorted) - 1)]
+
+
+class _SocksSessions:
+    """
+    One session per SOCKS proxy, since aiohttp can only send a whole session through a SOCKS proxy.
+    Kept between requests so they reuse the connections, the least recently used idle ones are closed.
+    """
+
+    def __init__(self, max_idle: int = 64, trace_configs: List[aiohttp.TraceConfig] | None = None):
+        self.max_idle = max_idle
+        self.trace_configs = trace_configs
+        self._sessions: OrderedDict[str, aiohttp.ClientSession] = OrderedDict()
+        self._users: Dict[str, int] = {}
+
+    @asynccontextmanager
+    async def session(self, proxy_url: str) -> AsyncIterator[aiohttp.ClientSession]:
+        session = self._sessions.pop(proxy_url, None)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(connector=socks_connector(proxy_url), trace_configs=self.trace_configs)
+        self._sessions[proxy_url] = session
+        self._users[proxy_url] = self._users.get(proxy_url, 0) + 1
+        try:
+            yield session
+        finally:
+            self._users[proxy_url] -= 1
+            if not self._users[proxy_url]:
+                del self._users[proxy_url]
+            await self._close_idle()
+
+    async def _close_idle(self) -> None:
+        excess = len(self._sessions) - self.max_idle
+        if excess <= 0:
+            return
+        idle = [proxy_url for proxy_url in self._sessions if proxy_url not in self._users][:excess]
+        for proxy_url in idle:
+            await self._sessions.pop(proxy_url).close()
+
+    async def aclose(self) -> None:
+        sessions, self._sessions = self._sessions, OrderedDict()
+        for session in sessions.values():
+            await session.close()
 
 
 class Manager:
@@ -20,7 +101,41 @@ class Manager:
                  percent_failed_to_remove: float = 0.5,
                  max_proxies: Union[int, False] = 10,
                  min_proxies: Union[int, False] = 2,
-                 simultaneous_proxy_requests: int = 300) -> None:
+                 simultaneous_proxy_requests: int = 300,
+                 flush_interval: float | None = None,
+                 flush_threshold: int = 100,
+                 journal: bool = False,
+                 selection: Union[str, Callable[[], SelectionStrategy]] = "random",
+                 connection_limit: int | None = None,
+                 connection_limit_per_host: int = 0,
+                 dns_cache_ttl: int | None = 10,
+                 source_timeout: float | None = 60,
+                 insert_batch_size: int = 10,
+                 insert_batch_interval: float = 0.5,
+                 test_url: str = "https://httpbin.org/ip",
+                 test_timeout: int = 20,
+                 prefilter_timeout: float | None = 2,
+                 prefilter_concurrency: int = 1000,
+                 health_check_interval: float | None = None,
+                 health_check_batch: int = 50,
+                 health_check_concurrency: int = 10,
+                 health_check_min_age: float = 600,
+                 hedge_delay: float | str | None = None,
+                 hedge_quantile: float = 0.9,
+                 breaker_cooldown: float = 60.0,
+                 breaker_max_trips: int = 3,
+                 request_attempts: int | None = 10,
+                 request_deadline: float | None = None,
+                 max_fetch_rounds: int = 2,
+                 source_cache: Path | bool = False,
+                 source_refresh_interval: float = 300,
+                 dead_proxy_ttl: float | None = 3600,
+                 dead_proxy_max_ttl: float = 24 * 3600,
+                 dead_proxy_bloom_capacity: int | None = None,
+                 trace_sample_rate: float = 0.0,
+                 trace_hooks: List[Callable[[AttemptTrace], None]] | None = None,
+                 shared_pool: Path | str | None = None,
+                 columnar: bool = False) -> None:
         """
         The main class to control pretty much everything.
 
@@ -28,19 +143,80 @@ class Manager:
         :param data_file: Path to a store file with proxy data.
         :param proxy_preferences: ProxyPreferences object to filter proxies.
         :param force_preferences: If True, will only return proxies that match the preferences.
-        When no proxies are available, it will fetch more (potential loop).
-        If False and no proxies are available,
-        it will fetch more, and when no proxies are available again, it ignores the preferences.
+        When no proxies are available, it will fetch more, up to max_fetch_rounds times.
+        If False and no proxies are available, it ignores the preferences first and fetches more after that.
         :param auto_fetch_proxies: If True, it will fetch when too few proxies are available.Has to be awaited (also on int).
-        :param allowed_fails_in_row: How many times a proxy can fail in a row before being removed.
-        :param fails_without_check: How many times a proxy can fail before being checked for percentage of fails to remove.
-        :param percent_failed_to_remove: Percentage of fails to remove a proxy.
-        Example: 0.5 means 50% of tries are fails, if higher than that it gets removed.
+        :param allowed_fails_in_row: How many times a proxy can fail in a row before its breaker trips.
+        :param fails_without_check: How many times a proxy can fail before being checked for percentage of fails.
+        :param percent_failed_to_remove: Percentage of fails that trips the breaker of a proxy.
+        Example: 0.5 means 50% of tries are fails, if higher than that it trips.
         :param max_proxies: Maximum number of proxies to be fetched.
         Saves time when testing proxies.
         :param min_proxies: When len(proxies) < min_proxies, fetch more proxies.
         :param simultaneous_proxy_requests: Number of simultaneous requests to test proxies.
+        :param flush_interval: Seconds between background writes of the data file (write-behind).
+        None writes the file on every change. Await aclose() before exiting when using it.
+        :param flush_threshold: Number of changes that trigger a background write before flush_interval is over.
+        :param journal: Append every change as a small record to a journal next to the data file
+        instead of rewriting the whole file. The journal is folded back into the file when it grows too big.
+        :param selection: How to pick proxies: "random", "round_robin", "lru", "least_in_flight", "weighted"
+        (by success rate), "p2c" (the faster of two random ones), "fastest" (lowest expected latency)
+        or a factory returning a SelectionStrategy.
+        :param connection_limit: Maximum number of open connections of the shared session
+        used for requests, proxy testing and fetching. Defaults to max(100, simultaneous_proxy_requests).
+        :param connection_limit_per_host: Maximum number of open connections per host, 0 means no limit.
+        :param dns_cache_ttl: Seconds to cache DNS lookups, None caches forever.
+        :param source_timeout: Seconds a single fetching method may take before it is given up on, None waits forever.
+        :param insert_batch_size: Tested proxies are added to the pool in batches of this size while testing goes on.
+        :param insert_batch_interval: Maximum seconds a tested proxy waits for its batch to fill up.
+        :param test_url: URL proxies are tested against, has to answer with JSON containing "origin".
+        :param test_timeout: Seconds a proxy test may take.
+        :param prefilter_timeout: Before the full test, every fetched proxy has to accept a plain TCP connection
+        within this many seconds, so dead ones are dropped quickly. None tests every proxy fully.
+        :param prefilter_concurrency: Number of TCP connection checks running at the same time.
+        Separate from simultaneous_proxy_requests, which limits the full tests.
+        :param health_check_interval: If set, a background task retests stored proxies every this many seconds,
+        so dead ones get removed before requests run into them. A failed check counts like a failed request.
+        :param health_check_batch: Maximum number of proxies tested per round.
+        :param health_check_concurrency: Maximum number of health checks running at the same time.
+        :param health_check_min_age: Only proxies not tested within this many seconds get checked.
+        :param hedge_delay: If set, get_request starts a second request through another proxy when the first
+        has not answered after this many seconds. The first response wins, the other request is cancelled
+        without counting as a failure. "auto" uses the hedge_quantile of recent response times
+        and only starts hedging once there are enough of them.
+        :param hedge_quantile: Quantile of recent response times used as delay with hedge_delay="auto".
+        :param breaker_cooldown: Seconds a proxy is paused when its breaker trips. Afterwards it gets one more
+        chance, a success puts it back to normal, a failure pauses it again for twice as long.
+        :param breaker_max_trips: A proxy is removed when its breaker trips this often in a row.
+        1 removes it on the first bad streak, like older versions did.
+        :param request_attempts: Default number of proxies get_request tries before giving up, None tries forever.
+        :param request_deadline: Default seconds get_request may take in total, None means no limit.
+        :param max_fetch_rounds: How often to fetch more proxies for a single request before raising NoProxyAvailable.
+        :param source_cache: Lets fetch_json_proxy_list and fetch_proxy_list remember the lists they fetched,
+        asking the source with If-None-Match/If-Modified-Since and reusing the list when it did not change.
+        True keeps the lists in memory, a Path of a directory also keeps them between runs.
+        :param source_refresh_interval: Seconds a source is not asked again after it was fetched.
+        :param dead_proxy_ttl: Seconds a proxy that failed its test is skipped by later fetches,
+        doubled with every further failure. Kept in "<data_file>.dead". None tests every fetched proxy.
+        :param dead_proxy_max_ttl: Upper limit for the doubled skip time.
+        :param dead_proxy_bloom_capacity: If set, failed proxies are kept in Bloom filters sized for this many
+        per dead_proxy_ttl instead of exactly. Much smaller for huge lists, but without backoff
+        and about 1% of working proxies get skipped as well.
+        :param trace_sample_rate: Share of get_request attempts whose phases (queueing, DNS, connect, sending,
+        waiting for the response, reading it) are timed, from 0 to 1. Traced attempts report their time
+        without the wait for a free local connection as latency of the proxy, so a busy session doesn't make
+        proxies look slow. Tracing is set up when the session is created, 0 leaves it out completely.
+        :param trace_hooks: Called with an AttemptTrace for every traced attempt, see add_trace_hook.
+        :param shared_pool: Path of the socket of a PoolServer, see serve_shared_pool. The Manager then keeps no pool
+        of its own: it leases proxies from the server, reports feedback there and lets it fetch, test and store
+        proxies. data_file, the dead proxy cache and health checks are left to the server.
+        :param columnar: Keep the proxy records in typed arrays instead of a dict per proxy, see ColumnarSlots.
+        Saves memory on big pools at the cost of slower field access.
+
+        Use it as `async with Manager(...) as manager:` or await aclose() when done,
+        so the session gets closed and pending data written.
         """
+        self.metrics = Metrics()
         self.simultaneous_proxy_requests = simultaneous_proxy_requests
         self.auto_fetch_proxies = auto_fetch_proxies
 
@@ -56,14 +232,79 @@ class Manager:
 
         self.failed_get_proxies_in_row: int = 0
 
+        self.connection_limit = connection_limit or max(100, simultaneous_proxy_requests)
+        self.connection_limit_per_host = connection_limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self._session: aiohttp.ClientSession | None = None
+        self.tracer = RequestTracer(trace_sample_rate, trace_hooks, metrics=self.metrics)
+        self._socks_sessions = _SocksSessions(trace_configs=self._trace_configs())
+
+        self.source_timeout = source_timeout
+        self.last_fetch_stats: List[SourceStats] = []
+        self.insert_batch_size = insert_batch_size
+        self.insert_batch_interval = insert_batch_interval
+
+        self.test_url = test_url
+        self.test_timeout = test_timeout
+        self.prefilter_timeout = prefilter_timeout
+        self.prefilter_concurrency = prefilter_concurrency
+        self.health_check_interval = health_check_interval
+        self.health_check_batch = health_check_batch
+        self.health_check_concurrency = health_check_concurrency
+        self.health_check_min_age = health_check_min_age
+        self._health_check_task: asyncio.Task | None = None
+
+        if isinstance(hedge_delay, str) and hedge_delay != "auto":
+            raise ValueError(f"Invalid hedge_delay: {hedge_delay}")
+        self.hedge_delay = hedge_delay
+        self.hedge_quantile = hedge_quantile
+        self._latencies = _LatencyWindow()
+
+        self.request_attempts = request_attempts
+        self.request_deadline = request_deadline
+        self.max_fetch_rounds = max_fetch_rounds
+        self._refill_task: asyncio.Task | None = None
+
+        self.source_cache = None
+        if source_cache is not False:
+            self.source_cache = SourceCache(None if source_cache is True else source_cache,
+                                            min_refresh_interval=source_refresh_interval)
+
+        self.shared_pool = PoolClient(shared_pool) if shared_pool is not None else None
+        self._shared_last_lease: ProxyLease | None = None  # lease behind get_proxy/feedback_proxy with a shared pool
+        if self.shared_pool is not None:
+            data_file = None  # the server is the only writer
+
+        self.dead_proxies: DeadProxyCache | None = None
+        if dead_proxy_ttl is not None and self.shared_pool is None:
+            dead_file = Path(data_file).with_name(Path(data_file).name + ".dead") if data_file else None
+            if dead_proxy_bloom_capacity:
+                self.dead_proxies = BloomDeadProxyCache(dead_file, ttl=dead_proxy_ttl,
+                                                        capacity=dead_proxy_bloom_capacity)
+            else:
+                self.dead_proxies = DeadProxyCache(dead_file, ttl=dead_proxy_ttl, max_ttl=dead_proxy_max_ttl)
+            self.dead_proxies.load()
+
         self.data_manager = DataManager(msgpack=data_file,
                                         allowed_fails_in_row=allowed_fails_in_row,
                                         fails_without_check=fails_without_check,
                                         percent_failed_to_remove=percent_failed_to_remove,
-                                        min_proxies=min_proxies)
+                                        min_proxies=min_proxies,
+                                        flush_interval=flush_interval,
+                                        flush_threshold=flush_threshold,
+                                        journal=journal,
+                                        selection=selection,
+                                        breaker_cooldown=breaker_cooldown,
+                                        breaker_max_trips=breaker_max_trips,
+                                        metrics=self.metrics,
+                                        columnar=columnar)
 
     async def _async_init(self):
-        if len(self.data_manager) < self.min_proxies and self.auto_fetch_proxies:
+        if self.shared_pool is not None:
+            return self
+        if self.health_check_interval is not None:
+            self.start_health_checks()
+        if self.data_manager.available() < self.min_proxies and self.auto_fetch_proxies:
             await self.fetch_proxies()
             logger.debug("Finished fetching proxies on init")
         return self
@@ -71,101 +312,533 @@ class Manager:
     def __await__(self):
         return self._async_init().__await__()
 
+    async def __aenter__(self):
+        return await self._async_init()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """The shared session, created on first use. Has to be used inside a running event loop."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.connection_limit,
+                                             limit_per_host=self.connection_limit_per_host,
+                                             ttl_dns_cache=self.dns_cache_ttl,
+                                             use_dns_cache=True)
+            self._session = aiohttp.ClientSession(connector=connector, trace_configs=self._trace_configs())
+        return self._session
+
+    def _trace_configs(self) -> List[aiohttp.TraceConfig] | None:
+        return [self.tracer.trace_config] if self.tracer.enabled else None
+
+    def add_trace_hook(self, hook: Callable[[AttemptTrace], None]) -> None:
+        """
+        Registers a function called with the AttemptTrace of every traced get_request attempt:
+        proxy, url, status, bytes and the seconds spent queued, resolving, connecting, sending,
+        waiting for the response and reading it. Only attempts sampled by trace_sample_rate are traced.
+        """
+        self.tracer.hooks.append(hook)
+
     async def fetch_proxies(self, test_proxies: bool = True,
-                            fetching_method: List[Callable[[], List[ProxyDict]]] = None) -> None:
+                            fetching_method: List[Callable[[], List[ProxyDict]]] = None) -> List[SourceStats]:
         """
         Fetch proxies from the internet.
+        All fetching methods run at the same time, one that fails or times out is logged and skipped.
         :param test_proxies: Test proxies before adding them.
         :param fetching_method: List of functions that return a list of ProxyDict.
         Change will be temp.
+        :return: Count, duration and error of every fetching method, also kept in last_fetch_stats.
         """
+        if self.shared_pool is not None:
+            return await self._fetch_shared(test_proxies, fetching_method)
         if fetching_method is None:
             fetching_method = self.fetching_method
 
+        # the tasks below copy the context, so they see these too
+        session_token = current_session.set(self.session)
+        cache_token = current_source_cache.set(self.source_cache)
+        try:
+            results = await asyncio.gather(*(self._fetch_source(i, method) for i, method in enumerate(fetching_method)))
+        finally:
+            current_source_cache.reset(cache_token)
+            current_session.reset(session_token)
+
         all_proxies = []
-        for method in fetching_method:
-            proxies = await method()
+        for proxies, _ in results:
             all_proxies.extend(proxies)
+        self.last_fetch_stats = [stats for _, stats in results]
 
         if test_proxies:
-            all_proxies = await get_valid_proxies(all_proxies, max_working_proxies=self.max_proxies,
-                                                  simultaneous_proxy_requests=self.simultaneous_proxy_requests)
+            candidates = all_proxies
+            if self.dead_proxies is not None:
+                candidates = self.dead_proxies.filter(all_proxies)
+                logger.debug("Skipping %d proxies that failed recently", len(all_proxies) - len(candidates))
+            validated = iter_valid_proxies(candidates, max_working_proxies=self.max_proxies,
+                                           simultaneous_proxy_requests=self.simultaneous_proxy_requests,
+                                           test_url=self.test_url, timeout=self.test_timeout,
+                                           session=self.session, on_invalid=self._mark_dead,
+                                           prefilter_timeout=self.prefilter_timeout,
+                                           prefilter_concurrency=self.prefilter_concurrency,
+                                           metrics=self.metrics)
+            try:
+                added = await self._add_streaming(validated)
+            finally:
+                if self.dead_proxies is not None:
+                    await self.dead_proxies.asave()
+        else:
+            added = self.data_manager.add_proxy(all_proxies)
+
+        logger.debug("Fetched %d new proxies", added)
+        return self.last_fetch_stats
+
+    async def _fetch_shared(self, test_proxies: bool,
+                            fetching_method: List[Callable[[], List[ProxyDict]]] | None) -> List[SourceStats]:
+        """
+        With a shared pool the server fetches with its own fetching methods.
+        Explicitly given ones run here and their proxies are handed to the server, which tests and stores them.
+        """
+        if fetching_method is None:
+            await self.shared_pool.fetch()
+            self.last_fetch_stats = []
+            return self.last_fetch_stats
+
+        results = await asyncio.gather(*(self._fetch_source(i, method) for i, method in enumerate(fetching_method)))
+        proxies = [proxy for source_proxies, _ in results for proxy in source_proxies]
+        await self.shared_pool.add_proxy(proxies, test=test_proxies)
+        self.last_fetch_stats = [stats for _, stats in results]
+        return self.last_fetch_stats
+
+    async def _add_streaming(self, validated: AsyncIterator[ProxyDict]) -> int:
+        """
+        Adds proxies to the data manager in small batches while they are still being tested,
+        so the first ones can be used long before the slowest test timed out.
+        Returns how many of them were new to the pool.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        finished = object()
+
+        async def produce():
+            try:
+                async with aclosing(validated):
+                    async for proxy in validated:
+                        queue.put_nowait(proxy)
+            finally:
+                queue.put_nowait(finished)
+
+        producer = asyncio.create_task(produce())
+        loop = asyncio.get_running_loop()
+        batch: List[ProxyDict] = []
+        deadline = None
+        added = 0
+        try:
+            while True:
+                try:
+                    timeout = None if deadline is None else max(deadline - loop.time(), 0)
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    item = None  # the batch waited long enough
+
+                if item is finished:
+                    break
+                if item is not None:
+                    if self.dead_proxies is not None:
+                        self.dead_proxies.discard(item)
+                    now = time.time()
+                    batch.append({**item, "last_checked": now, "last_ok": now})
+                    if deadline is None:
+                        deadline = loop.time() + self.insert_batch_interval
+
+                if batch and (item is None or len(batch) >= self.insert_batch_size):
+                    added += self.data_manager.add_proxy(batch)
+                    batch, deadline = [], None
+        finally:
+            if not producer.done():
+                producer.cancel()
+            if batch:
+                added += self.data_manager.add_proxy(batch)
+
+        await producer  # re-raises errors of the validation
+        return added
+
+    def _mark_dead(self, proxy: ProxyDict) -> None:
+        if self.dead_proxies is not None and URL(proxy["url"]).protocol in SUPPORTED_PROTOCOLS:
+            self.dead_proxies.add(proxy)
+
+    async def _fetch_source(self, position: int,
+                            method: Callable[[], List[ProxyDict]]) -> Tuple[List[ProxyDict], SourceStats]:
+        # Lambdas and partials share a qualname, the position in the list tells them apart
+        source = f"{position}:{getattr(method, '__qualname__', None) or repr(method)}"
+        start = time.monotonic()
+        proxies, error = [], None
+        try:
+            proxies = await asyncio.wait_for(method(), self.source_timeout)
+        except asyncio.TimeoutError:
+            error = f"Timed out after {self.source_timeout}s"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+
+        duration = time.monotonic() - start
+        if error:
+            logger.warning("Fetching method %s failed after %.1fs: %s", source, duration, error)
+        else:
+            logger.debug("Fetching method %s returned %d proxies in %.1fs", source, len(proxies), duration)
+        return proxies, SourceStats(source=source, count=len(proxies), duration=duration, error=error)
+
+    def start_health_checks(self) -> None:
+        """Starts the background health checks, every health_check_interval seconds. Does nothing if running."""
+        if self._health_check_task is None or self._health_check_task.done():
+            self._health_check_task = asyncio.create_task(self._health_check_loop())
 
-        logger.debug("Fetched %d proxies", len(all_proxies))
+    async def stop_health_checks(self) -> None:
+        if self._health_check_task is not None:
+            self._health_check_task.cancel()
+            try:
+                await self._health_check_task
+            except asyncio.CancelledError:
+                pass
+            self._health_check_task = None
+
+    async def _health_check_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_check_interval or 0)
+            try:
+                await self.check_proxies()
+            except Exception as e:
+                logger.error("Health check round failed: %s", e)
+
+    async def check_proxies(self, limit: int | None = None) -> int:
+        """
+        Retests the stored proxies most in need of it, see DataManager.health_check_candidates.
+        :param limit: Maximum number of proxies to test, defaults to health_check_batch.
+        :return: Number of proxies that passed. Always 0 with a shared pool, the server checks its proxies.
+        """
+        if self.shared_pool is not None:
+            return 0
+        candidates = self.data_manager.health_check_candidates(limit or self.health_check_batch,
+                                                               self.health_check_min_age,
+                                                               protocols=SUPPORTED_PROTOCOLS)
+        if not candidates:
+            return 0
+
+        semaphore = asyncio.Semaphore(self.health_check_concurrency)
+        session = self.session
 
-        self.data_manager.add_proxy(all_proxies, remove_duplicates=True if len(fetching_method) > 1 else False)
+        async def check(proxy_id: int, proxy: dict) -> bool:
+            async with semaphore:
+                started = time.monotonic()
+                ok = await _is_proxy_valid({"url": URL(proxy["url"])}, session, self.test_url,
+                                           self.test_timeout, metrics=self.metrics) is not None
+            self.data_manager.record_check(proxy_id, proxy, ok, latency=time.monotonic() - started)
+            if self.dead_proxies is not None:
+                if ok:
+                    self.dead_proxies.discard(proxy)
+                else:
+                    self.dead_proxies.add(proxy)
+            return ok
+
+        results = await asyncio.gather(*(check(proxy_id, proxy) for proxy_id, proxy in candidates))
+        passed = sum(results)
+        logger.debug("Health check: %d of %d proxies passed", passed, len(results))
+        return passed
 
     async def get_proxy(self, ignore_preferences=False, **preferences_kwargs) -> str:
-        """Returns a proxy from the data manager."""
+        """
+        Returns a proxy from the data manager.
+        Pair it with feedback_proxy only when running one request at a time, otherwise use acquire.
+        """
+        if self.shared_pool is not None:
+            if self._shared_last_lease is not None:
+                self._shared_last_lease.release()  # no feedback came for it
+            self._shared_last_lease = await self.shared_pool.acquire(ignore_preferences, **preferences_kwargs)
+            return self._shared_last_lease.url
+        return await self._pick(self.data_manager.get_proxy, ignore_preferences, preferences_kwargs)
+
+    async def acquire(self, ignore_preferences=False, **preferences_kwargs) -> ProxyLease:
+        """
+        Leases a proxy from the data manager, fetching more when none is available like get_proxy.
+        Report the outcome on the lease or use it as an async context manager:
+
+            async with await manager.acquire() as lease:
+                await do_request(proxy=lease.url)
+        """
+        if self.shared_pool is not None:
+            return await self.shared_pool.acquire(ignore_preferences, **preferences_kwargs)
+        return await self._pick(self.data_manager.acquire, ignore_preferences, preferences_kwargs)
+
+    async def _pick(self, pick: Callable, ignore_preferences: bool, preferences_kwargs: dict):
         if not ignore_preferences:
             try:
-                proxy = self.data_manager.get_proxy(**preferences_kwargs)
+                result = pick(**preferences_kwargs)
                 self.failed_get_proxies_in_row = 0
-                return proxy
+                return result
             except NoProxyAvailable:
                 self.failed_get_proxies_in_row += 1
-                return await self._handle_no_proxy_available(preferences_kwargs)
+                return await self._handle_no_proxy_available(pick, preferences_kwargs)
         else:
-            return self.data_manager.get_proxy()
+            return pick()
 
-    async def _handle_no_proxy_available(self, preferences_kwargs):
-        """Helper method to handle NoProxyAvailable exceptions."""
+    async def _handle_no_proxy_available(self, pick: Callable, preferences_kwargs):
+        """
+        Helper method to handle NoProxyAvailable exceptions.
+        Drops the preferences unless they are forced, then fetches at most max_fetch_rounds times.
+        """
         if not self.auto_fetch_proxies:
+            self.metrics.no_proxy_escalations.inc("exhausted")
             raise NoProxyAvailable("No proxy available")
 
-        if self.force_preferences:
-            logger.debug("No proxy available, fetching more proxies")
-            await self.fetch_proxies()
-            return await self.get_proxy(ignore_preferences=False, **preferences_kwargs)
+        def try_pick():
+            try:
+                return pick(**preferences_kwargs)
+            except NoProxyAvailable:
+                if self.force_preferences:
+                    return None
+                logger.debug("Failed with preferences. Trying without preferences.")
+                self.metrics.no_proxy_escalations.inc("ignored_preferences")
+                try:
+                    return pick()
+                except NoProxyAvailable:
+                    return None
 
-        if self.failed_get_proxies_in_row == 1:
-            logger.debug("Failed with preferences. Trying without preferences.")
-            return await self.get_proxy(ignore_preferences=True)
-        if self.failed_get_proxies_in_row == 2:
-            logger.debug("Failed without preferences. Fetching more proxies.")
-            await self.fetch_proxies()
-            return await self.get_proxy(ignore_preferences=True)
+        if not self.force_preferences:
+            result = try_pick()
+            if result is not None:
+                return result
+
+        for fetch_round in range(1, self.max_fetch_rounds + 1):
+            logger.debug("No proxy available, fetching more proxies (round %d of %d)",
+                         fetch_round, self.max_fetch_rounds)
+            self.metrics.no_proxy_escalations.inc("fetched")
+            await self._refill()
+            result = try_pick()
+            if result is not None:
+                self.failed_get_proxies_in_row = 0
+                return result
 
-        logger.critical("Failed to get proxy %d times in a row.",
-                        self.failed_get_proxies_in_row)
-        await self.fetch_proxies()
-        return await self.get_proxy(ignore_preferences=True)
+        logger.critical("Failed to get proxy %d times in a row.", self.failed_get_proxies_in_row)
+        self.metrics.no_proxy_escalations.inc("exhausted")
+        raise NoProxyAvailable(f"Still no proxy available after fetching {self.max_fetch_rounds} times")
+
+    async def _refill(self) -> None:
+        """
+        Fetches more proxies. Callers that run out of proxies at the same time share a single fetch
+        instead of starting one each.
+        """
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self.fetch_proxies())
+        # Shielded, so one caller giving up does not cancel the fetch the others wait for
+        await asyncio.shield(self._refill_task)
 
-    def feedback_proxy(self, success: bool) -> None:
-        """Just feedback to the DataManager if the last proxy was successful or not."""
-        logger.debug("Feedback: Proxy %s was %s.", self.data_manager.proxies[self.data_manager.last_proxy_index]["url"],
+    def feedback_proxy(self, success: bool, latency: float | None = None) -> None:
+        """
+        Just feedback to the DataManager if the last proxy from get_proxy was successful or not.
+        Kept for compatibility, with concurrent requests report on a lease from acquire instead.
+        """
+        if self.shared_pool is not None:
+            lease, self._shared_last_lease = self._shared_last_lease, None
+            if lease is not None:
+                (lease.success if success else lease.failure)(latency)
+            return
+        last_proxy = self.data_manager.slots.get(self.data_manager.last_proxy_id) \
+            if self.data_manager.last_proxy_id is not None else None
+        logger.debug("Feedback: Proxy %s was %s.", last_proxy["url"] if last_proxy else None,
                      "successful" if success else "unsuccessful")
-        self.data_manager.feedback_proxy(success)
+        self.data_manager.feedback_proxy(success, latency)
 
     async def get_request(self, url: str, timeout: int = 10,
-                          session: aiohttp.ClientSession = None) -> aiohttp.ClientResponse | None:
+                          session: aiohttp.ClientSession = None,
+                          max_attempts: int | None = None,
+                          deadline: float | None = None) -> str:
         """
         Sends a GET request using a proxy.
-        Will keep trying indefinitely until successful.
+        Every failed attempt is charged to its proxy and retried through another one,
+        until the request succeeds or runs out of attempts or time.
 
         :param url: The URL to request.
-        :param timeout: Timeout for the request.
-        :param session: Optionally, an existing aiohttp.ClientSession.
-        :return: The full aiohttp.ClientResponse object or None if all attempts fail.
+        :param timeout: Timeout for a single attempt.
+        :param session: Optionally, an existing aiohttp.ClientSession. Defaults to the shared session.
+        Requests through SOCKS proxies use a session per proxy instead.
+        :param max_attempts: Number of attempts, defaults to request_attempts of the Manager.
+        :param deadline: Seconds the whole request may take, defaults to request_deadline of the Manager.
+        :return: The response text.
+        :raises RequestFailed: When all attempts failed or the deadline passed.
+        :raises NoProxyAvailable: When no proxy is left even after fetching more.
         """
 
         if not self.auto_fetch_proxies:
             raise Exception("THE AUTO FETCH PROXIES OPTION IS NOT ENABLED. PLEASE ENABLE IT TO USE THIS METHOD.")
 
         if session is None:
-            session = aiohttp.ClientSession()
+            session = self.session
+        if max_attempts is None:
+            max_attempts = self.request_attempts
+        if deadline is None:
+            deadline = self.request_deadline
 
-        while True:  # Infinite retry loop
-            proxy = await self.get_proxy()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        stop_at = None if deadline is None else started + deadline
+        attempts = 0
+        last_error = None
+        while max_attempts is None or attempts < max_attempts:
+            remaining = None if stop_at is None else stop_at - loop.time()
+            if remaining is not None and remaining <= 0:
+                break
+            attempts += 1
 
+            hedge_delay = self._hedge_delay()
             try:
-                response = await _get_request(url=url, timeout=timeout, proxy=proxy, session=session)
-
-                self.feedback_proxy(success=True)
+                if hedge_delay is None:
+                    attempt = self._lease_and_attempt(url, timeout, session)
+                else:
+                    attempt = self._hedged_attempt(url, timeout, session, hedge_delay)
+                # Also bounds the wait for a proxy, a request cut off by the deadline is not charged to its proxy
+                response = await asyncio.wait_for(attempt, remaining)
+                self.metrics.request_seconds.observe(loop.time() - started, "success")
                 return response
+            except _REQUEST_ERRORS as e:
+                last_error = e
+                logger.debug("Attempt %d for %s failed: %r", attempts, url, e)
+
+        self.metrics.request_seconds.observe(loop.time() - started, "failed")
+        reason = f"deadline of {deadline}s passed" if stop_at is not None and loop.time() >= stop_at \
+            else "no attempts left"
+        raise RequestFailed(f"GET {url} failed after {attempts} attempts, {reason}",
+                            attempts=attempts, last_error=last_error)
+
+    async def _lease_and_attempt(self, url: str, timeout: float, session: aiohttp.ClientSession) -> str:
+        return await self._attempt(await self.acquire(), url, timeout, session)
+
+    async def _attempt(self, lease: ProxyLease, url: str, timeout: int, session: aiohttp.ClientSession) -> str:
+        """One request through a leased proxy, reporting the outcome on the lease."""
+        timer = self.tracer.start(lease.url, url) if self.tracer.enabled else None
+        try:
+            if lease.proxy.get("protocol") in SOCKS_PROTOCOLS:
+                async with self._socks_sessions.session(lease.url) as socks_session:
+                    response = await _get_request(url=url, timeout=timeout, session=socks_session,
+                                                  trace_request_ctx=timer)
+            else:
+                response = await _get_request(url=url, timeout=timeout, proxy=lease.url, session=session,
+                                              trace_request_ctx=timer)
+        except asyncio.CancelledError:
+            lease.release()  # lost a hedge or got cancelled, says nothing about the proxy
+            raise
+        except Exception as e:
+            lease.failure(timer.proxy_latency if timer is not None else None)
+            self.metrics.attempt_seconds.observe(lease.latency, "failure")
+            if timer is not None:
+                self.tracer.finish(timer, e)
+            raise
+
+        lease.success(timer.proxy_latency if timer is not None else None)
+        if timer is not None:
+            self.tracer.finish(timer)
+        self.metrics.attempt_seconds.observe(lease.latency, "success")
+        self._latencies.add(lease.latency)
+        return response
+
+    async def _hedged_attempt(self, url: str, timeout: int, session: aiohttp.ClientSession, delay: float) -> str:
+        """
+        Starts a request and, if it has not finished after delay seconds, a second one through another proxy.
+        The first successful response wins and the other request gets cancelled.
+        """
+        first = await self.acquire()
+        second = None
+        tasks = {asyncio.create_task(self._attempt(first, url, timeout, session))}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                second = await self._acquire_other(first)
+                if second is not None:
+                    logger.debug("No response from %s after %.2fs, hedging with %s", first.url, delay, second.url)
+                    tasks.add(asyncio.create_task(self._attempt(second, url, timeout, session)))
+
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # A task cancelled before it started never reaches its own release, no-op for reported leases
+            first.release()
+            if second is not None:
+                second.release()
+
+    async def _acquire_other(self, lease: ProxyLease) -> ProxyLease | None:
+        """Leases a proxy other than the one of lease, None if there is none right now."""
+        for _ in range(3):
+            try:
+                if self.shared_pool is not None:
+                    other = await self.shared_pool.acquire(fetch=False)
+                else:
+                    other = self.data_manager.acquire()
+            except (NoProxyAvailable, SharedPoolError):
+                return None
+            if other.url != lease.url:
+                return other
+            other.release()
+        return None
+
+    def _hedge_delay(self) -> float | None:
+        if self.hedge_delay is None:
+            return None
+        if self.hedge_delay == "auto":
+            return self._latencies.quantile(self.hedge_quantile)
+        return self.hedge_delay
+
+    def stats(self) -> Dict[str, object]:
+        """
+        Counters of the pool, selection, proxy tests, store writes and requests as a plain dict,
+        see Metrics.snapshot. Useful to tune min_proxies, simultaneous_proxy_requests and the breaker settings.
+        """
+        return self.metrics.snapshot()
+
+    def prometheus(self) -> str:
+        """
+        The same metrics in the Prometheus text exposition format. Serve it from any HTTP handler
+        with the Content-Type PROMETHEUS_CONTENT_TYPE, for example with aiohttp:
+
+            web.Response(body=manager.prometheus(), headers={"Content-Type": PROMETHEUS_CONTENT_TYPE})
+        """
+        return self.metrics.prometheus()
+
+    async def serve_shared_pool(self, path: Path | str) -> PoolServer:
+        """
+        Shares the pool of this Manager with Managers in other processes created with shared_pool=path,
+        over a Unix domain socket. This Manager fetches, tests and stores for all of them,
+        and their feedback adds up here. Close the returned server when done, aclose does not.
+        """
+        return await PoolServer(self, path).start()
+
+    def flush(self) -> None:
+        """Writes all pending proxy data to the data file."""
+        self.data_manager.flush()
 
-            except Exception:
-                self.feedback_proxy(success=False)
+    async def aclose(self) -> None:
+        """Stops health checks, closes the shared session, writes all pending proxy data and stops background writing."""
+        await self.stop_health_checks()
+        if self._refill_task is not None and not self._refill_task.done():
+            self._refill_task.cancel()
+            await asyncio.gather(self._refill_task, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        await self._socks_sessions.aclose()
+        if self.shared_pool is not None:
+            if self._shared_last_lease is not None:
+                self._shared_last_lease.release()
+            await self.shared_pool.aclose()
+        await self.data_manager.aclose()
+        if self.dead_proxies is not None:
+            await self.dead_proxies.asave()
 
     def __len__(self):
+        if self.shared_pool is not None:
+            return self.shared_pool.pool_size  # as of the last answer of the server
         return len(self.data_manager)
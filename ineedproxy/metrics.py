@@ -0,0 +1,299 @@
+from bisect import bisect_left
+from math import inf
+import threading
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+# Content-Type of the Prometheus text exposition format, for serving Metrics.prometheus() over HTTP
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Labels = Tuple[str, ...]
+
+LATENCY_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+WRITE_BUCKETS: Tuple[float, ...] = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+PHASE_BUCKETS: Tuple[float, ...] = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _snapshot_key(labels: Labels) -> str:
+    return ",".join(str(label) for label in labels)
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # Updates may come from the writing thread of the store while the loop thread reads
+        self._lock = threading.Lock()
+
+    def _samples(self) -> Iterator[Tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def snapshot(self):
+        raise NotImplementedError
+
+    def reset(self) -> None:
+        raise NotImplementedError
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines += [f"{name}{labels} {_format_value(value)}" for name, labels, value in self._samples()]
+        return lines
+
+
+class Counter(_Metric):
+    """A number that only goes up. inc() is one dict update under an uncontended lock, cheap enough for every request."""
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels: str) -> float:
+        return self.values.get(labels, 0)
+
+    def _items(self) -> List[Tuple[Labels, float]]:
+        with self._lock:
+            return sorted(self.values.items())
+
+    def _samples(self) -> Iterator[Tuple[str, str, float]]:
+        items = self._items()
+        if not self.labelnames and not items:
+            yield self.name, "", 0
+        for labels, value in items:
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+    def snapshot(self) -> Union[float, Dict[str, float]]:
+        if not self.labelnames:
+            return self.get()
+        return {_snapshot_key(labels): value for labels, value in self._items()}
+
+    def reset(self) -> None:
+        with self._lock:
+            self.values.clear()
+
+
+class Gauge(Counter):
+    """A number that goes up and down. The gauges of Metrics are filled in right before they are read."""
+    type = "gauge"
+
+    def set(self, *labels: str, value: float) -> None:
+        with self._lock:
+            self.values[labels] = value
+
+    def replace(self, values: Dict[Labels, float]) -> None:
+        """Replaces all values at once, so labels that disappeared don't linger."""
+        with self._lock:
+            self.values = values
+
+
+class Histogram(_Metric):
+    """Counts observations into buckets of upper bounds, like a Prometheus histogram."""
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.counts: Dict[Labels, List[int]] = {}  # labels -> count per bucket, the last one is +Inf
+        self.sums: Dict[Labels, float] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        with self._lock:
+            counts = self.counts.get(labels)
+            if counts is None:
+                counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+                self.sums[labels] = 0.0
+            counts[bisect_left(self.buckets, value)] += 1
+            self.sums[labels] += value
+
+    def _copy(self) -> List[Tuple[Labels, List[int], float]]:
+        """(labels, counts, sum) of every label combination, copied together so they fit each other."""
+        with self._lock:
+            return [(labels, list(counts), self.sums[labels]) for labels, counts in sorted(self.counts.items())]
+
+    def count(self, *labels: str) -> int:
+        with self._lock:
+            return sum(self.counts.get(labels, ()))
+
+    def quantile(self, q: float, *labels: str) -> Optional[float]:
+        """Upper bound of the bucket the q-quantile falls in, None without observations."""
+        with self._lock:
+            counts = list(self.counts.get(labels, ()))
+        return self._quantile(q, counts)
+
+    def _quantile(self, q: float, counts: List[int]) -> Optional[float]:
+        if not counts:
+            return None
+        rank, seen = q * sum(counts), 0
+        for bound, count in zip(self.buckets + (inf,), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return inf
+
+    def _samples(self) -> Iterator[Tuple[str, str, float]]:
+        for labels, counts, total in self._copy():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (inf,), counts):
+                cumulative += count
+                yield (f"{self.name}_bucket",
+                       _format_labels(self.labelnames + ("le",), labels + (_format_value(float(bound)),)),
+                       cumulative)
+            label_text = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum", label_text, total
+            yield f"{self.name}_count", label_text, cumulative
+
+    def snapshot(self) -> Dict[str, dict]:
+        result = {}
+        for labels, counts, total in self._copy():
+            count = sum(counts)
+            result[_snapshot_key(labels)] = {
+                "count": count,
+                "sum": total,
+                "mean": total / count if count else None,
+                "p50": self._quantile(0.5, counts),
+                "p99": self._quantile(0.99, counts),
+            }
+        return result
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counts.clear()
+            self.sums.clear()
+
+
+class Metrics:
+    def __init__(self, prefix: str = "ineedproxy"):
+        """
+        Counters and histograms of one Manager, kept as plain numbers so that updating them costs next to nothing.
+        Gauges describing the pool are filled in by collectors right before the metrics are read.
+
+        Every metric guards its values with its own lock, so the store metrics can be updated
+        by the writing thread of the store while the loop thread reads snapshot() or prometheus().
+
+        :param prefix: Prefix of all metric names in the Prometheus output.
+        """
+        self.prefix = prefix
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], None]] = []
+
+        # Pool, filled in by the collector of the DataManager
+        self.pool_size = self.gauge("pool_proxies", "Stored proxies")
+        self.pool_available = self.gauge("pool_available_proxies", "Stored proxies not paused by their breaker")
+        self.pool_open_breakers = self.gauge("pool_open_breakers", "Proxies paused by their breaker")
+        self.pool_in_flight = self.gauge("pool_in_flight_leases", "Leases that were not released yet")
+        self.pool_by_protocol = self.gauge("pool_proxies_by_protocol", "Stored proxies per protocol", ["protocol"])
+        self.pool_by_country = self.gauge("pool_proxies_by_country", "Stored proxies per country", ["country"])
+        self.pool_by_anonymity = self.gauge("pool_proxies_by_anonymity", "Stored proxies per anonymity",
+                                            ["anonymity"])
+
+        # Selection
+        self.get_proxy_calls = self.counter("get_proxy_calls_total", "Proxies asked for through get_proxy or acquire")
+        self.get_proxy_misses = self.counter("get_proxy_misses_total",
+                                             "get_proxy or acquire calls that found no matching proxy")
+        self.no_proxy_escalations = self.counter(
+            "no_proxy_escalations_total",
+            "Steps taken by the Manager when no proxy was available: "
+            "ignored_preferences, fetched, exhausted (NoProxyAvailable raised)", ["step"])
+        self.breaker_trips = self.counter("breaker_trips_total", "Breakers tripped by failing proxies")
+        self.proxies_removed = self.counter("proxies_removed_total",
+                                            "Proxies removed after their breaker tripped breaker_max_trips times")
+        self.proxies_added = self.counter("proxies_added_total", "New proxies added to the pool")
+
+        # Validation
+        self.validation_attempts = self.counter("validation_attempts_total",
+                                                "Proxy tests started, by fetching and by health checks")
+        self.validation_passes = self.counter("validation_passes_total", "Proxy tests passed")
+        self.validation_timeouts = self.counter("validation_timeouts_total", "Proxy tests that timed out")
+        self.prefilter_rejects = self.counter("prefilter_rejects_total",
+                                              "Candidates that did not accept a TCP connection before the test")
+
+        # Persistence
+        self.store_writes = self.counter("store_writes_total", "Writes of the store file, by snapshot or journal",
+                                         ["kind"])
+        self.store_write_bytes = self.counter("store_write_bytes_total", "Bytes written to the store file",
+                                              ["kind"])
+        self.store_write_seconds = self.histogram("store_write_seconds", "Duration of store file writes",
+                                                  ["kind"], buckets=WRITE_BUCKETS)
+
+        # Requests
+        self.request_seconds = self.histogram("request_seconds",
+                                              "Duration of get_request calls including retries, by outcome",
+                                              ["outcome"])
+        self.attempt_seconds = self.histogram("request_attempt_seconds",
+                                              "Duration of single attempts through one proxy, by outcome",
+                                              ["outcome"])
+        self.attempt_phase_seconds = self.histogram("request_attempt_phase_seconds",
+                                                    "Duration of the phases of traced attempts, see AttemptTrace",
+                                                    ["phase"], buckets=PHASE_BUCKETS)
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(f"{self.prefix}_{name}", help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(f"{self.prefix}_{name}", help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(f"{self.prefix}_{name}", help, labelnames, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        """Registers a function that updates gauges, called before every snapshot() and prometheus()."""
+        self._collectors.append(collector)
+
+    def collect(self) -> None:
+        for collector in self._collectors:
+            collector()
+
+    def snapshot(self) -> Dict[str, object]:
+        """
+        All metrics as a plain dict keyed by their name without prefix.
+        Metrics with labels map the label values to their value, histograms give count, sum, mean, p50 and p99.
+        """
+        self.collect()
+        cut = len(self.prefix) + 1
+        return {metric.name[cut:]: metric.snapshot() for metric in self._metrics}
+
+    def prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format, served with PROMETHEUS_CONTENT_TYPE."""
+        self.collect()
+        lines = []
+        for metric in self._metrics:
+            lines += metric.expose()
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        """Sets all counters and histograms back to zero."""
+        for metric in self._metrics:
+            metric.reset()
+
+
+__all__ = ['Metrics', 'Counter', 'Gauge', 'Histogram', 'PROMETHEUS_CONTENT_TYPE', 'LATENCY_BUCKETS']
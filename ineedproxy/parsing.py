@@ -0,0 +1,327 @@
+from typing import List, Dict, Optional, Union, Tuple, Callable, Any
+from concurrent.futures import Executor
+from contextlib import contextmanager
+from functools import partial
+import asyncio
+import gc
+import re
+import threading
+
+import orjson
+
+from .utils import ProxyDict, URL, _convert_to_proxy_dict, _find_country, _find_anonymity, _PROTOCOLS, _IPV4_PATTERN
+from .logger import logger
+
+# Payloads at least this big are parsed in an executor by parse_proxy_list_async
+OFFLOAD_BYTES = 1024 * 1024
+
+_PROTOCOL_PATTERN = "|".join(_PROTOCOLS)
+_PROTOCOL_SET = frozenset(_PROTOCOLS)
+_URL_RE = re.compile(rf"(?:({_PROTOCOL_PATTERN})://)?({_IPV4_PATTERN}):(\d{{1,5}})/?")
+_IP_RE = re.compile(_IPV4_PATTERN)
+# The same for many values at once, joined by newlines, so the regex engine runs once instead of per row
+_URL_LINES_RE = re.compile(rf"^{_URL_RE.pattern}$", re.MULTILINE)
+_IP_LINES_RE = re.compile(rf"^{_IPV4_PATTERN}$", re.MULTILINE)
+# One proxy per line, anything after whitespace, a comma, a semicolon or a # is ignored
+_LINE_RE = re.compile(rf"^[ \t]*(?:({_PROTOCOL_PATTERN})://)?({_IPV4_PATTERN}):(\d{{1,5}})(?:[ \t,;#].*)?\r?$",
+                      re.MULTILINE)
+
+KeyPath = Tuple[str, ...]  # keys leading to a value, one key for the row itself or two for a nested dict
+
+# Fields in the order _convert_to_proxy_dict prefers them
+_COUNTRY_KEYS = ("countryCode", "country")
+_ANONYMITY_KEYS = ("anonymity",)
+_SAMPLE_ROWS = 20
+_MAX_SCHEMAS = 256
+
+
+def _find(row: dict, key: str) -> Optional[KeyPath]:
+    """Where _convert_to_proxy_dict would find key in row: the row itself first, then the first nested dict."""
+    if row.get(key):
+        return (key,)
+    for outer, value in row.items():
+        if isinstance(value, dict) and value.get(key):
+            return outer, key
+    return None
+
+
+def _first_path(rows: List[dict], keys: Tuple[str, ...]) -> Optional[KeyPath]:
+    """Where the first of keys, in order of preference, is found in any of the rows."""
+    for key in keys:
+        for row in rows:
+            path = _find(row, key)
+            if path is not None:
+                return path
+    return None
+
+
+def _field(row: dict, path: Optional[KeyPath], keys: Tuple[str, ...], find: Callable[[dict], Any]) -> Any:
+    """
+    The value _convert_to_proxy_dict takes for a field. Read straight from the row when the schema found it
+    in the row itself under the most preferred key. Searched like the slow path otherwise,
+    as a value under another key or in a nested dict can be overruled by a more preferred one.
+    """
+    if path == keys[:1]:
+        value = row.get(keys[0])
+        if value:
+            return value
+    return find(row)
+
+
+def _column(rows: List[dict], path: Optional[KeyPath], keys: Tuple[str, ...],
+            find: Callable[[dict], Any]) -> List[Any]:
+    """_field for every row."""
+    if path == keys[:1]:
+        key = keys[0]
+        return [value or find(row) for value, row in zip([row.get(key) for row in rows], rows)]
+    return [find(row) for row in rows]
+
+
+def _all_match(pattern: re.Pattern, values: List[str]) -> Optional[List[Any]]:
+    """Matches every value in one pass. None if a value does not match or contains a line break."""
+    text = "\n".join(values)
+    if text.count("\n") != len(values) - 1:
+        return None
+    matches = pattern.findall(text)
+    return matches if len(matches) == len(values) else None
+
+
+class _Schema:
+    """Where the fields of the rows of one source are, so they don't have to be searched in every row."""
+
+    __slots__ = ("parts", "url", "country", "anonymity")
+
+    def __init__(self, rows: List[dict]):
+        self.parts = False  # protocol, ip and port keys instead of a url
+        self.url: Optional[str] = None
+        self.country: Optional[KeyPath] = None
+        self.anonymity: Optional[KeyPath] = None
+
+        rows = [row for row in rows if isinstance(row, dict)]
+        for row in rows:
+            if row.get("protocol") and row.get("ip") and row.get("port"):
+                self.parts = True
+            elif row.get("url"):
+                self.url = "url"
+            elif row.get("proxy"):
+                self.url = "proxy"
+            else:
+                continue
+            break
+        self.country = _first_path(rows, _COUNTRY_KEYS)
+        self.anonymity = _first_path(rows, _ANONYMITY_KEYS)
+
+    def parse_all(self, rows: List[dict]) -> Optional[List[ProxyDict]]:
+        """Parses all rows column by column. None if any row does not fit the schema."""
+        try:
+            if self.parts:
+                protocols = [row["protocol"] for row in rows]
+                ips = [row["ip"] for row in rows]
+                ports = [int(row["port"]) for row in rows]
+                if not _PROTOCOL_SET.issuperset(protocols) or _all_match(_IP_LINES_RE, ips) is None:
+                    return None
+                urls = [URL._from_parts(f"{protocol}://{ip}:{port}", protocol, ip, port)
+                        for protocol, ip, port in zip(protocols, ips, ports)]
+            else:
+                if self.url is None or any(not self._url_key_used(row) for row in rows):
+                    return None
+                url_strs = [row[self.url] for row in rows]
+                matches = _all_match(_URL_LINES_RE, url_strs)
+                if matches is None:
+                    return None
+                ports = [int(port) for _, _, port in matches]
+                urls = [URL._from_parts(url_str, protocol or None, ip, port)
+                        for url_str, (protocol, ip, _), port in zip(url_strs, matches, ports)]
+        except (KeyError, TypeError, ValueError):
+            return None
+        if min(ports) <= 0 or max(ports) >= 65536:
+            return None
+
+        countries = _column(rows, self.country, _COUNTRY_KEYS, _find_country)
+        anonymities = _column(rows, self.anonymity, _ANONYMITY_KEYS, _find_anonymity)
+        return [{"url": url, "country": country, "anonymity": anonymity}
+                for url, country, anonymity in zip(urls, countries, anonymities)]
+
+    def parse(self, row: dict) -> ProxyDict:
+        url = self._url(row)
+        if url is None:
+            return _convert_to_proxy_dict(row)  # does not fit the schema, take the slow path for this row
+
+        return ProxyDict(url=url, country=_field(row, self.country, _COUNTRY_KEYS, _find_country),
+                         anonymity=_field(row, self.anonymity, _ANONYMITY_KEYS, _find_anonymity))
+
+    def _url_key_used(self, row: dict) -> bool:
+        """Whether _convert_to_proxy_dict takes the url of row from the key the schema found."""
+        if row.get("protocol") and row.get("ip") and row.get("port"):
+            return False
+        return self.url != "proxy" or not row.get("url")
+
+    def _url(self, row: dict) -> Optional[URL]:
+        if self.parts:
+            protocol, ip, port = row.get("protocol"), row.get("ip"), row.get("port")
+            if not (protocol and ip and port) or protocol not in _PROTOCOLS or not _IP_RE.fullmatch(str(ip)):
+                return None
+            try:
+                port = int(port)
+            except (TypeError, ValueError):
+                return None
+            if not 0 < port < 65536:
+                return None
+            return URL._from_parts(f"{protocol}://{ip}:{port}", protocol, str(ip), port)
+
+        if self.url is None or not self._url_key_used(row):
+            return None
+        url_str = row.get(self.url)
+        if not isinstance(url_str, str):
+            return None
+        return _match_url(url_str)
+
+
+def _match_url(url_str: str) -> Optional[URL]:
+    match = _URL_RE.fullmatch(url_str)
+    if match is None:
+        return None
+    protocol, ip, port = match.groups()
+    port = int(port)
+    if not 0 < port < 65536:
+        return None
+    return URL._from_parts(url_str, protocol, ip, port)
+
+
+_schemas: Dict[str, _Schema] = {}
+
+
+@contextmanager
+def _gc_paused():
+    """
+    Pauses the cyclic garbage collector. Building hundreds of thousands of small objects
+    otherwise triggers full collections over all of them, which can take longer than the parsing itself.
+
+    Only on the main thread: the switch is process wide, so a parse in an executor thread
+    would turn it off for the event loop too, and two of them would race on turning it back on.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def parse_records(rows: Union[List[dict], dict], source: Optional[str] = None) -> List[ProxyDict]:
+    """
+    Converts decoded JSON rows into ProxyDicts, with the same results as convert_to_proxy_dict_format.
+
+    Where url, country and anonymity are is worked out once from the first rows
+    and remembered per source, instead of searching every nested dict of every row.
+    Rows that don't fit are converted the slow way.
+
+    Args:
+        rows: List of proxy dicts, or a dict with them under "proxies"
+        source: Name of the source, usually its URL, to remember the schema for
+
+    Returns:
+        List of proxy dictionaries
+
+    Raises:
+        ValueError: If a row has neither a url nor protocol, ip and port
+    """
+    if isinstance(rows, dict) and "proxies" in rows:
+        rows = rows["proxies"]
+    if not rows:
+        return []
+
+    schema = _schemas.get(source) if source is not None else None
+    if schema is None or schema._url(rows[0]) is None:
+        schema = _Schema(rows[:_SAMPLE_ROWS])
+        if source is not None:
+            if len(_schemas) >= _MAX_SCHEMAS:
+                _schemas.clear()
+            _schemas[source] = schema
+            logger.debug("Learned the row format of %s", source)
+    with _gc_paused():
+        return schema.parse_all(rows) or [schema.parse(row) for row in rows]
+
+
+def parse_text(text: str, default_protocol: str = "http") -> List[ProxyDict]:
+    """
+    Parses plain text lists with one "ip:port" or "protocol://ip:port" per line.
+    Lines that don't look like a proxy are skipped.
+
+    Args:
+        text: The list
+        default_protocol: Protocol of lines without one
+
+    Returns:
+        List of proxy dictionaries
+    """
+    proxies = []
+    with _gc_paused():
+        for protocol, ip, port in _LINE_RE.findall(text):
+            port_number = int(port)
+            if not 0 < port_number < 65536:
+                continue
+            protocol = protocol or default_protocol
+            url = URL._from_parts(f"{protocol}://{ip}:{port_number}", protocol, ip, port_number)
+            proxies.append({"url": url, "country": None, "anonymity": None})
+    return proxies
+
+
+def parse_proxy_list(payload: Union[str, bytes, list, dict], source: Optional[str] = None,
+                     default_protocol: str = "http") -> List[ProxyDict]:
+    """
+    Parses a proxy list in any supported format: JSON rows (see parse_records) or plain text lines (see parse_text).
+
+    Args:
+        payload: Response body, or already decoded JSON
+        source: Name of the source, usually its URL, to remember the JSON schema for
+        default_protocol: Protocol of plain text lines without one
+
+    Returns:
+        List of proxy dictionaries
+
+    Raises:
+        ValueError: If JSON rows can't be converted
+    """
+    if isinstance(payload, (list, dict)):
+        return parse_records(payload, source)
+
+    start = payload.lstrip()[:1]
+    if start in ("[", "{", b"[", b"{"):
+        return parse_records(orjson.loads(payload), source)
+    if isinstance(payload, bytes):
+        payload = payload.decode("utf-8", errors="replace")
+    return parse_text(payload, default_protocol)
+
+
+async def parse_proxy_list_async(payload: Union[str, bytes, list, dict], source: Optional[str] = None,
+                                 default_protocol: str = "http",
+                                 executor: Optional[Executor] = None,
+                                 offload_bytes: int = OFFLOAD_BYTES) -> List[ProxyDict]:
+    """
+    Like parse_proxy_list, but parses big payloads in an executor, so the event loop keeps running.
+
+    Args:
+        payload: Response body, or already decoded JSON
+        source: Name of the source, usually its URL, to remember the JSON schema for
+        default_protocol: Protocol of plain text lines without one
+        executor: Executor for big payloads, None uses the default thread pool.
+            A ProcessPoolExecutor also takes the work off the interpreter lock,
+            but schemas learned there are not remembered.
+        offload_bytes: Payloads shorter than this are parsed right away
+
+    Returns:
+        List of proxy dictionaries
+    """
+    if not isinstance(payload, (str, bytes)) or len(payload) < offload_bytes:
+        return parse_proxy_list(payload, source, default_protocol)
+
+    parse: Callable[[], List[ProxyDict]] = partial(parse_proxy_list, payload, source, default_protocol)
+    return await asyncio.get_running_loop().run_in_executor(executor, parse)
+
+
+__all__ = ['parse_records', 'parse_text', 'parse_proxy_list', 'parse_proxy_list_async', 'OFFLOAD_BYTES']
@@ -0,0 +1,444 @@
+from collections import OrderedDict, deque
+from heapq import heappush, heappop, heapify
+from random import randrange, random
+from typing import Dict, List, Optional, Tuple, Callable, Union, Deque
+
+from .utils import NoProxyAvailable
+
+
+class SelectionStrategy:
+    """
+    Picks proxies out of one pool of candidates.
+
+    DataManager keeps one strategy instance per preference combination and tells it about every change,
+    so each instance maintains its own structure incrementally and a pick never scans the pool.
+    """
+
+    name = "base"
+
+    def add(self, proxy_id: int, proxy: dict) -> None:
+        raise NotImplementedError
+
+    def remove(self, proxy_id: int) -> None:
+        raise NotImplementedError
+
+    def pick(self, avoid: Optional[int] = None) -> int:
+        """Returns the id of the next proxy. Never returns avoid, unless it is the only candidate."""
+        raise NotImplementedError
+
+    def on_in_flight(self, proxy_id: int, in_flight: int) -> None:
+        """Called when the number of unreleased leases of a proxy changed."""
+
+    def on_feedback(self, proxy_id: int, proxy: dict) -> None:
+        """Called after the counters of a proxy changed."""
+
+    def __contains__(self, proxy_id: int) -> bool:
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+
+class _DenseIds(SelectionStrategy):
+    """Keeps the ids in a dense list with swap-remove, so a uniformly random member costs O(1)."""
+
+    def __init__(self):
+        self._ids: List[int] = []
+        self._positions: Dict[int, int] = {}
+
+    def add(self, proxy_id: int, proxy: dict) -> None:
+        if proxy_id in self._positions:
+            return
+        self._positions[proxy_id] = len(self._ids)
+        self._ids.append(proxy_id)
+
+    def remove(self, proxy_id: int) -> None:
+        position = self._positions.pop(proxy_id, None)
+        if position is None:
+            return
+        last = self._ids.pop()
+        if last != proxy_id:
+            self._ids[position] = last
+            self._positions[last] = position
+
+    def _random_id(self, avoid: Optional[int]) -> int:
+        n = len(self._ids)
+        if not n:
+            raise NoProxyAvailable("No proxy found with the given parameters.")
+        position = randrange(n)
+        if n > 1 and self._ids[position] == avoid:
+            position = (position + randrange(1, n)) % n
+        return self._ids[position]
+
+    def __contains__(self, proxy_id: int) -> bool:
+        return proxy_id in self._positions
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+
+class RandomStrategy(_DenseIds):
+    """Uniformly random proxy, O(1)."""
+
+    name = "random"
+
+    def pick(self, avoid: Optional[int] = None) -> int:
+        return self._random_id(avoid)
+
+
+class RoundRobinStrategy(SelectionStrategy):
+    """Every proxy in turn. A rotating deque, removed proxies are skipped lazily. O(1) amortized."""
+
+    name = "round_robin"
+
+    def __init__(self):
+        self._queue: Deque[Tuple[int, int]] = deque()
+        self._members: Dict[int, int] = {}  # id -> generation of its live queue entry
+        self._generation = 0
+
+    def add(self, proxy_id: int, proxy: dict) -> None:
+        if proxy_id in self._members:
+            return
+        self._generation += 1
+        self._members[proxy_id] = self._generation
+        self._queue.append((proxy_id, self._generation))
+
+    def remove(self, proxy_id: int) -> None:
+        if self._members.pop(proxy_id, None) is not None and len(self._queue) > 2 * len(self._members) + 16:
+            self._queue = deque(entry for entry in self._queue if self._members.get(entry[0]) == entry[1])
+
+    def _next(self) -> int:
+        while self._queue:
+            entry = self._queue.popleft()
+            if self._members.get(entry[0]) == entry[1]:
+                self._queue.append(entry)
+                return entry[0]
+        raise NoProxyAvailable("No proxy found with the given parameters.")
+
+    def pick(self, avoid: Optional[int] = None) -> int:
+        proxy_id = self._next()
+        if proxy_id == avoid and len(self._members) > 1:
+            proxy_id = self._next()
+        return proxy_id
+
+    def __contains__(self, proxy_id: int) -> bool:
+        return proxy_id in self._members
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+
+class LeastRecentlyUsedStrategy(SelectionStrategy):
+    """The proxy that was picked longest ago, new proxies first. An ordered dict, O(1)."""
+
+    name = "lru"
+
+    def __init__(self):
+        self._order: OrderedDict[int, None] = OrderedDict()
+
+    def add(self, proxy_id: int, proxy: dict) -> None:
+        if proxy_id in self._order:
+            return
+        self._order[proxy_id] = None
+        self._order.move_to_end(proxy_id, last=False)
+
+    def remove(self, proxy_id: int) -> None:
+        self._order.pop(proxy_id, None)
+
+    def pick(self, avoid: Optional[int] = None) -> int:
+        if not self._order:
+            raise NoProxyAvailable("No proxy found with the given parameters.")
+        candidates = iter(self._order)
+        proxy_id = next(candidates)
+        if proxy_id == avoid and len(self._order) > 1:
+            proxy_id = next(candidates)
+        self._order.move_to_end(proxy_id)
+        return proxy_id
+
+    def __contains__(self, proxy_id: int) -> bool:
+        return proxy_id in self._order
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+
+class _ScoredHeap(SelectionStrategy):
+    """
+    The proxy with the lowest score, rotating among equal scores.
+    A heap with lazily dropped outdated entries, O(log n).
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, int]] = []  # (score, sequence, id)
+        self._proxies: Dict[int, dict] = {}
+        self._load: Dict[int, int] = {}
+        self._live: Dict[int, int] = {}  # id -> sequence of its only valid heap entry
+        self._sequence = 0
+
+    def score(self, proxy_id: int) -> float:
+        raise NotImplementedError
+
+    def _push(self, proxy_id: int) -> None:
+        self._sequence += 1
+        self._live[proxy_id] = self._sequence
+        heappush(self._heap, (self.score(proxy_id), self._sequence, proxy_id))
+        if len(self._heap) > 2 * len(self._live) + 16:
+            self._heap = [entry for entry in self._heap if self._live.get(entry[2]) == entry[1]]
+            heapify(self._heap)
+
+    def _pop_valid(self) -> Tuple[float, int, int]:
+        while self._heap:
+            entry = heappop(self._heap)
+            if self._live.get(entry[2]) == entry[1]:
+                return entry
+        raise NoProxyAvailable("No proxy found with the given parameters.")
+
+    def add(self, proxy_id: int, proxy: dict) -> None:
+        if proxy_id in self._live:
+            return
+        self._proxies[proxy_id] = proxy
+        self._load[proxy_id] = 0
+        self._push(proxy_id)
+
+    def remove(self, proxy_id: int) -> None:
+        self._proxies.pop(proxy_id, None)
+        self._load.pop(proxy_id, None)
+        self._live.pop(proxy_id, None)
+
+    def on_in_flight(self, proxy_id: int, in_flight: int) -> None:
+        if proxy_id in self._load and self._load[proxy_id] != in_flight:
+            self._load[proxy_id] = in_flight
+            self._push(proxy_id)
+
+    def pick(self, avoid: Optional[int] = None) -> int:
+        # Every id has exactly one valid heap entry, outdated ones are dropped on the way.
+        entry = self._pop_valid()
+        if entry[2] == avoid and len(self._live) > 1:
+            try:
+                other = self._pop_valid()
+            except NoProxyAvailable:
+                other = None
+            if other is not None:
+                heappush(self._heap, entry)
+                entry = other
+        self._push(entry[2])  # back behind the others with the same score
+        return entry[2]
+
+    def __contains__(self, proxy_id: int) -> bool:
+        return proxy_id in self._live
+
+    def __len__(self) -> int:
+        return len(self._live)
+
+
+class LeastInFlightStrategy(_ScoredHeap):
+    """The proxy with the fewest unreleased leases, rotating among equally loaded ones. O(log n)."""
+
+    name = "least_in_flight"
+
+    def score(self, proxy_id: int) -> float:
+        return self._load[proxy_id]
+
+
+def success_rate(proxy: dict) -> float:
+    """Laplace-smoothed success rate, new proxies start at 0.5."""
+    succeeded = proxy.get("times_succeed", 0)
+    return (succeeded + 1) / (succeeded + proxy.get("times_failed", 0) + 2)
+
+
+class WeightedStrategy(_DenseIds):
+    """
+    Random proxy with a probability proportional to its success rate.
+    A Fenwick tree over the dense id list, so picks and weight updates are O(log n).
+    """
+
+    name = "weighted"
+
+    def __init__(self, weight: Callable[[dict], float] = success_rate):
+        super().__init__()
+        self.weight = weight
+        self._weights: List[float] = []
+        self._tree: List[float] = [0.0]  # 1-based Fenwick tree, len - 1 is its capacity
+
+    def _rebuild(self, capacity: int) -> None:
+        tree = [0.0] + self._weights + [0.0] * (capacity - len(self._weights))
+        for i in range(1, capacity + 1):
+            parent = i + (i & -i)
+            if parent <= capacity:
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _update(self, position: int, delta: float) -> None:
+        i = position + 1
+        capacity = len(self._tree) - 1
+        while i <= capacity:
+            self._tree[i] += delta
+            i += i & -i
+
+    def _set_weight(self, position: int, weight: float) -> None:
+        self._update(position, weight - self._weights[position])
+        self._weights[position] = weight
+
+    def add(self, proxy_id: int, proxy: dict) -> None:
+        if proxy_id in self._positions:
+            return
+        super().add(proxy_id, proxy)
+        self._weights.append(self.weight(proxy))
+        if len(self._weights) > len(self._tree) - 1:
+            self._rebuild(max(16, 2 * (len(self._tree) - 1)))  # also clears accumulated float error
+        else:
+            self._update(len(self._weights) - 1, self._weights[-1])
+
+    def remove(self, proxy_id: int) -> None:
+        position = self._positions.get(proxy_id)
+        if position is None:
+            return
+        last = len(self._ids) - 1
+        if position != last:
+            self._set_weight(position, self._weights[last])
+        self._set_weight(last, 0.0)
+        self._weights.pop()
+        super().remove(proxy_id)
+
+    def on_feedback(self, proxy_id: int, proxy: dict) -> None:
+        position = self._positions.get(proxy_id)
+        if position is not None:
+            self._set_weight(position, self.weight(proxy))
+
+    def _find(self, target: float) -> int:
+        """Smallest position whose prefix sum exceeds target."""
+        position = 0
+        step = 1 << (len(self._tree) - 1).bit_length()
+        while step:
+            nxt = position + step
+            if nxt < len(self._tree) and self._tree[nxt] <= target:
+                position = nxt
+                target -= self._tree[nxt]
+            step >>= 1
+        return min(position, len(self._ids) - 1)
+
+    def pick(self, avoid: Optional[int] = None) -> int:
+        if not self._ids:
+            raise NoProxyAvailable("No proxy found with the given parameters.")
+        avoid_position = self._positions.get(avoid) if len(self._ids) > 1 else None
+        if avoid_position is not None:
+            avoided_weight = self._weights[avoid_position]
+            self._set_weight(avoid_position, 0.0)
+        try:
+            position = self._find(random() * self._tree_total())
+            if position == avoid_position:  # float rounding at the edge
+                position = (position + 1) % len(self._ids)
+        finally:
+            if avoid_position is not None:
+                self._set_weight(avoid_position, avoided_weight)
+        return self._ids[position]
+
+    def _tree_total(self) -> float:
+        total = 0.0
+        i = len(self._tree) - 1
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+
+def expected_latency(proxy: dict, in_flight: int = 0, default_latency: float = 1.0) -> float:
+    """
+    Expected seconds until a proxy delivers a successful response:
+    its average latency, stretched by its recent error rate and by the requests already running through it.
+    Proxies without latency samples count as default_latency.
+    """
+    latency = proxy.get("latency")
+    if latency is None:
+        latency = default_latency
+    error_score = min(proxy.get("error_score") or 0.0, 0.95)
+    return latency / (1 - error_score) * (1 + in_flight)
+
+
+class PowerOfTwoChoicesStrategy(_DenseIds):
+    """
+    The proxy with the lower expected latency out of two random ones, O(1).
+    Almost as good as always taking the fastest, but spreads the load without any global ordering.
+    """
+
+    name = "p2c"
+
+    def __init__(self, default_latency: float = 1.0):
+        super().__init__()
+        self.default_latency = default_latency
+        self._proxies: Dict[int, dict] = {}
+        self._load: Dict[int, int] = {}
+
+    def add(self, proxy_id: int, proxy: dict) -> None:
+        super().add(proxy_id, proxy)
+        self._proxies[proxy_id] = proxy
+
+    def remove(self, proxy_id: int) -> None:
+        super().remove(proxy_id)
+        self._proxies.pop(proxy_id, None)
+        self._load.pop(proxy_id, None)
+
+    def on_in_flight(self, proxy_id: int, in_flight: int) -> None:
+        if proxy_id in self._proxies:
+            self._load[proxy_id] = in_flight
+
+    def _expected(self, proxy_id: int) -> float:
+        return expected_latency(self._proxies[proxy_id], self._load.get(proxy_id, 0), self.default_latency)
+
+    def pick(self, avoid: Optional[int] = None) -> int:
+        n = len(self._ids)
+        if n < 3:
+            return self._random_id(avoid)
+        first = randrange(n)
+        second = (first + randrange(1, n)) % n
+        a, b = self._ids[first], self._ids[second]
+        if a == avoid:
+            return b
+        if b == avoid:
+            return a
+        return a if self._expected(a) <= self._expected(b) else b
+
+
+class LowestLatencyStrategy(_ScoredHeap):
+    """
+    The proxy with the lowest expected latency, see expected_latency. O(log n).
+    Running leases count into the expectation, so with acquire() the load spreads over the fastest proxies.
+    """
+
+    name = "fastest"
+
+    def __init__(self, default_latency: float = 1.0):
+        super().__init__()
+        self.default_latency = default_latency
+
+    def score(self, proxy_id: int) -> float:
+        return expected_latency(self._proxies[proxy_id], self._load[proxy_id], self.default_latency)
+
+    def on_feedback(self, proxy_id: int, proxy: dict) -> None:
+        if proxy_id in self._live:
+            self._push(proxy_id)
+
+
+STRATEGIES: Dict[str, Callable[[], SelectionStrategy]] = {
+    RandomStrategy.name: RandomStrategy,
+    RoundRobinStrategy.name: RoundRobinStrategy,
+    LeastRecentlyUsedStrategy.name: LeastRecentlyUsedStrategy,
+    LeastInFlightStrategy.name: LeastInFlightStrategy,
+    WeightedStrategy.name: WeightedStrategy,
+    PowerOfTwoChoicesStrategy.name: PowerOfTwoChoicesStrategy,
+    LowestLatencyStrategy.name: LowestLatencyStrategy,
+}
+
+
+def get_strategy_factory(selection: Union[str, Callable[[], SelectionStrategy]]) -> Callable[[], SelectionStrategy]:
+    if callable(selection):
+        return selection
+    try:
+        return STRATEGIES[selection]
+    except KeyError:
+        raise ValueError(f"Invalid selection strategy: {selection}. Choose one of {', '.join(STRATEGIES)}")
+
+
+__all__ = ['SelectionStrategy', 'RandomStrategy', 'RoundRobinStrategy', 'LeastRecentlyUsedStrategy',
+           'LeastInFlightStrategy', 'WeightedStrategy', 'PowerOfTwoChoicesStrategy', 'LowestLatencyStrategy',
+           'STRATEGIES', 'get_strategy_factory', 'success_rate', 'expected_latency']
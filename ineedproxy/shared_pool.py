@@ -0,0 +1,308 @@
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Union, TYPE_CHECKING
+import asyncio
+import itertools
+import os
+
+import msgpack
+
+from .lease import ProxyLease
+from .utils import ProxyDict, NoProxyAvailable, URL
+from .logger import logger
+
+if TYPE_CHECKING:
+    from .manager import Manager
+
+# Messages are msgpack arrays written back to back on the socket.
+# Request:  [id, op, args]      id 0 means no response is expected (release)
+# Response: [id, error, result]  error is None or [type name, message]
+ACQUIRE = "acquire"  # args: [preferences, ignore_preferences, fetch]  result: [lease no, url, protocol, pool size]
+RELEASE = "release"  # args: [lease no, success or None, latency]     no response
+ADD = "add"  # args: [[url, country, anonymity], ...], test                result: number of proxies stored
+FETCH = "fetch"  # args: []                                              result: number of proxies stored
+STATS = "stats"  # args: []                                              result: Manager.stats() of the server
+
+_READ_SIZE = 64 * 1024
+
+
+class SharedPoolError(Exception):
+    """The pool server failed a request or the connection to it broke."""
+
+
+def _pack(message: list) -> bytes:
+    return msgpack.packb(message, use_bin_type=True)
+
+
+def _proxy_row(proxy: ProxyDict) -> list:
+    return [str(proxy["url"]), proxy.get("country"), proxy.get("anonymity")]
+
+
+def _proxy_from_row(row: list) -> ProxyDict:
+    url, country, anonymity = row
+    return ProxyDict(url=URL(url), country=country, anonymity=anonymity)
+
+
+class PoolServer:
+    def __init__(self, manager: "Manager", path: Union[str, Path]):
+        """
+        Shares the proxy pool of one Manager with other processes over a Unix domain socket.
+
+        The serving process owns the pool: it fetches, tests and health checks proxies and is the only one
+        writing the data file. Managers created with shared_pool=path lease proxies from it,
+        and their feedback counts as if their requests were made by the owner.
+        Leases of a client that disconnects are given back without feedback.
+
+        The socket is created with the permissions of the umask, anyone who can open it can use the pool.
+
+        :param manager: The Manager whose pool is shared.
+        :param path: Path of the socket file. A stale file left by a crashed server is replaced,
+        start() raises SharedPoolError if a live server listens on it.
+        """
+        self.manager = manager
+        self.path = Path(path)
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Dict[asyncio.StreamWriter, Dict[int, ProxyLease]] = {}
+        self._lease_numbers = itertools.count(1)
+
+    async def start(self) -> "PoolServer":
+        if os.name != "posix":
+            raise OSError("Sharing a pool needs Unix domain sockets")
+        try:
+            _, writer = await asyncio.open_unix_connection(str(self.path))
+        except (ConnectionRefusedError, FileNotFoundError):
+            self.path.unlink(missing_ok=True)  # a stale file left by a crashed server, or none at all
+        else:
+            writer.close()
+            raise SharedPoolError(f"Another pool server is already serving on {self.path}")
+        self._server = await asyncio.start_unix_server(self._serve, path=str(self.path))
+        logger.debug("Serving the proxy pool on %s", self.path)
+        return self
+
+    async def close(self) -> None:
+        """Stops accepting clients, drops the connected ones and gives back their leases."""
+        if self._server is None:
+            return
+        self._server.close()
+        for writer in list(self._connections):
+            writer.close()
+        await self._server.wait_closed()
+        self._server = None
+        if self.path.exists():
+            self.path.unlink()
+
+    async def __aenter__(self) -> "PoolServer":
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.close()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        leases: Dict[int, ProxyLease] = {}
+        self._connections[writer] = leases
+        unpacker = msgpack.Unpacker(raw=False)
+        tasks = set()
+        try:
+            while data := await reader.read(_READ_SIZE):
+                unpacker.feed(data)
+                for message_id, op, args in unpacker:
+                    if op == RELEASE:
+                        self._release(leases, *args)
+                        continue
+                    # Handled concurrently, an acquire may wait for a fetch while others go on
+                    task = asyncio.create_task(self._respond(writer, leases, message_id, op, args))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        except (ConnectionError, ValueError, msgpack.UnpackException) as e:
+            logger.warning("Dropping pool client after a broken message: %s", e)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            del self._connections[writer]
+            for lease in leases.values():
+                lease.release()
+            writer.close()
+
+    async def _respond(self, writer: asyncio.StreamWriter, leases: Dict[int, ProxyLease],
+                       message_id: int, op: str, args: list) -> None:
+        try:
+            result, error = await self._handle(leases, op, args), None
+        except Exception as e:
+            result, error = None, [type(e).__name__, str(e)]
+        if not writer.is_closing():
+            writer.write(_pack([message_id, error, result]))
+
+    async def _handle(self, leases: Dict[int, ProxyLease], op: str, args: list) -> Any:
+        manager = self.manager
+        if op == ACQUIRE:
+            preferences, ignore_preferences, fetch = args
+            if fetch:
+                lease = await manager.acquire(ignore_preferences, **preferences)
+            else:
+                lease = manager.data_manager.acquire() if ignore_preferences \
+                    else manager.data_manager.acquire(**preferences)
+            lease_no = next(self._lease_numbers)
+            leases[lease_no] = lease
+            return [lease_no, lease.url, lease.proxy.get("protocol"), len(manager.data_manager)]
+        if op == ADD:
+            rows, test = args
+            proxies = [_proxy_from_row(row) for row in rows]
+            if test:
+                async def source() -> List[ProxyDict]:
+                    return proxies
+                await manager.fetch_proxies(fetching_method=[source])
+            else:
+                manager.data_manager.add_proxy(proxies)
+            return len(manager.data_manager)
+        if op == FETCH:
+            await manager._refill()
+            return len(manager.data_manager)
+        if op == STATS:
+            return manager.stats()
+        raise ValueError(f"Unknown operation: {op}")
+
+    @staticmethod
+    def _release(leases: Dict[int, ProxyLease], lease_no: int, success: Optional[bool],
+                 latency: Optional[float]) -> None:
+        lease = leases.pop(lease_no, None)
+        if lease is None:
+            return
+        if success is None:
+            lease.release()
+        elif success:
+            lease.success(latency)
+        else:
+            lease.failure(latency)
+
+
+class PoolClient:
+    def __init__(self, path: Union[str, Path]):
+        """
+        Connection to a PoolServer. Requests are multiplexed over one socket, so any number of tasks
+        can use it at once. Reconnects on the next request after the connection broke.
+
+        :param path: Path of the socket file of the server.
+        """
+        self.path = Path(path)
+        self.pool_size = 0  # size of the shared pool as of the last acquire or fetch
+        self._reader_task: Optional[asyncio.Task] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._abandoned: Set[int] = set()  # acquires whose caller was cancelled before the answer came
+        self._message_ids = itertools.count(1)
+        self._connecting: Optional[asyncio.Lock] = None
+
+    async def _connection(self) -> asyncio.StreamWriter:
+        if self._writer is not None and not self._writer.is_closing():
+            return self._writer
+        if self._connecting is None:
+            self._connecting = asyncio.Lock()
+        async with self._connecting:
+            if self._writer is None or self._writer.is_closing():
+                try:
+                    reader, self._writer = await asyncio.open_unix_connection(str(self.path))
+                except OSError as e:
+                    raise SharedPoolError(f"Can't connect to the pool server at {self.path}: {e}") from e
+                self._reader_task = asyncio.create_task(self._read(reader))
+        return self._writer
+
+    async def _read(self, reader: asyncio.StreamReader) -> None:
+        unpacker = msgpack.Unpacker(raw=False)
+        error: BaseException = SharedPoolError("Pool server closed the connection")
+        try:
+            while data := await reader.read(_READ_SIZE):
+                unpacker.feed(data)
+                for message_id, remote_error, result in unpacker:
+                    if message_id in self._abandoned:
+                        self._abandoned.discard(message_id)
+                        if remote_error is None:
+                            self._release(result[0], None, None)  # nobody got the lease, give it back
+                        continue
+                    future = self._pending.pop(message_id, None)
+                    if future is None or future.done():
+                        continue
+                    if remote_error is None:
+                        future.set_result(result)
+                    elif remote_error[0] == NoProxyAvailable.__name__:
+                        future.set_exception(NoProxyAvailable(remote_error[1]))
+                    else:
+                        future.set_exception(SharedPoolError(f"{remote_error[0]}: {remote_error[1]}"))
+        except (ConnectionError, ValueError, msgpack.UnpackException) as e:
+            error = SharedPoolError(f"Connection to the pool server broke: {e}")
+        finally:
+            if self._writer is not None:
+                self._writer.close()
+            pending, self._pending = self._pending, {}
+            self._abandoned.clear()  # the server gave their leases back when the connection dropped
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(error)
+
+    async def _call(self, op: str, *args: Any) -> Any:
+        writer = await self._connection()
+        message_id = next(self._message_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[message_id] = future
+        writer.write(_pack([message_id, op, list(args)]))
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if op == ACQUIRE:
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    self._release(future.result()[0], None, None)  # answered, but the caller is gone
+                elif message_id in self._pending:
+                    self._abandoned.add(message_id)
+            raise
+        finally:
+            self._pending.pop(message_id, None)
+
+    async def acquire(self, ignore_preferences: bool = False, fetch: bool = True, **preferences) -> ProxyLease:
+        """
+        Leases a proxy of the shared pool. Report the outcome on the lease like on a local one.
+
+        :param fetch: Let the server fetch more proxies when none matches, like Manager.acquire.
+        False only takes what is there, raising NoProxyAvailable otherwise.
+        """
+        lease_no, url, protocol, self.pool_size = await self._call(ACQUIRE, preferences, ignore_preferences, fetch)
+        return ProxyLease(self, lease_no, {"url": url, "protocol": protocol})
+
+    def release(self, lease: ProxyLease, success: Optional[bool]) -> None:
+        """Sends the outcome of a lease to the server without waiting, called by the lease itself."""
+        self._release(lease.proxy_id, success, lease.latency)
+
+    def _release(self, lease_no: int, success: Optional[bool], latency: Optional[float]) -> None:
+        if self._writer is None or self._writer.is_closing():
+            return  # the server gave the lease back when the connection dropped
+        self._writer.write(_pack([0, RELEASE, [lease_no, success, latency]]))
+
+    async def add_proxy(self, proxies: List[ProxyDict], test: bool = True) -> int:
+        """
+        Hands proxies to the server, which tests them unless test is False and stores the working ones.
+        :return: Size of the shared pool afterwards.
+        """
+        self.pool_size = await self._call(ADD, [_proxy_row(proxy) for proxy in proxies], test)
+        return self.pool_size
+
+    async def fetch(self) -> int:
+        """
+        Lets the server fetch more proxies with its own fetching methods.
+        Clients asking at the same time share one fetch.
+        :return: Size of the shared pool afterwards.
+        """
+        self.pool_size = await self._call(FETCH)
+        return self.pool_size
+
+    async def stats(self) -> Dict[str, Any]:
+        """Manager.stats() of the server, covering the requests of all clients."""
+        return await self._call(STATS)
+
+    async def aclose(self) -> None:
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.close()
+        if self._reader_task is not None:
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+            self._reader_task = None
+
+
+__all__ = ['PoolServer', 'PoolClient', 'SharedPoolError']
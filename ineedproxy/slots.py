@@ -0,0 +1,78 @@
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+class ProxySlots:
+    """
+    Slot storage for proxy records with stable ids.
+
+    Every record lives in a slot of a list and its id is the slot number.
+    Removed slots go on a free-list and get reused by later additions,
+    so removing a proxy is O(1) and never shifts the id of any other proxy.
+    """
+
+    def __init__(self):
+        self._slots: List[Optional[Dict[str, Any]]] = []
+        self._free: List[int] = []
+        self._count = 0
+
+    def add(self, proxy: Dict[str, Any]) -> int:
+        """Stores a record and returns its id."""
+        if self._free:
+            proxy_id = self._free.pop()
+            self._slots[proxy_id] = proxy
+        else:
+            proxy_id = len(self._slots)
+            self._slots.append(proxy)
+        self._count += 1
+        return proxy_id
+
+    def remove(self, proxy_id: int) -> Dict[str, Any]:
+        """Empties the slot of a record and returns the record."""
+        proxy = self.get(proxy_id)
+        if proxy is None:
+            raise IndexError("Proxy does not exist")
+        self._slots[proxy_id] = None
+        self._free.append(proxy_id)
+        self._count -= 1
+        return proxy
+
+    def get(self, proxy_id: int) -> Optional[Dict[str, Any]]:
+        if 0 <= proxy_id < len(self._slots):
+            return self._slots[proxy_id]
+        return None
+
+    def clear(self) -> None:
+        self._slots.clear()
+        self._free.clear()
+        self._count = 0
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """
+        Copies all records.
+        Safe to call from another thread, the slot list and every record are each copied in one step under the GIL.
+        """
+        return [dict(proxy) for proxy in list(self._slots) if proxy is not None]
+
+    def ids(self) -> Iterator[int]:
+        return (i for i, proxy in enumerate(self._slots) if proxy is not None)
+
+    def values(self) -> Iterator[Dict[str, Any]]:
+        return (proxy for proxy in self._slots if proxy is not None)
+
+    def items(self) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        return ((i, proxy) for i, proxy in enumerate(self._slots) if proxy is not None)
+
+    def __getitem__(self, proxy_id: int) -> Dict[str, Any]:
+        proxy = self.get(proxy_id)
+        if proxy is None:
+            raise IndexError("Proxy does not exist")
+        return proxy
+
+    def __contains__(self, proxy_id: int) -> bool:
+        return self.get(proxy_id) is not None
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return self.values()
+
+    def __len__(self) -> int:
+        return self._count
@@ -0,0 +1,198 @@
+from ipaddress import IPv4Address, IPv6Address, ip_address
+from typing import Any, List, Optional, Tuple, Type, Union
+import asyncio
+import socket
+
+import aiohttp
+from aiohttp.abc import AbstractResolver
+
+from .utils import URL, _host_and_port
+
+try:  # optional, more complete implementation (authentication, proxy chains)
+    from aiohttp_socks import ProxyConnector, ProxyConnectionError, ProxyError, ProxyTimeoutError
+except ImportError:
+    ProxyConnector = None
+
+SOCKS_PROTOCOLS: Tuple[str, ...] = ('socks4', 'socks5')
+
+
+class SocksError(OSError):
+    """The SOCKS proxy refused the connection or answered with something that is not SOCKS."""
+
+
+async def _recv_exactly(loop: asyncio.AbstractEventLoop, sock: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = await loop.sock_recv(sock, size - len(data))
+        if not chunk:
+            raise SocksError("Proxy closed the connection during the handshake")
+        data += chunk
+    return data
+
+
+def _parse_ip(host: str) -> Optional[Union[IPv4Address, IPv6Address]]:
+    try:
+        return ip_address(host)
+    except ValueError:
+        return None
+
+
+async def _socks4(loop: asyncio.AbstractEventLoop, sock: socket.socket, host: str, port: int) -> None:
+    ip = _parse_ip(host)
+    if isinstance(ip, IPv6Address):
+        raise SocksError("SOCKS4 does not support IPv6 destinations")
+    if ip is None:  # SOCKS4a, the proxy resolves the name
+        request = b"\x04\x01" + port.to_bytes(2, "big") + b"\x00\x00\x00\x01" + b"\x00" + host.encode("idna") + b"\x00"
+    else:
+        request = b"\x04\x01" + port.to_bytes(2, "big") + ip.packed + b"\x00"
+    await loop.sock_sendall(sock, request)
+    reply = await _recv_exactly(loop, sock, 8)
+    if reply[0] != 0:
+        raise SocksError("Invalid SOCKS4 reply")
+    if reply[1] != 0x5A:
+        raise SocksError(f"SOCKS4 proxy rejected the connection (code {reply[1]})")
+
+
+async def _socks5(loop: asyncio.AbstractEventLoop, sock: socket.socket, host: str, port: int) -> None:
+    await loop.sock_sendall(sock, b"\x05\x01\x00")  # version 5, one method: no authentication
+    reply = await _recv_exactly(loop, sock, 2)
+    if reply[0] != 5:
+        raise SocksError("Invalid SOCKS5 reply")
+    if reply[1] != 0:
+        raise SocksError("SOCKS5 proxy requires authentication")
+
+    ip = _parse_ip(host)
+    if ip is None:  # the proxy resolves the name
+        name = host.encode("idna")
+        address = b"\x03" + len(name).to_bytes(1, "big") + name
+    else:
+        address = (b"\x01" if ip.version == 4 else b"\x04") + ip.packed
+    await loop.sock_sendall(sock, b"\x05\x01\x00" + address + port.to_bytes(2, "big"))
+
+    version, code, _, address_type = await _recv_exactly(loop, sock, 4)
+    if version != 5:
+        raise SocksError("Invalid SOCKS5 reply")
+    if code != 0:
+        raise SocksError(f"SOCKS5 proxy rejected the connection (code {code})")
+    if address_type == 1:
+        size = 4
+    elif address_type == 4:
+        size = 16
+    elif address_type == 3:
+        size = (await _recv_exactly(loop, sock, 1))[0]
+    else:
+        raise SocksError("Invalid SOCKS5 reply")
+    await _recv_exactly(loop, sock, size + 2)  # bound address and port, not needed
+
+
+async def socks_connect(proxy: Union[str, URL], host: str, port: int) -> socket.socket:
+    """
+    Opens a connection to host:port through a SOCKS4 or SOCKS5 proxy without authentication.
+    Host names are resolved by the proxy (SOCKS4a / SOCKS5 domain addresses).
+
+    Returns:
+        The connected non-blocking socket, ready to be used as if it was connected to host:port
+
+    Raises:
+        SocksError: If the proxy refused the connection
+        OSError: If the proxy can't be reached
+    """
+    proxy = URL(proxy)
+    if proxy.protocol not in SOCKS_PROTOCOLS:
+        raise ValueError(f"Not a SOCKS proxy: {proxy}")
+    proxy_host, proxy_port = _host_and_port(proxy)
+    if not proxy_host or not proxy_port:
+        raise ValueError(f"Proxy without host or port: {proxy}")
+
+    loop = asyncio.get_running_loop()
+    family, type_, proto, _, address = (await loop.getaddrinfo(proxy_host, proxy_port, type=socket.SOCK_STREAM))[0]
+    sock = socket.socket(family, type_, proto)
+    sock.setblocking(False)
+    try:
+        await loop.sock_connect(sock, address)
+        if proxy.protocol == "socks5":
+            await _socks5(loop, sock, host, port)
+        else:
+            await _socks4(loop, sock, host, port)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+class _NoResolver(AbstractResolver):
+    """Hands host names through unresolved, the proxy resolves them."""
+
+    async def resolve(self, host: str, port: int = 0, family: socket.AddressFamily = socket.AF_INET) -> List[dict]:
+        return [{"hostname": host, "host": host, "port": port, "family": family, "proto": 0, "flags": 0}]
+
+    async def close(self) -> None:
+        pass
+
+
+class SocksConnector(aiohttp.TCPConnector):
+    def __init__(self, proxy: Union[str, URL], **kwargs: Any):
+        """
+        A minimal connector sending every connection of a session through one SOCKS4 or SOCKS5 proxy.
+        Used when aiohttp_socks is not installed.
+
+        :param proxy: URL of the proxy, like "socks5://1.2.3.4:1080".
+        :param kwargs: Passed on to aiohttp.TCPConnector.
+        """
+        kwargs.setdefault("resolver", _NoResolver())
+        super().__init__(**kwargs)
+        self.proxy = URL(proxy)
+
+    async def _wrap_create_connection(self, *args: Any, req: aiohttp.ClientRequest, timeout: aiohttp.ClientTimeout,
+                                      client_error: Type[Exception] = aiohttp.ClientConnectorError,
+                                      **kwargs: Any) -> Tuple[asyncio.Transport, Any]:
+        kwargs.pop("addr_infos", None)  # locally resolved addresses of the target, the proxy connects instead
+        try:
+            sock = await asyncio.wait_for(socks_connect(self.proxy, req.host, req.port),
+                                          timeout.sock_connect or timeout.total)
+            try:
+                return await self._loop.create_connection(*args, **kwargs, sock=sock)
+            except BaseException:
+                sock.close()
+                raise
+        except OSError as e:
+            if e.errno is None and isinstance(e, asyncio.TimeoutError):
+                raise
+            raise client_error(req.connection_key, e) from e
+
+
+if ProxyConnector is not None:
+    class _LibraryConnector(ProxyConnector):
+        """
+        aiohttp_socks.ProxyConnector raising the errors of aiohttp, so a dead SOCKS proxy fails an attempt
+        like a dead HTTP proxy instead of escaping the retry loops.
+        """
+
+        async def _wrap_create_connection(self, *args: Any, req: aiohttp.ClientRequest,
+                                          client_error: Type[Exception] = aiohttp.ClientConnectorError,
+                                          **kwargs: Any) -> Tuple[asyncio.Transport, Any]:
+            try:
+                return await super()._wrap_create_connection(*args, req=req, client_error=client_error, **kwargs)
+            except ProxyTimeoutError as e:
+                raise asyncio.TimeoutError(str(e)) from e
+            except (ProxyConnectionError, ProxyError) as e:
+                raise client_error(req.connection_key, SocksError(str(e))) from e
+            except OSError as e:  # a proxy hanging up during the handshake
+                if isinstance(e, asyncio.TimeoutError):
+                    raise
+                raise client_error(req.connection_key, e) from e
+else:
+    _LibraryConnector = None
+
+
+def socks_connector(proxy: Union[str, URL], **kwargs: Any) -> aiohttp.BaseConnector:
+    """
+    A connector that sends every connection through the given SOCKS proxy.
+    Uses aiohttp_socks when it is installed, the built-in SocksConnector otherwise.
+    """
+    if _LibraryConnector is not None:
+        return _LibraryConnector.from_url(str(proxy), rdns=True, **kwargs)
+    return SocksConnector(proxy, **kwargs)
+
+
+__all__ = ['SOCKS_PROTOCOLS', 'SocksError', 'SocksConnector', 'socks_connect', 'socks_connector']
@@ -0,0 +1,105 @@
+from contextvars import ContextVar
+from hashlib import sha1
+from pathlib import Path
+from typing import Dict, List, Optional, Any
+import asyncio
+import time
+
+import msgpack
+
+from .file_ops import read_msgpack, write_msgpack
+from .utils import ProxyDict, URL
+from .logger import logger
+
+
+class _Entry:
+    __slots__ = ("proxies", "etag", "last_modified", "fetched_at")
+
+    def __init__(self, proxies: List[ProxyDict], etag: Optional[str], last_modified: Optional[str],
+                 fetched_at: float):
+        self.proxies = proxies
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at  # monotonic time of the last download or 304, 0 if loaded from disk
+
+
+class SourceCache:
+    def __init__(self, directory: Optional[Path] = None, min_refresh_interval: float = 300):
+        """
+        Remembers the parsed proxy list of every source together with its ETag and Last-Modified header.
+
+        Within min_refresh_interval after a download the remembered list is returned without any request.
+        After that the source is asked with If-None-Match/If-Modified-Since,
+        and a 304 answer reuses the list instead of downloading and parsing it again.
+
+        :param directory: Where to keep the lists between runs, one msgpack file per source.
+        None keeps them in memory only.
+        :param min_refresh_interval: Seconds a source is not asked again after it was fetched.
+        """
+        self.directory = Path(directory) if directory is not None else None
+        self.min_refresh_interval = min_refresh_interval
+        self._entries: Dict[str, _Entry] = {}
+        self._loaded: set = set()
+
+    def _file(self, url: str) -> Path:
+        return self.directory / f"{sha1(url.encode()).hexdigest()}.msgpack"
+
+    async def get(self, url: str) -> Optional[_Entry]:
+        """The remembered list of url, read from disk in an executor the first time."""
+        if url not in self._loaded and self.directory is not None:
+            self._loaded.add(url)
+            entry = await asyncio.get_running_loop().run_in_executor(None, self._read, url)
+            if entry is not None and url not in self._entries:
+                self._entries[url] = entry
+        return self._entries.get(url)
+
+    def is_fresh(self, entry: _Entry, min_refresh_interval: Optional[float] = None) -> bool:
+        interval = self.min_refresh_interval if min_refresh_interval is None else min_refresh_interval
+        return entry.fetched_at > 0 and time.monotonic() - entry.fetched_at < interval
+
+    def touch(self, entry: _Entry) -> None:
+        """Marks the list as just confirmed by the source, after a 304."""
+        entry.fetched_at = time.monotonic()
+
+    async def put(self, url: str, proxies: List[ProxyDict], etag: Optional[str], last_modified: Optional[str]) -> None:
+        """Remembers a freshly downloaded list. Written to disk in an executor when a directory is set."""
+        entry = _Entry(proxies, etag, last_modified, time.monotonic())
+        self._entries[url] = entry
+        self._loaded.add(url)
+        if self.directory is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, url, entry)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._loaded.clear()
+
+    def _read(self, url: str) -> Optional[_Entry]:
+        file = self._file(url)
+        if not file.exists():
+            return None
+        try:
+            data: Dict[str, Any] = read_msgpack(file)
+            proxies = [ProxyDict(url=URL._from_parts(url_str, protocol, ip, port), country=country, anonymity=anonymity)
+                       for url_str, protocol, ip, port, country, anonymity in data["proxies"]]
+            return _Entry(proxies, data.get("etag"), data.get("last_modified"), 0)
+        except (msgpack.UnpackException, ValueError, KeyError, TypeError) as e:
+            logger.warning("Ignoring broken source cache file %s: %s", file, e)
+            return None
+
+    def _write(self, url: str, entry: _Entry) -> None:
+        rows = []
+        for proxy in entry.proxies:
+            proxy_url = URL(proxy["url"])
+            rows.append([proxy_url.url, proxy_url.protocol, proxy_url.ip, proxy_url.port,
+                         proxy.get("country"), proxy.get("anonymity")])
+        try:
+            write_msgpack(self._file(url), {"url": url, "etag": entry.etag, "last_modified": entry.last_modified,
+                                            "proxies": rows})
+        except OSError as e:
+            logger.warning("Failed to write source cache for %s: %s", url, e)
+
+
+# Source cache of the Manager that is currently fetching, used by fetch_json_proxy_list and fetch_proxy_list.
+current_source_cache: ContextVar[Optional[SourceCache]] = ContextVar("current_source_cache", default=None)
+
+__all__ = ['SourceCache', 'current_source_cache']
@@ -0,0 +1,244 @@
+from pathlib import Path
+from typing import Callable, List, Dict, Any, Optional
+import asyncio
+import os
+import threading
+import time
+
+import msgpack
+
+from .file_ops import read_msgpack, write_msgpack, append_msgpack_records, read_msgpack_records
+from .metrics import Metrics
+from .logger import logger
+
+# Journal record types. Every record sets absolute values, so replaying a record twice is harmless.
+ADD = "a"  # ["a", proxy]
+REMOVE = "r"  # ["r", url]
+UPDATE = "u"  # ["u", url, {field: value}]
+CLEAR = "c"  # ["c"]
+
+
+def _replay(proxies: List[Dict[str, Any]], records: List[list]) -> List[Dict[str, Any]]:
+    by_url = {proxy["url"]: proxy for proxy in proxies}
+    for record in records:
+        try:
+            kind = record[0]
+            if kind == ADD:
+                by_url[record[1]["url"]] = record[1]
+            elif kind == REMOVE:
+                by_url.pop(record[1], None)
+            elif kind == UPDATE:
+                proxy = by_url.get(record[1])
+                if proxy is not None:
+                    proxy.update(record[2])
+            elif kind == CLEAR:
+                by_url.clear()
+            else:
+                logger.warning("Skipping unknown journal record type: %s", kind)
+        except (IndexError, KeyError, TypeError):
+            logger.warning("Skipping malformed journal record: %s", record)
+    return list(by_url.values())
+
+
+class ProxyStore:
+    def __init__(self, file: Optional[Path],
+                 snapshot: Callable[[], List[Dict[str, Any]]],
+                 flush_interval: Optional[float] = None,
+                 flush_threshold: int = 100,
+                 journal: bool = False,
+                 compact_ratio: float = 2.0,
+                 compact_min_bytes: int = 64 * 1024,
+                 metrics: Optional[Metrics] = None):
+        """
+        Persists the proxy pool to a msgpack file.
+
+        Without a flush_interval every change is written through right away.
+        With one, changes only mark the store dirty and a background thread writes the file
+        once the interval has passed or flush_threshold changes piled up, so the event loop never waits on disk.
+
+        With journal enabled, changes are appended as small records to "<file>.journal" next to the snapshot
+        instead of rewriting the whole snapshot, so a change costs the same no matter how big the pool is.
+        On load the journal is replayed on top of the snapshot.
+        When the journal outgrows the snapshot by compact_ratio, a new snapshot is written and the journal is emptied.
+
+        :param file: Path to the msgpack file. If None, nothing is stored.
+        :param snapshot: Returns copies of all proxy records, called from the writing thread.
+        :param flush_interval: Seconds between background writes. None writes every change immediately.
+        :param flush_threshold: Number of changes that trigger a background write before the interval is over.
+        :param journal: Append changes to a journal instead of rewriting the snapshot.
+        :param compact_ratio: Compact when the journal is this many times bigger than the snapshot.
+        :param compact_min_bytes: Never compact a journal smaller than this.
+        :param metrics: Where to count writes, their size and duration.
+        """
+        self.file = Path(file) if file is not None else None
+        self.snapshot = snapshot
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.journal = journal
+        self.compact_ratio = compact_ratio
+        self.compact_min_bytes = compact_min_bytes
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        self.journal_file = self.file.with_name(self.file.name + ".journal") if self.file else None
+        self._snapshot_bytes = 0
+        self._journal_bytes = 0
+        self._pending: List[list] = []
+
+        self._dirty = 0
+        self._dirty_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def write_behind(self) -> bool:
+        return self.flush_interval is not None
+
+    def load(self) -> List[Dict[str, Any]]:
+        if not self.file:
+            return []
+
+        proxies = []
+        if self.file.exists() and self.file.stat().st_size > 0:
+            try:
+                proxies = read_msgpack(self.file)
+                self._snapshot_bytes = self.file.stat().st_size
+            except (msgpack.UnpackException, ValueError):
+                logger.warning("Failed to decode msgpack, returning empty list.")
+        else:
+            self.file.parent.mkdir(parents=True, exist_ok=True)
+            self.file.touch(exist_ok=True)
+
+        if self.journal_file.exists():
+            records, valid_bytes = read_msgpack_records(self.journal_file)
+            size = self.journal_file.stat().st_size
+            if valid_bytes < size:
+                logger.warning("Dropping %d bytes of a truncated record at the end of %s",
+                               size - valid_bytes, self.journal_file)
+                os.truncate(self.journal_file, valid_bytes)
+            self._journal_bytes = valid_bytes
+            if records:
+                proxies = _replay(proxies, records)
+                logger.debug("Replayed %d journal records", len(records))
+            if not self.journal and records:
+                # The journal was turned off since the last run, fold it into the snapshot once.
+                self._write_snapshot(proxies)
+                os.truncate(self.journal_file, 0)
+                self._journal_bytes = 0
+        return proxies
+
+    def record(self, *records: list) -> None:
+        """
+        Records changes to the pool.
+        In journal mode the records get appended to the journal,
+        otherwise they only mark the snapshot as outdated.
+        """
+        if not self.file or not records:
+            return
+
+        with self._dirty_lock:
+            if self.journal:
+                self._pending.extend(records)
+            self._dirty += len(records)
+            dirty = self._dirty
+
+        if not self.write_behind or self._closed:
+            self.flush()
+            return
+
+        if self._thread is None:
+            self._start_thread()
+        if dirty >= self.flush_threshold:
+            self._wake.set()
+
+    def flush(self) -> None:
+        """Writes all changes since the last write to the file."""
+        if not self.file:
+            return
+
+        with self._flush_lock:
+            with self._dirty_lock:
+                dirty, self._dirty = self._dirty, 0
+                pending, self._pending = self._pending, []
+            if not dirty:
+                return
+
+            try:
+                if self.journal:
+                    self._append_journal(pending)
+                    if self._should_compact():
+                        self._compact()
+                else:
+                    self._write_snapshot(self.snapshot())
+            except Exception:
+                with self._dirty_lock:
+                    self._dirty += dirty
+                    self._pending[:0] = pending
+                raise
+            logger.debug("Wrote %d pending changes to %s", dirty, self.file)
+
+    def compact(self) -> None:
+        """Writes a fresh snapshot and empties the journal."""
+        if not self.file:
+            return
+        with self._flush_lock:
+            with self._dirty_lock:
+                self._dirty = 0
+                self._pending = []
+            self._compact()
+
+    def close(self) -> None:
+        """Stops the background thread and writes everything still pending."""
+        self._closed = True
+        if self._thread is not None:
+            self._wake.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    async def aclose(self) -> None:
+        """Like close, but waits for the final write in an executor instead of blocking the event loop."""
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def _should_compact(self) -> bool:
+        return self._journal_bytes > max(self._snapshot_bytes * self.compact_ratio, self.compact_min_bytes)
+
+    def _compact(self) -> None:
+        # Records that arrive while the snapshot is taken end up in the next journal as well,
+        # which is fine because replaying them again gives the same result.
+        self._write_snapshot(self.snapshot())
+        if self.journal_file.exists():
+            os.truncate(self.journal_file, 0)
+        self._journal_bytes = 0
+        logger.debug("Compacted journal into %s (%d bytes)", self.file, self._snapshot_bytes)
+
+    def _write_snapshot(self, proxies: List[Dict[str, Any]]) -> None:
+        started = time.perf_counter()
+        self._snapshot_bytes = write_msgpack(self.file, proxies)
+        self._count_write("snapshot", self._snapshot_bytes, started)
+
+    def _append_journal(self, records: List[list]) -> None:
+        started = time.perf_counter()
+        written = append_msgpack_records(self.journal_file, records)
+        self._journal_bytes += written
+        self._count_write("journal", written, started)
+
+    def _count_write(self, kind: str, size: int, started: float) -> None:
+        metrics = self.metrics
+        metrics.store_writes.inc(kind)
+        metrics.store_write_bytes.inc(kind, amount=size)
+        metrics.store_write_seconds.observe(time.perf_counter() - started, kind)
+
+    def _start_thread(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="ineedproxy-store", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Background write to %s failed: %s", self.file, e)
@@ -1,19 +1,24 @@
-from typing import Tuple, List, Union, Dict, Optional
+from typing import Tuple, List, Union, Optional, AsyncIterator, Iterable, Callable
 from random import shuffle
 import asyncio
 
-from .utils import ProxyDict
+from .utils import ProxyDict, URL, _host_and_port
+from .socks import SOCKS_PROTOCOLS, socks_connector
+from .metrics import Metrics
 from .logger import logger
 
 import aiohttp
 
+SUPPORTED_PROTOCOLS: Tuple[str, ...] = ('http', 'https') + SOCKS_PROTOCOLS
+
 
 async def _is_proxy_valid(
         proxy: ProxyDict,
         session: aiohttp.ClientSession,
         test_url: str = "https://httpbin.org/ip",
         timeout: int = 20,
-        supported_protocols: Tuple[str, ...] = ('http', 'https')
+        supported_protocols: Tuple[str, ...] = SUPPORTED_PROTOCOLS,
+        metrics: Optional[Metrics] = None
 ) -> Optional[ProxyDict]:
     """
     Test if a proxy is valid by making a request through it.
@@ -24,6 +29,7 @@ async def _is_proxy_valid(
         test_url: URL to test the proxy against
         timeout: Timeout in seconds
         supported_protocols: Tuple of supported proxy protocols
+        metrics: Where to count attempts, passes and timeouts
 
     Returns:
         The proxy dict if valid, None otherwise
@@ -42,91 +48,262 @@ async def _is_proxy_valid(
     if protocol not in supported_protocols:
         return None
 
+    if metrics is not None:
+        metrics.validation_attempts.inc()
     try:
-        proxy_str = str(url)
-        async with session.get(
-                test_url,
-                proxy=proxy_str,
-                allow_redirects=True,
-                timeout=aiohttp.ClientTimeout(total=timeout)
-        ) as response:
-            if response.status == 200:
-                try:
-                    json_data = await response.json()
-                    if 'origin' in json_data:
-                        logger.debug(f"Valid: {url}")
-                        return proxy
-                except:
-                    pass
-            return None
-
+        if protocol in SOCKS_PROTOCOLS:
+            # aiohttp only speaks HTTP proxies, SOCKS needs a connector of its own
+            async with aiohttp.ClientSession(connector=socks_connector(url)) as socks_session:
+                valid = await _answers_test(socks_session, test_url, timeout, None)
+        else:
+            valid = await _answers_test(session, test_url, timeout, str(url))
+    except asyncio.TimeoutError:
+        if metrics is not None:
+            metrics.validation_timeouts.inc()
+        return None
     except Exception:
         return None
 
+    if valid:
+        logger.debug(f"Valid: {url}")
+        if metrics is not None:
+            metrics.validation_passes.inc()
+        return proxy
+    return None
 
-async def get_valid_proxies(
-        proxies: List[ProxyDict],
+
+async def _answers_test(session: aiohttp.ClientSession, test_url: str, timeout: int, proxy: Optional[str]) -> bool:
+    async with session.get(
+            test_url,
+            proxy=proxy,
+            allow_redirects=True,
+            timeout=aiohttp.ClientTimeout(total=timeout)
+    ) as response:
+        if response.status == 200:
+            try:
+                json_data = await response.json()
+                return 'origin' in json_data
+            except:
+                pass
+        return False
+
+
+async def _accepts_tcp(proxy: ProxyDict, timeout: float) -> bool:
+    """
+    Checks that the proxy accepts a TCP connection at all, which costs one socket for a fraction of a second.
+
+    Args:
+        proxy: Proxy dictionary containing URL information
+        timeout: Timeout for the connect in seconds
+
+    Returns:
+        True if the connection was accepted
+    """
+    host, port = _host_and_port(URL(proxy.get("url") or ""))
+    if not host or not port:
+        return False
+
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError, ValueError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+
+_FINISHED = object()
+
+
+def _limit(max_working_proxies: Union[int, bool]) -> Optional[int]:
+    # bool is a subclass of int, so False has to be told apart from a real limit explicitly
+    if isinstance(max_working_proxies, bool) or max_working_proxies is None:
+        return None
+    return max_working_proxies
+
+
+async def iter_valid_proxies(
+        proxies: Iterable[ProxyDict],
         max_working_proxies: Union[int, bool] = False,
         simultaneous_proxy_requests: int = 50,
         test_url: str = "https://httpbin.org/ip",
-        timeout: int = 20
-) -> List[ProxyDict]:
+        timeout: int = 20,
+        session: Optional[aiohttp.ClientSession] = None,
+        on_invalid: Optional[Callable[[ProxyDict], None]] = None,
+        prefilter_timeout: Optional[float] = None,
+        prefilter_concurrency: int = 500,
+        metrics: Optional[Metrics] = None
+) -> AsyncIterator[ProxyDict]:
     """
-    Test multiple proxies concurrently and return those that are valid.
+    Test multiple proxies concurrently and yield each valid one as soon as its test passed.
+
+    A fixed pool of simultaneous_proxy_requests workers pulls candidates one by one,
+    so memory depends on the concurrency and not on the number of candidates.
+    With a prefilter_timeout, a first pool of prefilter_concurrency workers only opens a TCP connection
+    to every candidate, and just the ones that accept it get the full test. Dead candidates then cost
+    a short connect attempt instead of a whole request timeout.
 
     Args:
-        proxies: List of proxy dictionaries to test
-        max_working_proxies: Maximum number of working proxies to return, or False for all
-        simultaneous_proxy_requests: Maximum number of concurrent proxy tests
+        proxies: Proxy dictionaries to test. A list is tested in random order,
+            any other iterable is consumed lazily in its own order
+        max_working_proxies: Stop after this many valid proxies, or False for all
+        simultaneous_proxy_requests: Number of workers testing proxies at the same time
         test_url: URL to test proxies against
         timeout: Timeout for each proxy test in seconds
+        session: Optional aiohttp session to reuse, a new one is opened and closed otherwise
+        on_invalid: Called with every proxy that failed its test. Not called for tests cut short by stopping early
+        prefilter_timeout: Timeout of the TCP connect check in seconds, None tests every candidate fully
+        prefilter_concurrency: Number of workers doing the TCP connect check at the same time
+        metrics: Where to count tests, passes, timeouts and candidates dropped by the TCP connect check
 
-    Returns:
-        List of valid proxy dictionaries
+    Yields:
+        Copies of the valid proxy dictionaries, fastest first, with the test duration in seconds under "latency"
 
     Raises:
-        ValueError: If proxies list contains non-dictionary items
+        ValueError: If proxies contains non-dictionary items
     """
-    valid_proxies = []
-
-    if not proxies:
-        return valid_proxies
+    if isinstance(proxies, list):
+        if not proxies:
+            return
+        if not all(isinstance(proxy, dict) for proxy in proxies):
+            raise ValueError("All items in the proxies list must be dictionaries")
+        proxies = proxies.copy()
+        shuffle(proxies)
+        workers_count = min(simultaneous_proxy_requests, len(proxies))
+        prefilter_count = min(prefilter_concurrency, len(proxies))
+    else:
+        workers_count = simultaneous_proxy_requests
+        prefilter_count = prefilter_concurrency
 
-    if not all(isinstance(proxy, dict) for proxy in proxies):
-        raise ValueError("All items in the proxies list must be dictionaries")
+    limit = _limit(max_working_proxies)
+    if limit is not None and limit <= 0:
+        return
 
-    proxies_copy = proxies.copy()
-    shuffle(proxies_copy)
+    candidates = iter(proxies)
+    loop = asyncio.get_running_loop()
+    results: asyncio.Queue = asyncio.Queue()
+    stop = asyncio.Event()
 
-    semaphore = asyncio.Semaphore(simultaneous_proxy_requests)
-    lock = asyncio.Lock()
+    created_session = session is None
+    if created_session:
+        session = aiohttp.ClientSession()
 
-    async with aiohttp.ClientSession() as session:
-        async def limited_is_proxy_valid(proxy: Dict) -> Optional[ProxyDict]:
-            async with semaphore:
-                async with lock:
-                    if isinstance(max_working_proxies, int) and len(valid_proxies) >= max_working_proxies:
-                        return None
+    async def test(proxy: ProxyDict) -> None:
+        started = loop.time()
+        result = await _is_proxy_valid(proxy, session, test_url, timeout, metrics=metrics)
+        if result:
+            results.put_nowait({**result, "latency": loop.time() - started})
+        elif on_invalid is not None:
+            on_invalid(proxy)
 
-                result = await _is_proxy_valid(proxy, session, test_url, timeout)
+    def next_candidate() -> Optional[ProxyDict]:
+        # Workers share one iterator, next() never awaits, so no candidate is handed out twice.
+        proxy = next(candidates, None)
+        if proxy is not None and not isinstance(proxy, dict):
+            raise ValueError("All items in the proxies list must be dictionaries")
+        return proxy
 
-                if result:
-                    async with lock:
-                        valid_proxies.append(result)
-                        if isinstance(max_working_proxies, int) and len(valid_proxies) >= max_working_proxies:
-                            for task in pending:
-                                if not task.done():
-                                    task.cancel()
-                return result
+    async def worker() -> None:
+        while not stop.is_set() and (proxy := next_candidate()) is not None:
+            await test(proxy)
 
-        tasks = [asyncio.create_task(limited_is_proxy_valid(proxy)) for proxy in proxies_copy]
-        pending = tasks.copy()
+    # Bounded, so prefilter workers wait for free testers instead of piling up the reachable part of the list
+    reachable: asyncio.Queue = asyncio.Queue(maxsize=max(workers_count, 1))
+    prefilters_running = max(prefilter_count, 1)
 
+    async def prefilter_worker() -> None:
+        nonlocal prefilters_running
         try:
-            await asyncio.gather(*tasks, return_exceptions=True)
-        except asyncio.CancelledError:
-            pass
+            while not stop.is_set() and (proxy := next_candidate()) is not None:
+                if await _accepts_tcp(proxy, prefilter_timeout):
+                    await reachable.put(proxy)
+                    continue
+                if metrics is not None:
+                    metrics.prefilter_rejects.inc()
+                if on_invalid is not None:
+                    on_invalid(proxy)
+        finally:
+            prefilters_running -= 1
+            # After stopping the testers are cancelled and nobody would make room in the queue
+            if not prefilters_running and not stop.is_set():
+                for _ in range(max(workers_count, 1)):
+                    await reachable.put(_FINISHED)
+
+    async def tester() -> None:
+        while (proxy := await reachable.get()) is not _FINISHED:
+            if not stop.is_set():
+                await test(proxy)
+
+    if prefilter_timeout is None:
+        workers = [asyncio.create_task(worker()) for _ in range(max(workers_count, 1))]
+    else:
+        workers = [asyncio.create_task(prefilter_worker()) for _ in range(prefilters_running)]
+        workers += [asyncio.create_task(tester()) for _ in range(max(workers_count, 1))]
+    all_done = asyncio.gather(*workers)
+    all_done.add_done_callback(lambda _: results.put_nowait(_FINISHED))
+
+    found = 0
+    try:
+        while True:
+            result = await results.get()
+            if result is _FINISHED:
+                break
+            yield result
+            found += 1
+            if limit is not None and found >= limit:
+                break
+        if result is _FINISHED:
+            all_done.result()  # re-raises an error of a worker
+    finally:
+        # Also runs when the caller stops iterating early
+        stop.set()
+        for task in workers:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        if all_done.done() and not all_done.cancelled():
+            all_done.exception()  # mark it as retrieved
+        if created_session:
+            await session.close()
 
-        if isinstance(max_working_proxies, int):
-            return valid_proxies[:max_working_proxies]
-        return valid_proxies
+
+async def get_valid_proxies(
+        proxies: Iterable[ProxyDict],
+        max_working_proxies: Union[int, bool] = False,
+        simultaneous_proxy_requests: int = 50,
+        test_url: str = "https://httpbin.org/ip",
+        timeout: int = 20,
+        session: Optional[aiohttp.ClientSession] = None,
+        prefilter_timeout: Optional[float] = None,
+        prefilter_concurrency: int = 500,
+        metrics: Optional[Metrics] = None
+) -> List[ProxyDict]:
+    """
+    Test multiple proxies concurrently and return those that are valid.
+    Waits for all tests, use iter_valid_proxies to get each proxy as soon as it passed.
+
+    Args:
+        proxies: List of proxy dictionaries to test
+        max_working_proxies: Maximum number of working proxies to return, or False for all
+        simultaneous_proxy_requests: Maximum number of concurrent proxy tests
+        test_url: URL to test proxies against
+        timeout: Timeout for each proxy test in seconds
+        session: Optional aiohttp session to reuse, a new one is opened and closed otherwise
+        prefilter_timeout: Timeout of the TCP connect check in seconds, None tests every candidate fully
+        prefilter_concurrency: Number of workers doing the TCP connect check at the same time
+        metrics: Where to count tests, passes, timeouts and candidates dropped by the TCP connect check
+
+    Returns:
+        List of valid proxy dictionaries
+
+    Raises:
+        ValueError: If proxies list contains non-dictionary items
+    """
+    return [proxy async for proxy in iter_valid_proxies(proxies, max_working_proxies, simultaneous_proxy_requests,
+                                                        test_url, timeout, session,
+                                                        prefilter_timeout=prefilter_timeout,
+                                                        prefilter_concurrency=prefilter_concurrency,
+                                                        metrics=metrics)]
@@ -0,0 +1,204 @@
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional, TypedDict
+import random
+import time
+
+import aiohttp
+
+from .metrics import Metrics
+from .logger import logger
+
+# Phases of an attempt in the order they happen, as reported in AttemptTrace and the phase histogram
+PHASES = ("queued", "dns", "connect", "send", "wait", "receive")
+
+
+class AttemptTrace(TypedDict):
+    """
+    Timings of one request attempt through one proxy, in seconds.
+
+    queued: waiting for a free connection of the session (local, not the proxy's fault)
+    dns: resolving the host of the proxy, 0 when cached or an IP
+    connect: opening the connection, which covers TCP to the proxy, the CONNECT tunnel and TLS to an https target,
+    0 for a reused connection. aiohttp has no hooks between those steps.
+    send: sending the request headers and body
+    wait: from the request being sent to the response headers, the time the proxy and the target took
+    receive: reading the response body
+    """
+    proxy: str
+    url: str
+    status: int | None
+    bytes: int
+    reused_connection: bool
+    queued: float
+    dns: float
+    connect: float
+    send: float
+    wait: float
+    receive: float
+    total: float
+    error: str | None
+
+
+class _AttemptTimer:
+    """Collects the timestamps of one sampled attempt, handed to aiohttp as trace_request_ctx."""
+    __slots__ = ("proxy", "url", "started", "sent", "headers_at", "status", "bytes", "reused",
+                 "queued", "dns", "connect", "send", "error", "_marks", "_dns_before_connect")
+
+    def __init__(self, proxy: str, url: str):
+        self.proxy = proxy
+        self.url = url
+        self.started = time.perf_counter()
+        self.sent: Optional[float] = None
+        self.headers_at: Optional[float] = None
+        self.status: Optional[int] = None
+        self.bytes = 0
+        self.reused = False
+        self.queued = self.dns = self.connect = self.send = 0.0
+        self.error: Optional[str] = None
+        self._marks: Dict[str, float] = {}  # phase -> when it started, phases nest (dns runs inside connect)
+        self._dns_before_connect = 0.0
+
+    def begin(self, phase: str) -> None:
+        self._marks[phase] = time.perf_counter()
+
+    def end(self, phase: str) -> float:
+        started = self._marks.pop(phase, None)
+        return time.perf_counter() - started if started is not None else 0.0
+
+    def finish(self, error: Optional[BaseException] = None) -> AttemptTrace:
+        now = time.perf_counter()
+        headers_at = self.headers_at or now
+        sent = self.sent or headers_at
+        return AttemptTrace(proxy=self.proxy, url=self.url, status=self.status, bytes=self.bytes,
+                            reused_connection=self.reused, queued=self.queued, dns=self.dns, connect=self.connect,
+                            send=self.send, wait=max(headers_at - sent, 0.0), receive=max(now - headers_at, 0.0),
+                            total=now - self.started,
+                            error=self.error or (f"{type(error).__name__}: {error}" if error is not None else None))
+
+    @property
+    def proxy_latency(self) -> float:
+        """Time the attempt took without waiting for a free local connection."""
+        return time.perf_counter() - self.started - self.queued
+
+
+def _timer(context: SimpleNamespace) -> Optional[_AttemptTimer]:
+    timer = context.trace_request_ctx
+    return timer if isinstance(timer, _AttemptTimer) else None
+
+
+async def _on_queued_start(session, context, params) -> None:
+    if (timer := _timer(context)) is not None:
+        timer.begin("queued")
+
+
+async def _on_queued_end(session, context, params) -> None:
+    if (timer := _timer(context)) is not None:
+        timer.queued += timer.end("queued")
+
+
+async def _on_dns_start(session, context, params) -> None:
+    if (timer := _timer(context)) is not None:
+        timer.begin("dns")
+
+
+async def _on_dns_end(session, context, params) -> None:
+    if (timer := _timer(context)) is not None:
+        timer.dns += timer.end("dns")
+
+
+async def _on_create_start(session, context, params) -> None:
+    if (timer := _timer(context)) is not None:
+        timer.begin("connect")
+        timer._dns_before_connect = timer.dns
+
+
+async def _on_create_end(session, context, params) -> None:
+    if (timer := _timer(context)) is not None:
+        # the proxy host is resolved while the connection is created, that part is counted as dns
+        timer.connect += max(timer.end("connect") - (timer.dns - timer._dns_before_connect), 0.0)
+
+
+async def _on_reuse(session, context, params) -> None:
+    if (timer := _timer(context)) is not None:
+        timer.reused = True
+
+
+async def _on_headers_sent(session, context, params) -> None:
+    if (timer := _timer(context)) is not None:
+        timer.sent = time.perf_counter()
+
+
+async def _on_request_end(session, context, params) -> None:
+    if (timer := _timer(context)) is not None:
+        timer.headers_at = time.perf_counter()
+        timer.send = max(timer.sent - timer.started - timer.queued - timer.dns - timer.connect, 0.0) \
+            if timer.sent is not None else 0.0
+        timer.status = params.response.status
+
+
+async def _on_chunk(session, context, params) -> None:
+    if (timer := _timer(context)) is not None:
+        timer.bytes += len(params.chunk)
+
+
+async def _on_exception(session, context, params) -> None:
+    if (timer := _timer(context)) is not None:
+        timer.error = f"{type(params.exception).__name__}: {params.exception}"
+
+
+class RequestTracer:
+    def __init__(self, sample_rate: float = 0.0, hooks: Optional[List[Callable[[AttemptTrace], None]]] = None,
+                 metrics: Optional[Metrics] = None):
+        """
+        Times the phases of sampled request attempts with an aiohttp TraceConfig.
+
+        Unsampled attempts only cost one random number, the trace callbacks return right away for them.
+
+        :param sample_rate: Share of attempts to trace, from 0 (none) to 1 (all).
+        :param hooks: Called with the AttemptTrace of every sampled attempt, on the event loop,
+        so they should return quickly. Errors are logged and ignored.
+        :param metrics: Where to record the phase durations.
+        """
+        if not 0 <= sample_rate <= 1:
+            raise ValueError(f"sample_rate has to be between 0 and 1, got {sample_rate}")
+        self.sample_rate = sample_rate
+        self.hooks: List[Callable[[AttemptTrace], None]] = list(hooks or ())
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.trace_config = aiohttp.TraceConfig()
+        self.trace_config.on_connection_queued_start.append(_on_queued_start)
+        self.trace_config.on_connection_queued_end.append(_on_queued_end)
+        self.trace_config.on_dns_resolvehost_start.append(_on_dns_start)
+        self.trace_config.on_dns_resolvehost_end.append(_on_dns_end)
+        self.trace_config.on_connection_create_start.append(_on_create_start)
+        self.trace_config.on_connection_create_end.append(_on_create_end)
+        self.trace_config.on_connection_reuseconn.append(_on_reuse)
+        self.trace_config.on_request_headers_sent.append(_on_headers_sent)
+        self.trace_config.on_request_end.append(_on_request_end)
+        self.trace_config.on_response_chunk_received.append(_on_chunk)
+        self.trace_config.on_request_exception.append(_on_exception)
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0
+
+    def start(self, proxy: str, url: str) -> Optional[_AttemptTimer]:
+        """A timer to pass as trace_request_ctx if this attempt is sampled, None otherwise."""
+        if self.sample_rate <= 0 or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            return None
+        return _AttemptTimer(proxy, url)
+
+    def finish(self, timer: _AttemptTimer, error: Optional[BaseException] = None) -> AttemptTrace:
+        """Completes the trace of an attempt, records its phases and passes it to the hooks."""
+        trace = timer.finish(error)
+        phase_seconds = self.metrics.attempt_phase_seconds
+        for phase in PHASES:
+            phase_seconds.observe(trace[phase], phase)
+        for hook in self.hooks:
+            try:
+                hook(trace)
+            except Exception as e:
+                logger.error("Trace hook %r failed: %s", hook, e)
+        return trace
+
+
+__all__ = ['AttemptTrace', 'RequestTracer', 'PHASES']
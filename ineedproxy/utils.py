@@ -1,6 +1,7 @@
 import re
+from urllib.parse import urlsplit
 from collections import defaultdict
-from typing import Union, TypedDict, List, Dict, Set, Optional
+from typing import Union, TypedDict, List, Dict, Optional, Iterable, Iterator, Tuple
 
 
 def _get_port(port: str) -> Union[int, None]:
@@ -13,17 +14,21 @@ def _get_port(port: str) -> Union[int, None]:
     return None
 
 
+_PROTOCOLS = ('http', 'https', 'socks4', 'socks5')
+_IPV4_OCTET = r'(?:\d{1,2}|[01]\d\d|2[0-4]\d|25[0-5])'
+_IPV4_PATTERN = rf'{_IPV4_OCTET}\.{_IPV4_OCTET}\.{_IPV4_OCTET}\.{_IPV4_OCTET}'
+_IPV4_RE = re.compile(_IPV4_PATTERN)
+
+
 def _get_protocol(protocol: str) -> Union[str, None]:
-    if protocol in ['http', 'https', 'socks4', 'socks5']:
+    if protocol in _PROTOCOLS:
         return protocol
     return None
 
 
 def _get_ip(ip: str) -> Union[str, None]:
-    if re.match(r'^\d{1,3}(\.\d{1,3}){3}$', ip):
-        parts = ip.split('.')
-        if all(0 <= int(part) <= 255 for part in parts):
-            return ip
+    if _IPV4_RE.fullmatch(ip):
+        return ip
     return None
 
 
@@ -38,6 +43,13 @@ class URL:
             self.url = url
             self.protocol, self.ip, self.port = self._parse_url()
 
+    @classmethod
+    def _from_parts(cls, url: str, protocol: Optional[str], ip: Optional[str], port: Optional[int]) -> 'URL':
+        """Builds a URL from parts that were already validated, without parsing the string again."""
+        self = cls.__new__(cls)
+        self.url, self.protocol, self.ip, self.port = url, protocol, ip, port
+        return self
+
     def _parse_url(self):
         protocol, ip, port = None, None, None
         if '://' in self.url:
@@ -80,6 +92,25 @@ class URL:
         return self.protocol is not None and self.ip is not None and self.port is not None
 
 
+def _host_and_port(url: URL) -> Tuple[Optional[str], Optional[int]]:
+    """Host and port to connect to, also for proxies given by host name, which URL does not parse."""
+    if url.ip is not None and url.port is not None:
+        return url.ip, url.port
+    try:
+        parts = urlsplit(url.url if "://" in url.url else f"//{url.url}")
+        return parts.hostname, parts.port
+    except ValueError:
+        return None, None
+
+
+ProxyKey = Union[Tuple[Optional[str], str, Optional[int]], str]
+
+
+def _proxy_key(url: URL) -> ProxyKey:
+    """Identity of a proxy: (protocol, ip, port) like URL equality, the plain url if it has no parsable ip."""
+    return (url.protocol, url.ip, url.port) if url.ip is not None else url.url
+
+
 class ProxyDict(TypedDict):
     """
     {"url": URL, "country": str, "anonymity": str}
@@ -98,34 +129,160 @@ class ProxyPreferences(TypedDict, total=False):
     exclude_anonymity: Optional[Union[str, List[str]]]
 
 
-class ProxyIndex:
-    """An indexing system for efficient proxy lookup and filtering operations."""
+class SourceStats(TypedDict):
+    """
+    Outcome of one fetching method during a refill.
+    {"source": str, "count": int, "duration": float, "error": str | None}
+    source is the position of the method in fetching_method and its qualified name, like "0:fetch_proxy_list".
+    """
+    source: str
+    count: int
+    duration: float
+    error: str | None
+
+
+# Positions of the set bits of every byte value, for listing the ids of a bitmap byte by byte
+_BYTE_BITS = tuple(tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256))
+
+
+def bitmap_ids(bitmap: int) -> Iterator[int]:
+    """The positions of the set bits of an int bitmap in ascending order."""
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+    for byte_no, byte in enumerate(data):
+        if byte:
+            base = byte_no * 8
+            for bit in _BYTE_BITS[byte]:
+                yield base + bit
+
+
+def bitmap_of(ids: Iterable[int]) -> int:
+    """An int bitmap with the bits of the given ids set."""
+    bits = bytearray()
+    for proxy_id in ids:
+        byte_no = proxy_id >> 3
+        if byte_no >= len(bits):
+            bits.extend(bytes(byte_no + 1 - len(bits)))
+        bits[byte_no] |= 1 << (proxy_id & 7)
+    return int.from_bytes(bits, "little")
+
+
+class Bitmap:
+    """
+    A set of proxy ids stored as one bit per id. Adding and removing flip a bit in a bytearray,
+    the int form used for AND/ANDNOT with other bitmaps is built once and kept until the next change.
+    """
+    __slots__ = ("_bits", "_count", "_int")
 
     def __init__(self):
-        self.protocol_index: Dict[str, Set[int]] = defaultdict(set)
-        self.country_index: Dict[str, Set[int]] = defaultdict(set)
-        self.anonymity_index: Dict[str, Set[int]] = defaultdict(set)
+        self._bits = bytearray()
+        self._count = 0
+        self._int: Optional[int] = 0
+
+    def add(self, proxy_id: int) -> None:
+        byte_no, mask = proxy_id >> 3, 1 << (proxy_id & 7)
+        if byte_no >= len(self._bits):
+            self._bits.extend(bytes(byte_no + 1 - len(self._bits)))
+        if not self._bits[byte_no] & mask:
+            self._bits[byte_no] |= mask
+            self._count += 1
+            self._int = None
+
+    def discard(self, proxy_id: int) -> None:
+        byte_no, mask = proxy_id >> 3, 1 << (proxy_id & 7)
+        if byte_no < len(self._bits) and self._bits[byte_no] & mask:
+            self._bits[byte_no] &= ~mask
+            self._count -= 1
+            self._int = None
+
+    @property
+    def bits(self) -> int:
+        if self._int is None:
+            self._int = int.from_bytes(self._bits, "little")
+        return self._int
+
+    def __contains__(self, proxy_id: int) -> bool:
+        byte_no = proxy_id >> 3
+        return 0 <= byte_no < len(self._bits) and bool(self._bits[byte_no] >> (proxy_id & 7) & 1)
+
+    def __iter__(self) -> Iterator[int]:
+        return bitmap_ids(self.bits)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __repr__(self) -> str:
+        return f"Bitmap({list(self)!r})"
 
-    def add_proxy(self, index: int, proxy: dict) -> None:
-        self.protocol_index[proxy["protocol"]].add(index)
-        self.country_index[proxy["country"]].add(index)
-        self.anonymity_index[proxy["anonymity"]].add(index)
 
-    def remove_proxy(self, index: int, proxy: dict) -> None:
-        self.protocol_index[proxy["protocol"]].discard(index)
-        self.country_index[proxy["country"]].discard(index)
-        self.anonymity_index[proxy["anonymity"]].discard(index)
+class ProxyIndex:
+    """
+    An indexing system for efficient proxy lookup and filtering operations, keyed by stable proxy ids.
+    Every protocol, country and anonymity value maps to a Bitmap of the ids having it,
+    so filters are answered with a few AND/ANDNOT operations on ints instead of building sets.
+    """
+
+    def __init__(self):
+        self.all_ids = Bitmap()
+        self.protocol_index: Dict[str, Bitmap] = defaultdict(Bitmap)
+        self.country_index: Dict[str, Bitmap] = defaultdict(Bitmap)
+        self.anonymity_index: Dict[str, Bitmap] = defaultdict(Bitmap)
+
+    def add_proxy(self, proxy_id: int, proxy: dict) -> None:
+        self.all_ids.add(proxy_id)
+        self.protocol_index[proxy["protocol"]].add(proxy_id)
+        self.country_index[proxy["country"]].add(proxy_id)
+        self.anonymity_index[proxy["anonymity"]].add(proxy_id)
+
+    def remove_proxy(self, proxy_id: int, proxy: dict) -> None:
+        self.all_ids.discard(proxy_id)
+        self.protocol_index[proxy["protocol"]].discard(proxy_id)
+        self.country_index[proxy["country"]].discard(proxy_id)
+        self.anonymity_index[proxy["anonymity"]].discard(proxy_id)
 
     def clear(self) -> None:
+        self.all_ids = Bitmap()
         self.protocol_index.clear()
         self.country_index.clear()
         self.anonymity_index.clear()
 
-    def rebuild_index(self, proxies: List[dict]) -> None:
-        """Rebuild the entire index from a list of proxies."""
+    def rebuild_index(self, proxies: Iterable[Tuple[int, dict]]) -> None:
+        """Rebuild the entire index from (proxy_id, proxy) pairs."""
         self.clear()
-        for i, proxy in enumerate(proxies):
-            self.add_proxy(i, proxy)
+        for proxy_id, proxy in proxies:
+            self.add_proxy(proxy_id, proxy)
+
+    @staticmethod
+    def _union(index: Dict[str, Bitmap], values: Iterable[str]) -> int:
+        bits = 0
+        for value in values:
+            bitmap = index.get(value)
+            if bitmap is not None:
+                bits |= bitmap.bits
+        return bits
+
+    def matching(self,
+                 protocol: Optional[Iterable[str]] = None,
+                 country: Optional[Iterable[str]] = None,
+                 anonymity: Optional[Iterable[str]] = None,
+                 exclude_protocol: Optional[Iterable[str]] = None,
+                 exclude_country: Optional[Iterable[str]] = None,
+                 exclude_anonymity: Optional[Iterable[str]] = None) -> int:
+        """
+        Bitmap of the ids that have one of the given values of every include filter and none of the excluded ones.
+        Filters that are None or empty don't restrict. Iterate the result with bitmap_ids.
+        """
+        bits = self.all_ids.bits
+        for values, index in ((protocol, self.protocol_index),
+                              (country, self.country_index),
+                              (anonymity, self.anonymity_index)):
+            if values:
+                bits &= self._union(index, values)
+        for values, index in ((exclude_protocol, self.protocol_index),
+                              (exclude_country, self.country_index),
+                              (exclude_anonymity, self.anonymity_index)):
+            if values:
+                bits &= ~self._union(index, values)
+        return bits
 
     def __str__(self):
         return f"protocol_index: {self.protocol_index}, country_index: {self.country_index}, anonymity_index: {self.anonymity_index}"
@@ -147,25 +304,31 @@ def _convert_to_proxy_dict(proxy_store_dict: dict) -> ProxyDict:
     else:
         url = URL(f"{protocol}://{ip}:{port}")
 
+    return ProxyDict(url=url, country=_find_country(proxy_store_dict), anonymity=_find_anonymity(proxy_store_dict))
+
+
+def _find_country(proxy_store_dict: dict) -> Optional[str]:
     # Search for country code
     country = proxy_store_dict.get("countryCode")
-    if not country:
-        for value in proxy_store_dict.values():
-            if isinstance(value, dict):
-                country = value.get("countryCode")
-                if country:
-                    break
+    if country:
+        return country
+    nested = [value for value in proxy_store_dict.values() if isinstance(value, dict)]
+    for value in nested:
+        country = value.get("countryCode")
+        if country:
+            return country
 
     # Search for country in the base dict first, then in all other dicts
+    country = proxy_store_dict.get("country")
     if not country:
-        country = proxy_store_dict.get("country")
-        if not country:
-            for value in proxy_store_dict.values():
-                if isinstance(value, dict):
-                    country = value.get("country")
-                    if country:
-                        break
+        for value in nested:
+            country = value.get("country")
+            if country:
+                break
+    return country
+
 
+def _find_anonymity(proxy_store_dict: dict) -> Optional[str]:
     # Search for anonymity in the base dict first, then in all other dicts
     anonymity = proxy_store_dict.get("anonymity")
     if not anonymity:
@@ -174,14 +337,12 @@ def _convert_to_proxy_dict(proxy_store_dict: dict) -> ProxyDict:
                 anonymity = value.get("anonymity")
                 if anonymity:
                     break
+    return anonymity
 
-    return ProxyDict(url=url, country=country, anonymity=anonymity)
 
-
-def convert_to_proxy_dict_format(proxy_dict_list: List[dict]) -> List[ProxyDict]:
-    if isinstance(proxy_dict_list, dict) and "proxies" in proxy_dict_list:
-        proxy_dict_list = proxy_dict_list['proxies']
-    return [_convert_to_proxy_dict(proxy_dict) for proxy_dict in proxy_dict_list]
+def convert_to_proxy_dict_format(proxy_dict_list: List[dict], source: Optional[str] = None) -> List[ProxyDict]:
+    from .parsing import parse_records  # parsing builds on this module
+    return parse_records(proxy_dict_list, source)
 
 
 class NoProxyAvailable(Exception):
@@ -202,5 +363,18 @@ class NoValidProxyAvailable(Exception):
         return f"NoValidProxyAvailable: {self.message}"
 
 
-__all__ = ['URL', 'ProxyDict', 'ProxyPreferences', 'ProxyIndex', 'convert_to_proxy_dict_format', 'NoProxyAvailable',
-           'NoValidProxyAvailable']
+class RequestFailed(Exception):
+    """Raised when a request ran out of attempts or time. last_error is the error of the final attempt."""
+
+    def __init__(self, message, attempts: int = 0, last_error: Optional[BaseException] = None):
+        super().__init__(message)
+        self.message = message
+        self.attempts = attempts
+        self.last_error = last_error
+
+    def __str__(self):
+        return f"RequestFailed: {self.message}"
+
+
+__all__ = ['URL', 'ProxyDict', 'ProxyPreferences', 'SourceStats', 'ProxyIndex', 'Bitmap', 'bitmap_ids', 'bitmap_of', 'convert_to_proxy_dict_format', 'NoProxyAvailable',
+           'NoValidProxyAvailable', 'RequestFailed']
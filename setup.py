@@ -14,13 +14,14 @@ setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     author="Paul Hartwich",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
     install_requires=required,
+    extras_require={"socks": ["aiohttp_socks"]},  # optional, a minimal SOCKS implementation is built in
     license="MIT",
     url="https://github.com/paul-hartwich/ineedproxy",
 )
@@ -0,0 +1,52 @@
+import random
+import threading
+
+import pytest
+
+from ineedproxy.columnar import ColumnarSlots
+
+
+def _record(n: int) -> dict:
+    # Every field is derived from n, so a row mixing two records is easy to spot
+    host = f"10.0.{n // 250 % 250}.{n % 250}" if n % 3 else f"proxy-{n}.example"
+    return {"url": f"http://{host}:{1024 + n % 1000}", "protocol": "http", "country": f"C{n % 7}",
+            "anonymity": None, "times_succeed": n, "latency": float(n), "n": n}
+
+
+def _consistent(row: dict) -> bool:
+    expected = _record(row["n"])
+    return all(row[key] == value for key, value in expected.items())
+
+
+def test_snapshot_rows_are_never_mixed_while_slots_are_reused():
+    slots = ColumnarSlots()
+    ids = [slots.add(_record(n)) for n in range(500)]
+    stop = threading.Event()
+    broken = []
+
+    def snapshot_forever():
+        while not stop.is_set():
+            broken.extend(row for row in slots.snapshot() if not _consistent(row))
+
+    thread = threading.Thread(target=snapshot_forever)
+    thread.start()
+    try:
+        rng = random.Random(0)
+        for n in range(500, 30000):
+            slots.remove(ids.pop(rng.randrange(len(ids))))
+            ids.append(slots.add(_record(n)))
+    finally:
+        stop.set()
+        thread.join()
+    assert not broken[:1]
+    assert all(_consistent(row) for row in slots.snapshot())
+
+
+def test_view_of_removed_record_does_not_read_its_successor():
+    slots = ColumnarSlots()
+    proxy_id = slots.add(_record(1))
+    view = slots[proxy_id]
+    slots.remove(proxy_id)
+    assert slots.add(_record(2)) == proxy_id
+    with pytest.raises(KeyError):
+        view["url"]
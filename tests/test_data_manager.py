@@ -0,0 +1,186 @@
+import asyncio
+
+import pytest
+
+from ineedproxy import Manager
+from ineedproxy import data_manager as data_manager_module
+from ineedproxy.data_manager import DataManager
+from ineedproxy.utils import URL
+
+
+def _data_manager(**kwargs) -> DataManager:
+    return DataManager(None, allowed_fails_in_row=3, fails_without_check=2, percent_failed_to_remove=0.5,
+                       min_proxies=0, **kwargs)
+
+
+def _proxy(url: str, country: str = "US") -> dict:
+    return {"url": URL(url), "country": country, "anonymity": "elite"}
+
+
+def test_add_proxy_counts_only_new_proxies():
+    data_manager = _data_manager()
+    assert data_manager.add_proxy([_proxy("http://10.0.0.1:80"), _proxy("http://10.0.0.2:80"),
+                                   _proxy("http://10.0.0.1:80")]) == 2
+    assert data_manager.add_proxy([_proxy("http://10.0.0.2:80", "DE"), _proxy("http://10.0.0.3:80")]) == 1
+    assert len(data_manager) == 3
+
+
+def test_streamed_fetch_counts_only_new_proxies():
+    async def run():
+        async with Manager(fetching_method=[], data_file=None, auto_fetch_proxies=False) as manager:
+            manager.data_manager.add_proxy([_proxy("http://10.0.0.1:80")])
+
+            async def validated():
+                for url in ("http://10.0.0.1:80", "http://10.0.0.2:80", "http://10.0.0.2:80"):
+                    yield _proxy(url)
+
+            return await manager._add_streaming(validated()), len(manager.data_manager)
+
+    assert asyncio.run(run()) == (1, 2)
+
+
+@pytest.mark.parametrize("columnar", [False, True])
+def test_lease_reports_once(columnar):
+    data_manager = _data_manager(columnar=columnar)
+    data_manager.add_proxy([_proxy("http://10.0.0.1:80")])
+    first, second = data_manager.acquire(), data_manager.acquire()
+    proxy_id = first.proxy_id
+    assert data_manager.in_flight == {proxy_id: 2}
+
+    first.release()
+    first.release()  # no-op
+    assert data_manager.in_flight == {proxy_id: 1}
+    with pytest.raises(RuntimeError):
+        first.success()
+
+    second.failure(0.5)
+    with pytest.raises(RuntimeError):
+        second.success()
+    second.release()  # no-op after a report too
+    assert data_manager.in_flight == {}
+    proxy = data_manager.slots[proxy_id]
+    assert (proxy["times_failed"], proxy["times_succeed"]) == (1, 0)
+
+
+@pytest.mark.parametrize("columnar", [False, True])
+def test_lease_of_a_removed_proxy_does_not_touch_the_one_reusing_its_slot(columnar):
+    data_manager = _data_manager(columnar=columnar)
+    data_manager.add_proxy([_proxy("http://10.0.0.1:80")])
+    stale = data_manager.acquire()
+    data_manager.rm_proxy(stale.proxy_id)
+    data_manager.add_proxy([_proxy("http://10.0.0.2:80")])
+    current = data_manager.acquire()
+    assert current.proxy_id == stale.proxy_id  # the slot got reused
+
+    stale.failure(1.0)
+    assert data_manager.in_flight == {current.proxy_id: 1}
+    proxy = data_manager.slots[current.proxy_id]
+    assert proxy["url"] == "http://10.0.0.2:80"
+    assert proxy.get("times_failed", 0) == 0 and proxy.get("latency") is None
+
+    current.success(0.2)
+    assert data_manager.in_flight == {}
+    assert data_manager.slots[current.proxy_id]["times_succeed"] == 1
+
+
+def test_lease_as_context_manager():
+    async def run():
+        data_manager = _data_manager()
+        data_manager.add_proxy([_proxy("http://10.0.0.1:80")])
+        async with data_manager.acquire() as lease:
+            pass
+        with pytest.raises(ValueError):
+            async with data_manager.acquire():
+                raise ValueError
+        with pytest.raises(asyncio.CancelledError):
+            async with data_manager.acquire():
+                raise asyncio.CancelledError
+        proxy = data_manager.slots[lease.proxy_id]
+        assert (proxy["times_succeed"], proxy["times_failed"]) == (1, 1)  # the cancelled one gave no feedback
+        assert data_manager.in_flight == {}
+
+    asyncio.run(run())
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+def _breaker_manager(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(data_manager_module, "time", clock)
+    data_manager = DataManager(None, allowed_fails_in_row=1, fails_without_check=100, percent_failed_to_remove=0.5,
+                               min_proxies=0, breaker_cooldown=60, breaker_max_trips=3)
+    data_manager.add_proxy([_proxy("http://10.0.0.1:80"), _proxy("http://10.0.0.2:80")])
+    return data_manager, clock
+
+
+def _fail(data_manager: DataManager, proxy_id: int, times: int = 1) -> None:
+    for _ in range(times):
+        data_manager._feedback(proxy_id, False)
+
+
+def test_breaker_pauses_then_half_opens_then_removes(monkeypatch):
+    data_manager, clock = _breaker_manager(monkeypatch)
+    bad, good = [proxy_id for proxy_id, _ in data_manager.slots.items()]
+    bad_proxy = data_manager.slots[bad]
+
+    _fail(data_manager, bad, 2)  # more than allowed_fails_in_row
+    assert bad in data_manager.open_breakers
+    assert bad_proxy["breaker_trips"] == 1 and bad_proxy["open_until"] == clock.now + 60
+    assert data_manager.available() == 1
+    assert {data_manager.get_proxy() for _ in range(5)} == {"http://10.0.0.2:80"}
+
+    clock.now += 61
+    data_manager.get_proxy()  # reopens the due breakers
+    assert bad not in data_manager.open_breakers and bad_proxy["open_until"] is None
+
+    _fail(data_manager, bad)  # one failed probe is enough while half-open
+    assert bad_proxy["breaker_trips"] == 2 and bad_proxy["open_until"] == clock.now + 120
+    clock.now += 121
+    data_manager.get_proxy()
+    _fail(data_manager, bad)
+    assert bad not in data_manager.slots  # tripped breaker_max_trips times in a row
+    assert bad not in data_manager.open_breakers
+    assert [proxy["url"] for proxy in data_manager.proxies] == ["http://10.0.0.2:80"]
+    assert data_manager.metrics.breaker_trips.get() == 3
+
+
+def test_success_closes_a_half_open_breaker(monkeypatch):
+    data_manager, clock = _breaker_manager(monkeypatch)
+    bad = next(proxy_id for proxy_id, _ in data_manager.slots.items())
+    _fail(data_manager, bad, 2)
+    clock.now += 61
+    data_manager.get_proxy()
+    data_manager._feedback(bad, True, 0.1)
+    assert data_manager.slots[bad]["breaker_trips"] == 0
+
+    _fail(data_manager, bad, 2)  # a new bad streak starts over with the first cooldown
+    assert data_manager.slots[bad]["breaker_trips"] == 1
+    assert data_manager.slots[bad]["open_until"] == clock.now + 60
+
+
+def test_breaker_ignores_late_failures_and_closes_on_a_passed_check(monkeypatch):
+    data_manager, clock = _breaker_manager(monkeypatch)
+    bad = next(proxy_id for proxy_id, _ in data_manager.slots.items())
+    late = data_manager.acquire()
+    while late.proxy_id != bad:
+        late.release()
+        late = data_manager.acquire()
+    _fail(data_manager, bad, 2)
+    open_until = data_manager.slots[bad]["open_until"]
+
+    late.failure()  # taken before the breaker opened, not a failed probe
+    assert data_manager.slots[bad]["breaker_trips"] == 1
+    assert data_manager.slots[bad]["open_until"] == open_until
+
+    data_manager.record_check(bad, data_manager.slots[bad], ok=True, latency=0.3)
+    assert bad not in data_manager.open_breakers
+    assert data_manager.available() == 2
+    clock.now += 61
+    data_manager.get_proxy()  # the outdated reopen entry is skipped
+    assert data_manager.slots[bad]["breaker_trips"] == 0
@@ -0,0 +1,24 @@
+import asyncio
+
+from ineedproxy import Manager, URL
+
+
+def test_fetch_stats_tell_lambda_sources_apart():
+    def source(n: int):
+        async def fetch():
+            return [{"url": URL(f"http://10.0.{n}.1:8080"), "country": "US", "anonymity": "elite"}]
+        return fetch
+
+    async def run():
+        manager = Manager(fetching_method=[], data_file=None, auto_fetch_proxies=False, min_proxies=0)
+        stats = await manager.fetch_proxies(test_proxies=False, fetching_method=[lambda: source(0)(),
+                                                                                  lambda: source(1)()])
+        names = [s["source"] for s in stats]
+        assert names[0] != names[1]
+        assert names[0].startswith("0:") and names[1].startswith("1:")
+        assert names[0].endswith("<lambda>")
+        assert [s["count"] for s in stats] == [1, 1]
+        assert len(manager.data_manager) == 2
+        manager.data_manager.close()
+
+    asyncio.run(run())
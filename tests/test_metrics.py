@@ -0,0 +1,45 @@
+import sys
+import threading
+
+from ineedproxy.metrics import Metrics
+
+
+def test_reading_while_another_thread_records():
+    metrics = Metrics()
+    stop = threading.Event()
+
+    def write():
+        n = 0
+        while not stop.is_set():
+            n += 1
+            kind = f"kind{n}"  # every write adds labels, like the first write of a kind does
+            metrics.store_write_seconds.observe(0.001 * (n % 7), kind)
+            metrics.store_writes.inc(kind)
+            if n % 200 == 0:
+                metrics.reset()
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # switch threads as often as possible, so the reads overlap the writes
+    thread = threading.Thread(target=write)
+    thread.start()
+    try:
+        for _ in range(200):
+            metrics.prometheus()
+            snapshot = metrics.snapshot()
+    finally:
+        stop.set()
+        thread.join()
+        sys.setswitchinterval(interval)
+    assert all(entry["count"] == 1 for entry in snapshot["store_write_seconds"].values())
+
+
+def test_histogram_snapshot():
+    metrics = Metrics(prefix="test")
+    for value in (0.002, 0.02, 0.2, 2):
+        metrics.request_seconds.observe(value, "success")
+    snapshot = metrics.snapshot()["request_seconds"]["success"]
+    assert snapshot["count"] == 4
+    assert abs(snapshot["sum"] - 2.222) < 1e-9
+    assert snapshot["p50"] == 0.025
+    assert snapshot["p99"] == 2.5
+    assert 'test_request_seconds_bucket{outcome="success",le="+Inf"} 4' in metrics.prometheus()
@@ -0,0 +1,51 @@
+import asyncio
+import gc
+
+from ineedproxy.parsing import parse_proxy_list, parse_proxy_list_async, parse_records
+from ineedproxy.utils import _convert_to_proxy_dict
+
+
+def test_executor_parse_leaves_the_collector_alone(monkeypatch):
+    disabled = []
+    monkeypatch.setattr(gc, "disable", lambda: disabled.append(True))
+    text = "\n".join(f"10.0.{n // 250}.{n % 250}:8080" for n in range(5000))
+
+    async def run():
+        return await asyncio.gather(*(parse_proxy_list_async(text, offload_bytes=0) for _ in range(4)))
+
+    results = asyncio.run(run())
+    assert [len(proxies) for proxies in results] == [5000] * 4
+    assert not disabled
+    assert gc.isenabled()
+
+    parse_proxy_list(text)  # on the main thread the pause still applies
+    assert disabled
+
+
+def _plain(proxies):
+    return [(str(proxy["url"]), proxy["country"], proxy["anonymity"]) for proxy in proxies]
+
+
+def test_learned_schema_matches_the_slow_path_on_mixed_rows():
+    rows = [
+        {"ip": "10.0.0.1", "port": 80, "protocol": "http", "country": "DE", "anonymity": "elite"},
+        {"ip": "10.0.0.2", "port": 80, "protocol": "http", "country": "", "countryCode": "FR"},
+        {"ip": "10.0.0.3", "port": 80, "protocol": "http", "country": "DE", "countryCode": "US"},
+        {"ip": "10.0.0.4", "port": 80, "protocol": "http", "country": "DE", "geo": {"countryCode": "PL"}},
+        {"ip": "10.0.0.5", "port": 80, "protocol": "http", "geo": {"country": "NL", "anonymity": "anonymous"}},
+        {"ip": "10.0.0.6", "port": 80, "protocol": "http", "country": "", "anonymity": ""},
+        {"proxy": "socks5://10.0.0.7:1080", "url": "http://10.0.0.7:8080", "country": "IT"},
+    ]
+    expected = [_plain([_convert_to_proxy_dict(row)])[0] for row in rows]
+    source = "mixed rows"
+    assert _plain(parse_records(rows, source)) == expected
+    assert _plain(parse_records(rows, source)) == expected  # with the schema learned by the first call
+    assert _plain(parse_records(rows[::-1], source)) == expected[::-1]
+    # one row at a time goes through _Schema.parse instead of the column wise parse_all
+    assert [_plain(parse_records([row], source))[0] for row in rows] == expected
+
+
+def test_proxy_key_schema_gives_way_to_url():
+    rows = [{"proxy": "socks5://10.0.0.1:1080"}, {"proxy": "socks5://10.0.0.2:1080", "url": "http://10.0.0.2:80"}]
+    assert [url for url, _, _ in _plain(parse_records(rows, "proxy key"))] == \
+        ["socks5://10.0.0.1:1080", "http://10.0.0.2:80"]
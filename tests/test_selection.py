@@ -0,0 +1,185 @@
+import random
+
+import pytest
+
+from ineedproxy import NoProxyAvailable
+from ineedproxy.data_manager import DataManager, _NO_FILTER
+from ineedproxy.selection import STRATEGIES, WeightedStrategy, get_strategy_factory, success_rate
+from ineedproxy.utils import URL
+
+
+def _record(n: int, **fields) -> dict:
+    return {"url": f"http://10.0.0.{n}:80", **fields}
+
+
+@pytest.mark.parametrize("name", sorted(STRATEGIES))
+def test_strategies_follow_adds_and_removes(name):
+    random.seed(1)
+    strategy = get_strategy_factory(name)()
+    with pytest.raises(NoProxyAvailable):
+        strategy.pick()
+
+    for n in range(10):
+        strategy.add(n, _record(n))
+    strategy.add(3, _record(3))  # already a member
+    for n in (0, 4, 9, 42):
+        strategy.remove(n)
+    members = {1, 2, 3, 5, 6, 7, 8}
+    assert len(strategy) == len(members)
+    assert all(n in strategy for n in members) and 4 not in strategy
+
+    picked = set()
+    previous = None
+    for _ in range(300):
+        proxy_id = strategy.pick(avoid=previous)
+        assert proxy_id in members and proxy_id != previous
+        picked.add(proxy_id)
+        previous = proxy_id
+        strategy.on_in_flight(proxy_id, 1)
+        strategy.on_in_flight(proxy_id, 0)
+        strategy.on_feedback(proxy_id, _record(proxy_id, times_succeed=1))
+    if name not in ("fastest", "p2c"):  # these prefer proxies, the others reach every one
+        assert picked == members
+
+    for n in members - {6}:
+        strategy.remove(n)
+    assert strategy.pick(avoid=6) == 6  # the only candidate is returned anyway
+    strategy.remove(6)
+    assert len(strategy) == 0
+    with pytest.raises(NoProxyAvailable):
+        strategy.pick()
+
+
+def test_round_robin_visits_every_proxy_once_per_round():
+    strategy = get_strategy_factory("round_robin")()
+    for n in range(50):
+        strategy.add(n, _record(n))
+    for n in range(0, 50, 2):
+        strategy.remove(n)
+    strategy.add(0, _record(0))  # back at the end of the rotation
+    first_round = [strategy.pick() for _ in range(26)]
+    assert sorted(first_round) == [0] + list(range(1, 50, 2))
+    assert first_round[-1] == 0
+    assert [strategy.pick() for _ in range(26)] == first_round
+
+
+def test_lru_picks_new_proxies_first_then_the_longest_unused():
+    strategy = get_strategy_factory("lru")()
+    for n in range(3):
+        strategy.add(n, _record(n))
+    assert [strategy.pick() for _ in range(3)] == [2, 1, 0]
+    strategy.add(7, _record(7))
+    assert [strategy.pick() for _ in range(4)] == [7, 2, 1, 0]
+
+
+def test_least_in_flight_prefers_idle_proxies():
+    strategy = get_strategy_factory("least_in_flight")()
+    for n in range(3):
+        strategy.add(n, _record(n))
+    strategy.on_in_flight(0, 2)
+    strategy.on_in_flight(1, 1)
+    assert [strategy.pick() for _ in range(2)] == [2, 2]
+    strategy.on_in_flight(2, 5)
+    assert strategy.pick() == 1
+
+
+def test_fastest_follows_feedback():
+    strategy = get_strategy_factory("fastest")()
+    proxies = {n: _record(n, latency=1.0 + n) for n in range(3)}
+    for n, proxy in proxies.items():
+        strategy.add(n, proxy)
+    assert strategy.pick() == 0
+    proxies[2]["latency"] = 0.1
+    strategy.on_feedback(2, proxies[2])
+    assert strategy.pick() == 2
+
+
+def _fenwick_prefix(strategy: WeightedStrategy, position: int) -> float:
+    total, i = 0.0, position
+    while i > 0:
+        total += strategy._tree[i]
+        i -= i & -i
+    return total
+
+
+def test_weighted_fenwick_tree_matches_the_weights():
+    random.seed(2)
+    strategy = WeightedStrategy()
+    proxies = {}
+    for step in range(400):
+        n = random.randrange(60)
+        if n in strategy and random.random() < 0.4:
+            strategy.remove(n)
+            del proxies[n]
+        else:
+            proxies[n] = _record(n, times_succeed=random.randrange(10), times_failed=random.randrange(10))
+            if n in strategy:
+                strategy.on_feedback(n, proxies[n])
+            else:
+                strategy.add(n, proxies[n])
+
+        weights = strategy._weights
+        assert len(weights) == len(proxies)
+        for proxy_id, position in strategy._positions.items():
+            assert weights[position] == pytest.approx(success_rate(proxies[proxy_id]))
+        for position in range(len(weights) + 1):
+            assert _fenwick_prefix(strategy, position) == pytest.approx(sum(weights[:position]))
+
+
+def test_weighted_picks_in_proportion_to_the_weights():
+    random.seed(3)
+    strategy = WeightedStrategy(weight=lambda proxy: proxy["w"])
+    for n, w in enumerate((1.0, 3.0, 0.0, 6.0)):
+        strategy.add(n, {"w": w})
+    counts = [0] * 4
+    for _ in range(10000):
+        counts[strategy.pick()] += 1
+    assert counts[2] == 0
+    assert [round(c / 1000) for c in counts] == [1, 3, 0, 6]
+
+    strategy.on_feedback(3, {"w": 0.0})
+    assert {strategy.pick(avoid=1) for _ in range(200)} == {0}
+
+
+def _data_manager(**kwargs) -> DataManager:
+    return DataManager(None, allowed_fails_in_row=3, fails_without_check=2, percent_failed_to_remove=0.5,
+                       min_proxies=0, **kwargs)
+
+
+def _proxy(n: int, country: str) -> dict:
+    return {"url": URL(f"http://10.0.0.{n}:80"), "country": country, "anonymity": "elite"}
+
+
+def test_pools_per_preference_are_evicted_least_recently_used():
+    data_manager = _data_manager(max_cached_filters=2)
+    data_manager.add_proxy([_proxy(n, country) for n, country in enumerate(("US", "DE", "FR"))])
+    data_manager.get_proxy(country="US")
+    data_manager.get_proxy(country="DE")
+    data_manager.get_proxy(country="US")  # DE is now the least recently used
+    data_manager.get_proxy(country="FR")
+
+    cached_countries = [key[1] for key in data_manager._pools if key != _NO_FILTER]
+    assert _NO_FILTER in data_manager._pools
+    assert cached_countries == [frozenset({"FR"})]  # _NO_FILTER takes one of the two places
+    assert len(data_manager._pools) == 2
+
+    # An evicted pool is rebuilt from the index, with the proxies added in the meantime
+    data_manager.add_proxy([_proxy(7, "DE")])
+    assert {data_manager.get_proxy(country="DE") for _ in range(20)} == {"http://10.0.0.1:80", "http://10.0.0.7:80"}
+
+
+def test_cached_pools_follow_changes_of_the_pool():
+    data_manager = _data_manager(selection="round_robin")
+    data_manager.add_proxy([_proxy(n, "US") for n in range(3)])
+    data_manager.add_proxy([_proxy(5, "DE")])
+    data_manager.get_proxy(country="US")
+    data_manager.get_proxy(country="DE")  # both pools are cached from here on
+    data_manager.add_proxy([_proxy(3, "US"), _proxy(4, "DE")])
+    assert {data_manager.get_proxy(country="US") for _ in range(8)} == {f"http://10.0.0.{n}:80" for n in range(4)}
+
+    us_ids = [proxy_id for proxy_id, proxy in data_manager.slots.items() if proxy["country"] == "US"]
+    data_manager.rm_proxy(us_ids[0])
+    data_manager._update_seen(us_ids[1], {"country": "DE"})  # moves to the DE pools
+    assert {data_manager.get_proxy(country="US") for _ in range(8)} == {"http://10.0.0.2:80", "http://10.0.0.3:80"}
+    assert {data_manager.get_proxy(country="DE") for _ in range(8)} == {"http://10.0.0.1:80", "http://10.0.0.4:80",
+                                                                          "http://10.0.0.5:80"}
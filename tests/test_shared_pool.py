@@ -0,0 +1,74 @@
+import asyncio
+import os
+
+import pytest
+
+from ineedproxy import Manager, PoolClient, SharedPoolError, URL
+
+pytestmark = pytest.mark.skipif(os.name != "posix", reason="needs Unix domain sockets")
+
+
+def _proxies(count: int) -> list:
+    return [{"url": URL(f"http://10.0.0.{n}:8080"), "country": "US", "anonymity": "elite"} for n in range(count)]
+
+
+async def _serving(tmp_path):
+    manager = Manager(fetching_method=[], data_file=None, auto_fetch_proxies=False, min_proxies=0)
+    manager.data_manager.add_proxy(_proxies(3))
+    server = await manager.serve_shared_pool(tmp_path / "pool.sock")
+    return manager, server
+
+
+def test_cancelled_acquires_give_their_leases_back(tmp_path):
+    async def run():
+        manager, server = await _serving(tmp_path)
+        client = PoolClient(server.path)
+        try:
+            lease = await client.acquire(fetch=False)  # connects
+            lease.success(0.1)
+            for n in range(60):
+                task = asyncio.create_task(client.acquire(fetch=False))
+                for _ in range(1 + n % 4):  # cancelled before the answer came or after it was read
+                    await asyncio.sleep(0)
+                task.cancel()
+                try:
+                    (await task).release()  # finished before the cancel arrived
+                except asyncio.CancelledError:
+                    pass
+            for _ in range(100):
+                await asyncio.sleep(0.01)
+                if not manager.data_manager.in_flight:
+                    break
+            assert manager.data_manager.in_flight == {}
+        finally:
+            await client.aclose()
+            await server.close()
+            await manager.aclose()
+
+    asyncio.run(run())
+
+
+def test_second_server_does_not_take_over_a_live_socket(tmp_path):
+    async def run():
+        manager, server = await _serving(tmp_path)
+        other = Manager(fetching_method=[], data_file=None, auto_fetch_proxies=False, min_proxies=0)
+        client = PoolClient(server.path)
+        try:
+            with pytest.raises(SharedPoolError):
+                await other.serve_shared_pool(server.path)
+            assert (await client.acquire(fetch=False)).url.startswith("http://10.0.0.")
+        finally:
+            await client.aclose()
+            await server.close()
+            await manager.aclose()
+            await other.aclose()
+
+        # a socket file left behind by a server that did not close is replaced
+        stale = await asyncio.start_unix_server(lambda reader, writer: None, path=str(tmp_path / "stale.sock"))
+        stale.close()
+        await stale.wait_closed()
+        (tmp_path / "stale.sock").touch()
+        restarted = await manager.serve_shared_pool(tmp_path / "stale.sock")
+        await restarted.close()
+
+    asyncio.run(run())
@@ -0,0 +1,62 @@
+import asyncio
+import socket
+
+import aiohttp
+import pytest
+
+from ineedproxy import Manager, RequestFailed, URL
+from ineedproxy.socks import socks_connector
+
+pytest.importorskip("aiohttp_socks")  # pip install ineedproxy[socks]
+
+
+def _closed_port() -> int:
+    """A local port nothing listens on."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def _hanging_up_proxy() -> asyncio.AbstractServer:
+    """A server accepting connections and closing them before any SOCKS reply."""
+    async def hang_up(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        writer.close()
+    return await asyncio.start_server(hang_up, "127.0.0.1", 0)
+
+
+def test_library_connector_raises_aiohttp_errors():
+    async def run():
+        server = await _hanging_up_proxy()
+        hanging_up = server.sockets[0].getsockname()[1]
+        try:
+            for port in (_closed_port(), hanging_up):
+                async with aiohttp.ClientSession(connector=socks_connector(f"socks5://127.0.0.1:{port}")) as session:
+                    with pytest.raises(aiohttp.ClientConnectorError):
+                        await session.get("http://example.com/")
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(run())
+
+
+def test_dead_socks_proxies_are_retried():
+    async def run():
+        server = await _hanging_up_proxy()
+        hanging_up = server.sockets[0].getsockname()[1]
+        urls = [f"socks5://127.0.0.1:{_closed_port()}", f"socks4://127.0.0.1:{_closed_port()}",
+                f"socks5://127.0.0.1:{hanging_up}", f"socks4://127.0.0.1:{hanging_up}"]
+        try:
+            async with Manager(fetching_method=[], data_file=None,
+                               request_attempts=4) as manager:
+                manager.data_manager.add_proxy([{"url": URL(url), "country": None, "anonymity": None}
+                                                for url in urls])
+                with pytest.raises(RequestFailed) as failed:
+                    await manager.get_request("http://example.com/", timeout=5)
+            assert failed.value.attempts == 4
+            assert isinstance(failed.value.last_error, aiohttp.ClientConnectorError)
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(run())
@@ -0,0 +1,108 @@
+import msgpack
+import pytest
+
+from ineedproxy.data_manager import DataManager
+from ineedproxy.store import ProxyStore, ADD, REMOVE, UPDATE, CLEAR
+from ineedproxy.utils import URL
+
+
+def _proxy(url: str, country: str = "US") -> dict:
+    return {"url": url, "country": country, "anonymity": "elite"}
+
+
+def _journal_store(file, proxies=None, **kwargs) -> ProxyStore:
+    kwargs.setdefault("compact_min_bytes", 1 << 30)  # only compact when a test asks for it
+    return ProxyStore(file, snapshot=lambda: list(proxies or []), journal=True, **kwargs)
+
+
+def test_journal_replays_every_record_type(tmp_path):
+    file = tmp_path / "proxies.msgpack"
+    store = _journal_store(file)
+    store.load()
+    store.record([ADD, _proxy("http://10.0.0.1:80")], [ADD, _proxy("http://10.0.0.2:80")])
+    store.record([UPDATE, "http://10.0.0.1:80", {"country": "DE", "times_succeed": 2}])
+    store.record([REMOVE, "http://10.0.0.2:80"])
+    store.record([UPDATE, "http://10.0.0.2:80", {"country": "FR"}])  # of a removed proxy, ignored
+    assert _journal_store(file).load() == [{**_proxy("http://10.0.0.1:80", "DE"), "times_succeed": 2}]
+
+    store.record([CLEAR], [ADD, _proxy("http://10.0.0.3:80")])
+    assert _journal_store(file).load() == [_proxy("http://10.0.0.3:80")]
+
+
+def test_truncated_journal_tail_is_dropped(tmp_path):
+    file = tmp_path / "proxies.msgpack"
+    store = _journal_store(file)
+    store.load()
+    store.record([ADD, _proxy("http://10.0.0.1:80")], [ADD, _proxy("http://10.0.0.2:80")])
+    journal = store.journal_file
+    valid_size = journal.stat().st_size
+    partial = msgpack.packb([ADD, _proxy("http://10.0.0.3:80")], use_bin_type=True)
+    with open(journal, "ab") as f:
+        f.write(partial[:len(partial) // 2])  # a crash in the middle of an append
+
+    store = _journal_store(file)
+    assert [proxy["url"] for proxy in store.load()] == ["http://10.0.0.1:80", "http://10.0.0.2:80"]
+    assert journal.stat().st_size == valid_size
+
+    # appends after the cut are readable again
+    store.record([ADD, _proxy("http://10.0.0.4:80")])
+    assert [proxy["url"] for proxy in _journal_store(file).load()] == [
+        "http://10.0.0.1:80", "http://10.0.0.2:80", "http://10.0.0.4:80"]
+
+
+def test_compaction_folds_the_journal_into_the_snapshot(tmp_path):
+    file = tmp_path / "proxies.msgpack"
+    proxies = [_proxy(f"http://10.0.0.{n}:80") for n in range(5)]
+    store = _journal_store(file, proxies)
+    store.load()
+    store.record(*([ADD, proxy] for proxy in proxies))
+    assert store.journal_file.stat().st_size > 0
+
+    store.compact()
+    assert store.journal_file.stat().st_size == 0
+    assert _journal_store(file).load() == proxies
+
+    # compacts on its own once the journal outgrows the snapshot
+    store = _journal_store(file, proxies, compact_ratio=0.5, compact_min_bytes=0)
+    store.load()
+    snapshot_size = file.stat().st_size
+    for _ in range(20):
+        store.record([UPDATE, "http://10.0.0.0:80", {"times_succeed": 1}])
+        assert store.journal_file.stat().st_size <= snapshot_size * 0.5
+    assert store.metrics.store_writes.get("snapshot") >= 1
+
+
+def test_journal_turned_off_is_folded_in_once(tmp_path):
+    file = tmp_path / "proxies.msgpack"
+    store = _journal_store(file)
+    store.load()
+    store.record([ADD, _proxy("http://10.0.0.1:80")])
+
+    store = ProxyStore(file, snapshot=lambda: [])
+    assert [proxy["url"] for proxy in store.load()] == ["http://10.0.0.1:80"]
+    assert store.journal_file.stat().st_size == 0
+    assert [proxy["url"] for proxy in ProxyStore(file, snapshot=lambda: []).load()] == ["http://10.0.0.1:80"]
+
+
+def _data_manager(file, **kwargs) -> DataManager:
+    return DataManager(file, allowed_fails_in_row=3, fails_without_check=2, percent_failed_to_remove=0.5,
+                       min_proxies=0, **kwargs)
+
+
+@pytest.mark.parametrize("journal", [False, True])
+def test_write_behind_round_trip(tmp_path, journal):
+    file = tmp_path / "proxies.msgpack"
+    data_manager = _data_manager(file, flush_interval=60, journal=journal)
+    data_manager.add_proxy([{"url": URL(f"http://10.0.0.{n}:80"), "country": "US", "anonymity": "elite"}
+                            for n in range(4)])
+    ids = [proxy_id for proxy_id, _ in data_manager.slots.items()]
+    data_manager.acquire().success(0.2)
+    data_manager.rm_proxy(ids[1])
+    data_manager._update_seen(ids[2], {"country": "DE"})
+    expected = {proxy["url"]: dict(proxy) for proxy in data_manager.proxies}
+    assert data_manager.store._dirty > 0  # nothing written yet, the interval is far away
+    data_manager.close()
+
+    loaded = _data_manager(file, journal=journal)
+    assert {proxy["url"]: dict(proxy) for proxy in loaded.proxies} == expected
+    assert len(loaded.index.country_index["DE"]) == 1
@@ -0,0 +1,53 @@
+import asyncio
+
+from ineedproxy import URL
+from ineedproxy.test_proxies import iter_valid_proxies
+
+
+def test_prefilter_does_not_run_ahead_of_the_testers():
+    async def run():
+        # Accepts connections and never answers, so every full test hangs until its timeout
+        server = await asyncio.start_server(lambda reader, writer: None, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        taken = 0
+
+        def candidates():
+            nonlocal taken
+            for _ in range(2000):
+                taken += 1
+                yield {"url": URL(f"http://127.0.0.1:{port}"), "country": None, "anonymity": None}
+
+        valid = iter_valid_proxies(candidates(), simultaneous_proxy_requests=4, test_url="http://127.0.0.1:9/",
+                                   timeout=30, prefilter_timeout=1, prefilter_concurrency=20)
+        try:
+            await asyncio.wait_for(valid.__anext__(), 0.5)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            await valid.aclose()
+            server.close()
+        return taken
+
+    # 4 in the testers, up to 4 waiting in the queue and one per prefilter worker
+    assert asyncio.run(run()) <= 4 + 4 + 20
+
+
+def test_prefilter_and_testers_finish_the_whole_list():
+    async def run():
+        # Accepts connections and hangs up, so every candidate passes the prefilter and fails its test
+        async def hang_up(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            writer.close()
+
+        server = await asyncio.start_server(hang_up, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        invalid = []
+        candidates = [{"url": URL(f"http://127.0.0.1:{port}"), "country": None, "anonymity": None}] * 200
+        try:
+            valid = [proxy async for proxy in iter_valid_proxies(
+                candidates, simultaneous_proxy_requests=3, test_url="http://127.0.0.1:9/", timeout=5,
+                on_invalid=invalid.append, prefilter_timeout=1, prefilter_concurrency=50)]
+        finally:
+            server.close()
+        return valid, len(invalid)
+
+    assert asyncio.run(asyncio.wait_for(run(), 30)) == ([], 200)